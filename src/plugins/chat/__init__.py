@@ -1,26 +1,47 @@
 import asyncio
+import datetime
 import os
 import random
 import time
 
 from loguru import logger
-from nonebot import get_driver, on_command, on_message, require
-from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent, Message, MessageSegment
+from nonebot import get_driver, on_command, on_message, on_notice, require
+from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent, Message, MessageSegment, NoticeEvent
 from nonebot.rule import to_me
 from nonebot.typing import T_State
 
 from ...common.database import Database
+from ..models.cache import get_cache_stats
+from ..models.circuit_breaker import get_circuit_stats
+from ..models.client_pool import ClientSessionPool
+from ..models.key_pool import get_key_stats
+from ..models.latency import get_latency_stats
+from ..models.rate_limiter import RequestPriority, get_limiter_stats, llm_priority
+from ..models.timing import EventLoopMonitor, get_timing_stats
+from ..models.usage_recorder import UsageRecorder
+from ..models.utils_model import LLM_request
 from ..moods.moods import MoodManager  # 导入情绪管理器
 from ..schedule.schedule_generator import bot_schedule
 from ..utils.statistic import LLMStatistics
 from .bot import chat_bot
 from .config import global_config
 from .emoji_manager import emoji_manager
+from .group_info_cache import GroupInfoCache
+from .keyword_extractor import LOCAL_TOPIC_MODES, KeywordExtractor
 from .relationship_manager import relationship_manager
+from .utils import get_typo_generator
 from .willing_manager import willing_manager
 
 # 创建LLM统计实例
 llm_stats = LLMStatistics("llm_statistics.txt")
+llm_stats.register_runtime_source("模型请求排队", get_limiter_stats)
+llm_stats.register_runtime_source("模型缓存", get_cache_stats)
+llm_stats.register_runtime_source("相同请求合并", LLM_request.get_single_flight_stats)
+llm_stats.register_runtime_source("服务商熔断", get_circuit_stats)
+llm_stats.register_runtime_source("API key", get_key_stats)
+llm_stats.register_runtime_source("首字延迟", get_latency_stats)
+llm_stats.register_runtime_source("调用记录写入", UsageRecorder.get_instance().get_stats)
+llm_stats.register_runtime_source("模型调用耗时", get_timing_stats)
 
 # 添加标志变量
 _message_manager_started = False
@@ -38,6 +59,8 @@ Database.initialize(
         auth_source= config.MONGODB_AUTH_SOURCE
 )
 print("\033[1;32m[初始化数据库完成]\033[0m")
+# 模型调用记录的索引只在启动时创建一次
+LLM_request.init_database()
 
 
 # 导入其他模块
@@ -53,8 +76,16 @@ emoji_manager.initialize()
 print(f"\033[1;32m正在唤醒{global_config.BOT_NICKNAME}......\033[0m")
 # 创建机器人实例
 chat_bot = ChatBot()
+llm_stats.register_runtime_source("回复对冲", chat_bot.gpt.get_hedge_stats)
+llm_stats.register_runtime_source("回复模型路由", chat_bot.gpt.router.get_state)
+llm_stats.register_runtime_source("消息处理阶段", chat_bot.get_stage_stats)
+llm_stats.register_runtime_source("兴趣度估计", chat_bot.interest.get_stats)
+llm_stats.register_runtime_source("群信息缓存", GroupInfoCache.get_instance().get_stats)
+llm_stats.register_runtime_source("本地主题识别", KeywordExtractor.get_instance().get_stats)
 # 注册群消息处理器
 group_msg = on_message(priority=5)
+# 群成员变动的通知，用于刷新群成员信息缓存
+group_notice = on_notice(priority=5, block=False)
 # 创建定时任务
 scheduler = require("nonebot_plugin_apscheduler").scheduler
 
@@ -65,6 +96,8 @@ async def start_background_tasks():
     """启动后台任务"""
     # 启动LLM统计
     llm_stats.start()
+    # 测量事件循环的调度延迟，区分是服务商慢还是我们自己被阻塞
+    EventLoopMonitor.get_instance().start()
     print("\033[1;32m[初始化]\033[0m LLM统计功能已启动")
     
     # 初始化并启动情绪管理器
@@ -72,9 +105,14 @@ async def start_background_tasks():
     mood_manager.start_mood_update(update_interval=global_config.mood_update_interval)
     print("\033[1;32m[初始化]\033[0m 情绪管理器已启动")
     
+    # 错别字生成器初始化较慢，在线程里提前创建，避免第一次回复时阻塞
+    if global_config.chinese_typo_enable:
+        await asyncio.to_thread(get_typo_generator)
+    
     # 只启动表情包管理任务
     asyncio.create_task(emoji_manager.start_periodic_check(interval_MINS=global_config.EMOJI_CHECK_INTERVAL))
-    await bot_schedule.initialize()
+    with llm_priority(RequestPriority.BACKGROUND):
+        await bot_schedule.initialize()
     bot_schedule.print_schedule()
     
 @driver.on_startup
@@ -84,6 +122,13 @@ async def init_relationships():
     await relationship_manager.load_all_relationships()
     asyncio.create_task(relationship_manager._start_relationship_manager())
 
+@driver.on_shutdown
+async def close_llm_sessions():
+    """在 NoneBot2 退出时写入剩余的模型调用记录，并关闭模型请求的连接池"""
+    await UsageRecorder.get_instance().flush()
+    await ClientSessionPool.get_instance().close_all()
+    print("\033[1;32m[关闭]\033[0m 模型请求连接池已关闭")
+
 @driver.on_bot_connect
 async def _(bot: Bot):
     """Bot连接成功时的处理"""
@@ -106,13 +151,47 @@ async def _(bot: Bot):
 async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
     await chat_bot.handle_message(event, bot)
 
+@group_notice.handle()
+async def _(bot: Bot, event: NoticeEvent):
+    """进退群、管理员变动、群名片修改时作废对应的群成员信息缓存"""
+    if event.notice_type not in ("group_increase", "group_decrease", "group_admin", "group_card"):
+        return
+    group_id = getattr(event, "group_id", None)
+    user_id = getattr(event, "user_id", None)
+    if group_id is None:
+        return
+    if user_id is None or user_id == event.self_id:
+        # 机器人自己进退群时整个群的缓存都作废
+        GroupInfoCache.get_instance().invalidate(group_id)
+    else:
+        GroupInfoCache.get_instance().invalidate(group_id, user_id)
+
+# 本地提取关键词用的 IDF 表定时从聊天记录重新统计
+@scheduler.scheduled_job("interval", seconds=global_config.topic_idf_refresh_interval, id="refresh_topic_idf",
+                         next_run_time=datetime.datetime.now())
+async def refresh_topic_idf_task():
+    """统计本地提取关键词用的 IDF，只在有调用方使用本地方式时进行"""
+    modes = {global_config.topic_extract_activate, global_config.topic_extract_retrieve, global_config.topic_extract_build}
+    if not modes & set(LOCAL_TOPIC_MODES):
+        return
+    try:
+        documents = await asyncio.to_thread(
+            KeywordExtractor.get_instance().learn_idf_from_db,
+            Database.get_instance(), global_config.topic_idf_max_messages,
+        )
+        print(f"\033[1;32m[主题识别]\033[0m 从 {documents} 条消息统计了关键词 IDF")
+    except Exception as e:
+        print(f"\033[1;31m[错误]\033[0m 统计关键词 IDF 失败: {e}")
+
 # 添加build_memory定时任务
 @scheduler.scheduled_job("interval", seconds=global_config.build_memory_interval, id="build_memory")
 async def build_memory_task():
     """每build_memory_interval秒执行一次记忆构建"""
     print("\033[1;32m[记忆构建]\033[0m -------------------------------------------开始构建记忆-------------------------------------------")
     start_time = time.time()
-    await hippocampus.operation_build_memory(chat_size=20)
+    # 记忆构建是批量的后台请求，排队时让位给回复
+    with llm_priority(RequestPriority.BACKGROUND):
+        await hippocampus.operation_build_memory(chat_size=20)
     end_time = time.time()
     print(f"\033[1;32m[记忆构建]\033[0m -------------------------------------------记忆构建完成：耗时: {end_time - start_time:.2f} 秒-------------------------------------------")
     
@@ -1,14 +1,21 @@
+import asyncio
 import time
 from random import random
+from typing import Any, Dict
 
 from loguru import logger
 from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent
 
 from ..memory_system.memory import hippocampus
+from ..models.deadline import llm_deadline
+from ..models.rate_limiter import RequestPriority, llm_priority
+from ..models.timing import Histogram
 from ..moods.moods import MoodManager  # 导入情绪管理器
 from .config import global_config
 from .cq_code import CQCode  # 导入CQCode模块
 from .emoji_manager import emoji_manager  # 导入表情包管理器
+from .group_info_cache import GroupInfoCache
+from .interest_estimator import InterestEstimator
 from .llm_generator import ResponseGenerator
 from .message import (
     Message,
@@ -16,10 +23,16 @@ from .message import (
     Message_Thinking,  # 导入 Message_Thinking 类
     MessageSet,
 )
+from .message_analysis import MessageAnalysis
 from .message_sender import message_manager  # 导入新的消息管理器
 from .relationship_manager import relationship_manager
 from .storage import MessageStorage
-from .utils import calculate_typing_time, is_mentioned_bot_in_txt
+from .utils import (
+    StreamSentenceSplitter,
+    calculate_typing_time,
+    is_mentioned_bot_in_txt,
+    reply_over_limit,
+)
 from .willing_manager import willing_manager  # 导入意愿管理器
 
 
@@ -27,6 +40,8 @@ class ChatBot:
     def __init__(self):
         self.storage = MessageStorage()
         self.gpt = ResponseGenerator()
+        # 先用本地规则判断消息是否值得请求模型计算兴趣度
+        self.interest = InterestEstimator(hippocampus)
         self.bot = None  # bot 实例引用
         self._started = False
         self.mood_manager = MoodManager.get_instance()  # 获取情绪管理器单例
@@ -34,12 +49,39 @@ class ChatBot:
         
         self.emoji_chance = 0.2  # 发送表情包的基础概率
         # self.message_streams = MessageStreamContainer()
+        # 收到消息到决定是否回复之间各阶段的耗时
+        self.stage_timing: Dict[str, Histogram] = {}
         
     async def _ensure_started(self):
         """确保所有任务已启动"""
         if not self._started:
             self._started = True
 
+    def _observe_stage(self, stage: str, seconds: float):
+        histogram = self.stage_timing.get(stage)
+        if histogram is None:
+            histogram = self.stage_timing[stage] = Histogram()
+        histogram.observe(seconds)
+
+    async def _timed(self, stage: str, awaitable):
+        """等待 awaitable 并记录这个阶段的耗时"""
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self._observe_stage(stage, time.monotonic() - start)
+
+    def get_stage_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取消息处理各阶段的耗时（秒）；同一阶段的几步同时进行，合计约为各阶段中最慢一步的耗时之和"""
+        return {
+            stage: {"次数": histogram.count, "耗时": histogram.summary()}
+            for stage, histogram in self.stage_timing.items()
+        }
+
+    async def _update_sender_relationship(self, user_id: int, sender_info: dict):
+        await relationship_manager.update_relationship(user_id = user_id, data = sender_info)
+        await relationship_manager.update_relationship_value(user_id = user_id, relationship_value = 0.5)
+
     async def handle_message(self, event: GroupMessageEvent, bot: Bot) -> None:
         """处理收到的群消息"""
         
@@ -50,22 +92,29 @@ class ChatBot:
         if event.user_id in global_config.ban_user_id:
             return
 
-        group_info = await bot.get_group_info(group_id=event.group_id)
-        sender_info = await bot.get_group_member_info(group_id=event.group_id, user_id=event.user_id, no_cache=True)
-        
-        await relationship_manager.update_relationship(user_id = event.user_id, data = sender_info)
-        await relationship_manager.update_relationship_value(user_id = event.user_id, relationship_value = 0.5)
+        pipeline_start = time.monotonic()
+        # 阶段1：获取群信息和发送者的群名片，缓存命中时不经过 OneBot 连接
+        group_info_cache = GroupInfoCache.get_instance()
+        group_info, sender_info = await self._timed("获取群成员信息", asyncio.gather(
+            group_info_cache.get_group_info(bot, event.group_id),
+            group_info_cache.get_member_info(bot, event.group_id, event.user_id),
+        ))
         
         message = Message(
             group_id=event.group_id,
             user_id=event.user_id,
             message_id=event.message_id,
+            group_name=group_info.get('group_name'),
             user_cardname=sender_info['card'],
             raw_message=str(event.original_message), 
             plain_text=event.get_plaintext(),
             reply_message=event.reply,
         )
-        await message.initialize()
+        # 阶段2：更新关系和解析消息（可能调用识图模型）互不依赖，同时进行
+        await asyncio.gather(
+            self._timed("更新关系", self._update_sender_relationship(event.user_id, sender_info)),
+            self._timed("解析消息", message.initialize()),
+        )
 
         # 过滤词
         for word in global_config.ban_words:
@@ -81,13 +130,21 @@ class ChatBot:
         # topic=await topic_identifier.identify_topic_llm(message.processed_plain_text)
         topic = ''
         interested_rate = 0
-        interested_rate = await hippocampus.memory_activate_value(message.processed_plain_text)/100
+        # 主题、分词和 embedding 只计算一次，记忆激活、记忆检索和知识检索共用
+        message.analysis = MessageAnalysis(message.processed_plain_text)
+        is_mentioned = is_mentioned_bot_in_txt(message.processed_plain_text)
+        # 阶段3：兴趣度估计（可能请求模型做记忆激活）和存储消息同时进行
+        interested_rate, _ = await asyncio.gather(
+            self._timed("记忆激活", self.interest.estimate(message, is_mentioned)),
+            self._timed("存储消息", self.storage.store_message(message, topic[0] if topic else None)),
+        )
         print(f"\033[1;32m[记忆激活]\033[0m 对{message.processed_plain_text}的激活度:---------------------------------------{interested_rate}\n")
         # logger.info(f"\033[1;32m[主题识别]\033[0m 使用{global_config.topic_extract}主题: {topic}")
+        self._observe_stage("合计", time.monotonic() - pipeline_start)
         
-        await self.storage.store_message(message, topic[0] if topic else None)
+        # 群里的话题往前走了，思考太久的旧回复可能已经过时
+        message_manager.notify_new_message(event.group_id)
 
-        is_mentioned = is_mentioned_bot_in_txt(message.processed_plain_text)
         reply_probability = willing_manager.change_reply_willing_received(
             event.group_id, 
             topic[0] if topic else None,
@@ -115,9 +172,32 @@ class ChatBot:
 
             willing_manager.change_reply_willing_sent(thinking_message.group_id)
             
-            response,raw_content = await self.gpt.generate_response(message)
+            # 被提及时的回复在模型请求排队中最优先
+            priority = RequestPriority.MENTION_REPLY if is_mentioned else RequestPriority.NORMAL_REPLY
+            streamed = global_config.stream_reply
+            # 回复在思考消息的截止时间之前生成，超时后消息管理器会取消这个任务，
+            # 还在排队、重试或生成中的模型请求随之取消
+            with llm_priority(priority), llm_deadline(thinking_message.deadline):
+                if streamed:
+                    reply = self._stream_response(message, thinking_message, tinking_time_point)
+                else:
+                    reply = self.gpt.generate_response(message)
+                thinking_message.reply_task = asyncio.ensure_future(reply)
+            try:
+                response, raw_content = await thinking_message.reply_task
+            except asyncio.CancelledError:
+                # 思考超时或回复已过时，原因已由消息管理器输出
+                if thinking_message.cancel_reason is None:
+                    raise
+                response, raw_content = None, ""
+            # 没有生成回复（如服务商熔断）时立即移除思考消息，不必等到思考超时
+            if not response:
+                message_manager.get_container(event.group_id).remove_message(thinking_message)
             
-        if response:
+        if response and streamed:
+            # 流式回复的句子已经在生成过程中加入发送队列
+            thinking_start_time = thinking_message.thinking_start_time
+        elif response:
             container = message_manager.get_container(event.group_id)
             thinking_message = None
             # 找到message,删除
@@ -171,6 +251,7 @@ class ChatBot:
             # print(f"\033[1;32m[回复]\033[0m 将回复载入发送容器")
             message_manager.add_message(message_set)
             
+        if response:
             bot_response_time = tinking_time_point
 
             if random() < global_config.emoji_chance:
@@ -222,5 +303,74 @@ class ChatBot:
         
         # willing_manager.change_reply_willing_after_sent(event.group_id)
 
+    async def _stream_response(self, message: Message, thinking_message: Message_Thinking, tinking_time_point: float):
+        """流式生成回复，每凑齐一句就插到思考消息前面，由消息管理器立即发送
+
+        回复过长或句子过多时立即停止生成，与非流式回复一样改为发送默认回复（已经发出的句子无法撤回，
+        这时只停止发送）；思考消息已被移除（超时）时放弃剩下的内容
+
+        Returns:
+            (已发送的句子列表, 完整的原始回复)
+        """
+        container = message_manager.get_container(message.group_id)
+        splitter = StreamSentenceSplitter()
+        sentences = []
+        raw_content = ""
+        accu_typing_time = 0
+
+        async def enqueue(sentence: str) -> bool:
+            nonlocal accu_typing_time
+            accu_typing_time += calculate_typing_time(sentence)
+            bot_message = Message_Sending(
+                group_id=message.group_id,
+                user_id=global_config.BOT_QQ,
+                message_id=thinking_message.message_id,
+                raw_message=sentence,
+                plain_text=sentence,
+                processed_plain_text=sentence,
+                user_nickname=global_config.BOT_NICKNAME,
+                group_name=message.group_name,
+                time=tinking_time_point + accu_typing_time,
+                thinking_start_time=thinking_message.thinking_start_time,
+                reply_message_id=message.message_id
+            )
+            await bot_message.initialize()
+            bot_message.is_head = not sentences
+            if not container.insert_before(bot_message, thinking_message):
+                print("\033[1;33m[警告]\033[0m 未找到对应的思考消息，可能已超时被移除")
+                return False
+            sentences.append(sentence)
+            return True
+
+        async def enqueue_checked(sentence: str) -> bool:
+            """与 process_llm_response 的规则一致：超过字数或句数上限时停止，还没有发出句子时改为发送默认回复"""
+            fallback = reply_over_limit(raw_content, len(sentences) + 1)
+            if fallback:
+                if not sentences:
+                    await enqueue(fallback)
+                return False
+            return await enqueue(sentence)
+
+        stream = self.gpt.generate_response_stream(message)
+        try:
+            async for delta in stream:
+                raw_content += delta
+                # 字数已经超过上限时不必等这一句写完
+                if len(raw_content) > global_config.max_reply_length:
+                    await enqueue_checked("")
+                    return sentences, raw_content
+                for sentence in splitter.feed(delta):
+                    if not await enqueue_checked(sentence):
+                        return sentences, raw_content
+            for sentence in splitter.flush():
+                if not await enqueue_checked(sentence):
+                    break
+        except Exception as e:
+            print(f"\033[1;31m[错误]\033[0m 流式生成回复时出错: {e}")
+        finally:
+            await stream.aclose()
+            container.remove_message(thinking_message)
+        return sentences, raw_content
+
 # 创建全局ChatBot实例
 chat_bot = ChatBot()
\ No newline at end of file
@@ -18,7 +18,10 @@ class BotConfig:
     
     # 消息处理相关配置
     MIN_TEXT_LENGTH: int = 2  # 最小处理文本长度
+    interest_local_tier: bool = True  # 先用本地规则判断消息是否与记忆相关，无关时不请求模型计算兴趣度
     MAX_CONTEXT_SIZE: int = 15  # 上下文最大消息数
+    prompt_max_tokens: int = 4000  # 回复prompt的估算token上限，超出时裁剪聊天记录、记忆、知识和日程，0为不限
+    prompt_max_line_tokens: int = 200  # 上下文中单条消息最多的估算token数，超出部分截断
     emoji_chance: float = 0.2  # 发送表情包的基础概率
     
     ENABLE_PIC_TRANSLATE: bool = True  # 是否启用图片翻译
@@ -26,15 +29,25 @@ class BotConfig:
     talk_allowed_groups = set()
     talk_frequency_down_groups = set()
     thinking_timeout: int = 100  # 思考时间
+    supersede_message_count: int = 10  # 思考期间群里又来了这么多条消息就放弃这次回复，0为不限
+    supersede_on_new_reply: bool = False  # 同一个群开始新的回复时放弃还在思考的旧回复
     
     response_willing_amplifier: float = 1.0  # 回复意愿放大系数
     response_interested_rate_amplifier: float = 1.0  # 回复兴趣度放大系数
     down_frequency_rate: float = 3.5  # 降低回复频率的群组回复意愿降低系数
     
     ban_user_id = set()
+    group_info_cache_ttl: float = 3600  # 群信息缓存时间（秒），0为不缓存
+    member_info_cache_ttl: float = 600  # 群成员信息（群名片）缓存时间（秒），0为不缓存
     
     build_memory_interval: int = 30  # 记忆构建间隔（秒）
     forget_memory_interval: int = 300  # 记忆遗忘间隔（秒）
+    # 识别主题的方式：llm 请求主题判断模型，tfidf/textrank 用 jieba 在本地提取关键词
+    topic_extract_activate: str = "llm"  # 记忆激活（计算兴趣度）
+    topic_extract_retrieve: str = "llm"  # 记忆检索（构建回复 prompt）
+    topic_extract_build: str = "llm"  # 记忆构建
+    topic_idf_max_messages: int = 50000  # 本地提取关键词时，从最近多少条消息统计 IDF
+    topic_idf_refresh_interval: int = 21600  # IDF 重新统计间隔（秒）
     EMOJI_CHECK_INTERVAL: int = 120  # 表情包检查间隔（分钟）
     EMOJI_REGISTER_INTERVAL: int = 10  # 表情包注册间隔（分钟）
     EMOJI_SAVE: bool = True  # 偷表情包
@@ -44,6 +57,20 @@ class BotConfig:
     ban_words = set()
 
     max_response_length: int = 1024  # 最大回复长度
+    stream_reply: bool = False  # 流式生成回复，每生成完一句就发送
+    max_reply_length: int = 200  # 超过这个字数的回复会被丢弃，生成时超过即提前停止
+    max_reply_sentences: int = 5  # 分句后超过这个句数的回复会被丢弃
+    hedge_enable: bool = False  # 主回复模型迟迟没有输出时同时请求备用模型
+    hedge_model: str = "llm_normal"  # 对冲用的备用模型项名
+    hedge_percentile: float = 0.9  # 超过主模型首字延迟的这个分位数就发起对冲
+    hedge_min_delay: float = 1.0  # 对冲延迟的下限（秒）
+    hedge_default_delay: float = 10.0  # 首字延迟样本不足时的对冲延迟（秒）
+    router_enable: bool = True  # 回复模型变慢或频繁出错时临时调整选择比例
+    router_window: float = 300  # 统计耗时和错误率的时间窗口（秒）
+    router_min_samples: int = 5  # 窗口内样本数少于这个值时不调整
+    router_p95_slo: float = 60  # p95 耗时超过这个值（秒）时降权
+    router_error_rate: float = 0.3  # 错误率达到这个值时降权
+    router_shift_factor: float = 0.2  # 降权后保留原比例的多少
     
     # 模型配置
     llm_reasoning: Dict[str, str] = field(default_factory=lambda: {})
@@ -87,6 +114,34 @@ class BotConfig:
     PERSONALITY_1: float = 0.6 # 第一种人格概率
     PERSONALITY_2: float = 0.3 # 第二种人格概率
     PERSONALITY_3: float = 0.1 # 第三种人格概率
+
+    # LLM客户端连接池配置
+    llm_pool_limit: int = 100  # 连接池总连接数上限，0为不限制
+    llm_pool_limit_per_host: int = 20  # 对同一个API地址的最大连接数，0为不限制
+    llm_keepalive_timeout: float = 60  # 空闲连接保活时间（秒）
+    llm_dns_cache_ttl: int = 300  # DNS缓存时间（秒）
+    llm_connect_timeout: float = 10  # 建立连接的超时时间（秒）
+    llm_default_max_concurrency: int = 16  # 每个服务商默认的最大同时请求数，0为不限制
+    llm_provider_limits: Dict[str, dict] = field(default_factory=lambda: {})  # 按服务商的限流配置
+    llm_background_max_share: float = 0.5  # 记忆构建等后台任务最多占用的并发名额比例
+    embedding_batch_size: int = 32  # 一次embedding请求最多包含的文本条数
+    embedding_batch_max_tokens: int = 8000  # 一次embedding请求最多包含的估算token数
+    embedding_batch_wait_ms: float = 5  # 合并并发的单条embedding请求时的等待时间（毫秒）
+    llm_single_flight: bool = True  # 并发的相同请求只向服务商发送一次
+    circuit_window: float = 60  # 熔断器统计失败率的时间窗口（秒）
+    circuit_min_requests: int = 5  # 时间窗口内至少有这么多请求才会判断是否熔断
+    circuit_failure_rate: float = 0.5  # 失败率或慢请求比例达到该值时熔断
+    circuit_slow_call_seconds: float = 60  # 收到响应头超过该时间的请求算作慢请求
+    circuit_open_seconds: float = 30  # 熔断后多久开始探测恢复（秒）
+    circuit_half_open_probes: int = 1  # 探测恢复时同时放行的请求数
+    key_quota_bench_seconds: float = 3600  # 余额不足或认证失败的 key 停用多久（秒）
+    response_cache_ttl: float = 3600  # 辅助模型（情绪标签、主题识别等）响应缓存的过期时间（秒），0为不缓存
+    response_cache_size: int = 2000  # 内存中缓存的响应条数
+    response_cache_persist: bool = False  # 是否把响应缓存保存到数据库
+    embedding_cache_size: int = 10000  # 内存中缓存的embedding条数
+    embedding_cache_persist: bool = True  # 是否把embedding缓存保存到数据库
+    usage_flush_size: int = 50  # 模型调用记录攒够这么多条就写入数据库
+    usage_flush_interval: float = 5  # 模型调用记录最多在内存中等待多久（秒）再写入
     
     @staticmethod
     def get_config_dir() -> str:
@@ -193,6 +248,20 @@ class BotConfig:
             config.MODEL_V3_PROBABILITY = response_config.get("model_v3_probability", config.MODEL_V3_PROBABILITY)
             config.MODEL_R1_DISTILL_PROBABILITY = response_config.get("model_r1_distill_probability", config.MODEL_R1_DISTILL_PROBABILITY)
             config.max_response_length = response_config.get("max_response_length", config.max_response_length)
+            config.stream_reply = response_config.get("stream_reply", config.stream_reply)
+            config.max_reply_length = response_config.get("max_reply_length", config.max_reply_length)
+            config.max_reply_sentences = response_config.get("max_reply_sentences", config.max_reply_sentences)
+            config.hedge_enable = response_config.get("hedge_enable", config.hedge_enable)
+            config.hedge_model = response_config.get("hedge_model", config.hedge_model)
+            config.hedge_percentile = response_config.get("hedge_percentile", config.hedge_percentile)
+            config.hedge_min_delay = response_config.get("hedge_min_delay", config.hedge_min_delay)
+            config.hedge_default_delay = response_config.get("hedge_default_delay", config.hedge_default_delay)
+            config.router_enable = response_config.get("router_enable", config.router_enable)
+            config.router_window = response_config.get("router_window", config.router_window)
+            config.router_min_samples = response_config.get("router_min_samples", config.router_min_samples)
+            config.router_p95_slo = response_config.get("router_p95_slo", config.router_p95_slo)
+            config.router_error_rate = response_config.get("router_error_rate", config.router_error_rate)
+            config.router_shift_factor = response_config.get("router_shift_factor", config.router_shift_factor)
         
         def model(parent: dict):
             # 加载模型配置
@@ -231,6 +300,11 @@ class BotConfig:
                     elif config.INNER_VERSION in SpecifierSet(">=0.0.1"):
                         stable_item = ["name","pri_in","pri_out"]
                         pricing_item = ["pri_in","pri_out"]
+                        # 可选的模型级限流配置，不填则只受服务商级限流约束
+                        # fallback 为服务商熔断时改用的模型项名，如 llm_normal
+                        # stop 为停止序列，模型输出到这些内容时结束生成
+                        # max_prompt_tokens 为用作回复模型时 prompt 的估算token上限，覆盖 message.prompt_max_tokens
+                        optional_item = ["max_concurrency","rpm","tpm","fallback","stop","max_prompt_tokens"]
                         # 从配置中原始拷贝稳定字段
                         for i in stable_item:
                             # 如果 字段 属于计费项 且获取不到，那默认值是 0
@@ -252,6 +326,11 @@ class BotConfig:
                         
                         cfg_target["base_url"] = f"{provider}_BASE_URL"
                         cfg_target["key"] = f"{provider}_KEY"
+                        cfg_target["provider"] = provider
+
+                        for i in optional_item:
+                            if i in cfg_item:
+                                cfg_target[i] = cfg_item[i]
 
                     
                     # 如果 列表中的项目在 model_config 中，利用反射来设置对应项目
@@ -272,11 +351,24 @@ class BotConfig:
                 config.response_willing_amplifier = msg_config.get("response_willing_amplifier", config.response_willing_amplifier)
                 config.response_interested_rate_amplifier = msg_config.get("response_interested_rate_amplifier", config.response_interested_rate_amplifier)
                 config.down_frequency_rate = msg_config.get("down_frequency_rate", config.down_frequency_rate)
+                config.supersede_message_count = msg_config.get("supersede_message_count", config.supersede_message_count)
+                config.supersede_on_new_reply = msg_config.get("supersede_on_new_reply", config.supersede_on_new_reply)
+                config.prompt_max_tokens = msg_config.get("prompt_max_tokens", config.prompt_max_tokens)
+                config.prompt_max_line_tokens = msg_config.get("prompt_max_line_tokens", config.prompt_max_line_tokens)
+                config.interest_local_tier = msg_config.get("interest_local_tier", config.interest_local_tier)
 
         def memory(parent: dict):
             memory_config = parent["memory"]
             config.build_memory_interval = memory_config.get("build_memory_interval", config.build_memory_interval)
             config.forget_memory_interval = memory_config.get("forget_memory_interval", config.forget_memory_interval)
+            for key in ("topic_extract_activate", "topic_extract_retrieve", "topic_extract_build"):
+                mode = memory_config.get(key, getattr(config, key))
+                if mode not in ("llm", "tfidf", "textrank"):
+                    logger.error(f"[memory] 中的 {key} 只能是 llm、tfidf 或 textrank，当前为 {mode}，使用 llm")
+                    mode = "llm"
+                setattr(config, key, mode)
+            config.topic_idf_max_messages = memory_config.get("topic_idf_max_messages", config.topic_idf_max_messages)
+            config.topic_idf_refresh_interval = memory_config.get("topic_idf_refresh_interval", config.topic_idf_refresh_interval)
 
         def mood(parent: dict):
             mood_config = parent["mood"]
@@ -302,12 +394,43 @@ class BotConfig:
             config.talk_allowed_groups = set(groups_config.get("talk_allowed", []))
             config.talk_frequency_down_groups = set(groups_config.get("talk_frequency_down", []))
             config.ban_user_id = set(groups_config.get("ban_user_id", []))
+            config.group_info_cache_ttl = groups_config.get("group_info_cache_ttl", config.group_info_cache_ttl)
+            config.member_info_cache_ttl = groups_config.get("member_info_cache_ttl", config.member_info_cache_ttl)
 
         def others(parent: dict):
             others_config = parent["others"]
             config.enable_advance_output = others_config.get("enable_advance_output", config.enable_advance_output)
             config.enable_kuuki_read = others_config.get("enable_kuuki_read", config.enable_kuuki_read)
 
+        def llm_client(parent: dict):
+            llm_client_config = parent["llm_client"]
+            config.llm_pool_limit = llm_client_config.get("pool_limit", config.llm_pool_limit)
+            config.llm_pool_limit_per_host = llm_client_config.get("pool_limit_per_host", config.llm_pool_limit_per_host)
+            config.llm_keepalive_timeout = llm_client_config.get("keepalive_timeout", config.llm_keepalive_timeout)
+            config.llm_dns_cache_ttl = llm_client_config.get("dns_cache_ttl", config.llm_dns_cache_ttl)
+            config.llm_connect_timeout = llm_client_config.get("connect_timeout", config.llm_connect_timeout)
+            config.llm_default_max_concurrency = llm_client_config.get("default_max_concurrency", config.llm_default_max_concurrency)
+            config.llm_provider_limits = llm_client_config.get("provider_limits", config.llm_provider_limits)
+            config.llm_background_max_share = llm_client_config.get("background_max_share", config.llm_background_max_share)
+            config.embedding_batch_size = llm_client_config.get("embedding_batch_size", config.embedding_batch_size)
+            config.embedding_batch_max_tokens = llm_client_config.get("embedding_batch_max_tokens", config.embedding_batch_max_tokens)
+            config.embedding_batch_wait_ms = llm_client_config.get("embedding_batch_wait_ms", config.embedding_batch_wait_ms)
+            config.llm_single_flight = llm_client_config.get("single_flight", config.llm_single_flight)
+            config.circuit_window = llm_client_config.get("circuit_window", config.circuit_window)
+            config.circuit_min_requests = llm_client_config.get("circuit_min_requests", config.circuit_min_requests)
+            config.circuit_failure_rate = llm_client_config.get("circuit_failure_rate", config.circuit_failure_rate)
+            config.circuit_slow_call_seconds = llm_client_config.get("circuit_slow_call_seconds", config.circuit_slow_call_seconds)
+            config.circuit_open_seconds = llm_client_config.get("circuit_open_seconds", config.circuit_open_seconds)
+            config.circuit_half_open_probes = llm_client_config.get("circuit_half_open_probes", config.circuit_half_open_probes)
+            config.key_quota_bench_seconds = llm_client_config.get("key_quota_bench_seconds", config.key_quota_bench_seconds)
+            config.response_cache_ttl = llm_client_config.get("response_cache_ttl", config.response_cache_ttl)
+            config.response_cache_size = llm_client_config.get("response_cache_size", config.response_cache_size)
+            config.response_cache_persist = llm_client_config.get("response_cache_persist", config.response_cache_persist)
+            config.embedding_cache_size = llm_client_config.get("embedding_cache_size", config.embedding_cache_size)
+            config.embedding_cache_persist = llm_client_config.get("embedding_cache_persist", config.embedding_cache_persist)
+            config.usage_flush_size = llm_client_config.get("usage_flush_size", config.usage_flush_size)
+            config.usage_flush_interval = llm_client_config.get("usage_flush_interval", config.usage_flush_interval)
+
         # 版本表达式：>=1.0.0,<2.0.0
         # 允许字段：func: method, support: str, notice: str, necessary: bool
         # 如果使用 notice 字段，在该组配置加载时，会展示该字段对用户的警示
@@ -360,6 +483,11 @@ class BotConfig:
                 "support": ">=0.0.3",
                 "necessary": False
             },
+            "llm_client": {
+                "func": llm_client,
+                "support": ">=0.0.4",
+                "necessary": False
+            },
             "groups": {
                 "func": groups,
                 "support": ">=0.0.0"
@@ -412,6 +540,8 @@ class BotConfig:
                         # 通过 pass 处理的项虽然直接忽略也是可以的，但是为了不增加理解困难，依然需要在这里显式处理
                         if key == "keywords_reaction":
                             pass
+                        elif key == "llm_client":
+                            pass
                     
                     else:
                         # 如果用户根本没有需要的配置项，提示缺少配置
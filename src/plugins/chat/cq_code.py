@@ -60,11 +60,14 @@ class CQCode:
     translated_plain_text: Optional[str] = None
     reply_message: Dict = None  # 存储回复消息
     image_base64: Optional[str] = None
-    _llm: Optional[LLM_request] = None
 
-    def __post_init__(self):
-        """初始化LLM实例"""
-        self._llm = LLM_request(model=global_config.vlm, temperature=0.4, max_tokens=300)
+    @property
+    def _llm(self) -> LLM_request:
+        """识图模型，只有图片类CQ码才会用到，使用共享实例
+
+        多个群同时收到同一张图时描述只需要请求一次，允许合并相同请求
+        """
+        return LLM_request.get_instance(model=global_config.vlm, temperature=0.4, max_tokens=300, coalesce=True)
 
     async def translate(self):
         """根据CQ码类型进行相应的翻译处理"""
@@ -76,7 +79,7 @@ class CQCode:
             else:
                 self.translated_plain_text = await self.translate_emoji()
         elif self.type == 'at':
-            user_nickname = get_user_nickname(self.params.get('qq', ''))
+            user_nickname = get_user_nickname(self.params.get('qq', ''), self.group_id)
             if user_nickname:
                 self.translated_plain_text = f"[@{user_nickname}]"
             else:
@@ -10,8 +10,9 @@ from nonebot import get_driver
 
 from ...common.database import Database
 from ..chat.config import global_config
-from ..chat.utils import get_embedding
+from ..chat.utils import get_embedding, get_embeddings
 from ..chat.utils_image import image_path_to_base64
+from ..models.rate_limiter import RequestPriority, llm_priority
 from ..models.utils_model import LLM_request
 
 driver = get_driver()
@@ -32,8 +33,8 @@ class EmojiManager:
     def __init__(self):
         self.db = Database.get_instance()
         self._scan_task = None
-        self.vlm = LLM_request(model=global_config.vlm, temperature=0.3, max_tokens=1000)
-        self.llm_emotion_judge = LLM_request(model=global_config.llm_normal_minor, max_tokens=60,temperature=0.8) #更高的温度，更少的token（后续可以根据情绪来调整温度）
+        self.vlm = LLM_request.get_instance(model=global_config.vlm, temperature=0.3, max_tokens=1000)
+        self.llm_emotion_judge = LLM_request.get_instance(model=global_config.llm_normal_minor, max_tokens=60,temperature=0.8,cache_ttl=global_config.response_cache_ttl) #更高的温度，更少的token（后续可以根据情绪来调整温度）
         
     def _ensure_emoji_dir(self):
         """确保表情存储目录存在"""
@@ -200,7 +201,7 @@ class EmojiManager:
         try:
             prompt = f'这是{global_config.BOT_NICKNAME}将要发送的消息内容:\n{text}\n若要为其配上表情包，请你输出这个表情包应该表达怎样的情感，应该给人什么样的感觉，不要太简洁也不要太长，注意不要输出任何对消息内容的分析内容，只输出\"一种什么样的感觉\"中间的形容词部分。'
             
-            content, _ = await self.llm_emotion_judge.generate_response_async(prompt)
+            content, _ = await self.llm_emotion_judge.generate_response_async(prompt, request_type="emotion")
             logger.info(f"输出描述: {content}")
             return content
             
@@ -216,6 +217,8 @@ class EmojiManager:
 
             # 获取所有支持的图片文件
             files_to_process = [f for f in os.listdir(emoji_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif'))]
+            # 描述生成后先攒起来，最后一次性批量获取embedding
+            new_emojis = []
             
             for filename in files_to_process:
                 image_path = os.path.join(emoji_dir, filename)
@@ -241,8 +244,14 @@ class EmojiManager:
                         logger.info(f"其不满足过滤规则，被剔除 {check}")
                         continue
                     logger.info(f"check通过 {check}")
-                embedding = await get_embedding(discription)
                 if discription is not None:
+                    new_emojis.append((filename, image_path, discription))
+                else:
+                    logger.warning(f"跳过表情包: {filename}")
+
+            if new_emojis:
+                embeddings = await get_embeddings([discription for _, _, discription in new_emojis])
+                for (filename, image_path, discription), embedding in zip(new_emojis, embeddings):
                     # 准备数据库记录
                     emoji_record = {
                         'filename': filename,
@@ -256,8 +265,6 @@ class EmojiManager:
                     self.db.db['emoji'].insert_one(emoji_record)
                     logger.success(f"注册新表情包: {filename}")
                     logger.info(f"描述: {discription}")
-                else:
-                    logger.warning(f"跳过表情包: {filename}")
                 
         except Exception as e:
             logger.error(f"扫描表情包失败: {str(e)}")
@@ -267,7 +274,9 @@ class EmojiManager:
         """定期扫描新表情包"""
         while True:
             print("\033[1;36m[表情包]\033[0m 开始扫描新表情包...")
-            await self.scan_new_emojis()
+            # 偷表情包的识图请求属于后台任务
+            with llm_priority(RequestPriority.BACKGROUND):
+                await self.scan_new_emojis()
             await asyncio.sleep(interval_MINS * 60)  # 每600秒扫描一次
 
 
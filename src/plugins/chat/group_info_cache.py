@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from nonebot.adapters.onebot.v11 import Bot
+
+from .config import global_config
+
+
+class _Entry:
+    __slots__ = ("value", "loaded_at", "ttl")
+
+    def __init__(self, value: dict, ttl: float):
+        self.value = value
+        self.loaded_at = time.monotonic()
+        self.ttl = ttl
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.loaded_at
+
+
+class GroupInfoCache:
+    """OneBot 群信息和群成员信息的缓存
+
+    每条群消息都要用到群信息和发送者的群名片，不必每次都经过 OneBot 连接去查：
+    - 缓存在过期时间内直接返回；用到最后 REFRESH_AHEAD 比例的时间时在后台刷新，调用方不等待
+    - 同一个群/成员并发的查询只向 OneBot 发一次请求
+    - 加群、退群、管理员变动、群名片修改的通知到达时作废对应的缓存
+    - 查询失败时如果还有过期的缓存就先用旧数据
+    """
+    _instance: Optional["GroupInfoCache"] = None
+
+    # 剩余有效期不到这个比例时在后台刷新
+    REFRESH_AHEAD = 0.2
+    # 最多缓存的成员数，超出时丢弃最久没用到的
+    MAX_MEMBERS = 20000
+
+    def __init__(self):
+        self._groups: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._members: "OrderedDict[Tuple[int, int], _Entry]" = OrderedDict()
+        # 正在进行的查询，相同的查询共享结果
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+        # 指标
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.stale_served = 0
+        self.invalidations = 0
+
+    @classmethod
+    def get_instance(cls) -> "GroupInfoCache":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    async def get_group_info(self, bot: Bot, group_id: int) -> dict:
+        """获取群信息"""
+        return await self._get(
+            self._groups, group_id, global_config.group_info_cache_ttl,
+            lambda: bot.get_group_info(group_id=group_id),
+        )
+
+    async def get_member_info(self, bot: Bot, group_id: int, user_id: int) -> dict:
+        """获取群成员信息（含群名片 card）"""
+        return await self._get(
+            self._members, (group_id, user_id), global_config.member_info_cache_ttl,
+            lambda: bot.get_group_member_info(group_id=group_id, user_id=user_id, no_cache=True),
+        )
+
+    async def _get(self, store: OrderedDict, key: Hashable, ttl: float,
+                   loader: Callable[[], Awaitable[dict]]) -> dict:
+        if ttl <= 0:
+            return await loader()
+        entry = store.get(key)
+        if entry is not None and entry.age < entry.ttl:
+            self.hits += 1
+            store.move_to_end(key)
+            if entry.age > entry.ttl * (1 - self.REFRESH_AHEAD) and (id(store), key) not in self._loading:
+                self.refreshes += 1
+                self._load(store, key, ttl, loader)
+            return entry.value
+
+        self.misses += 1
+        try:
+            # 调用方被取消时不影响共享的查询
+            return await asyncio.shield(self._load(store, key, ttl, loader))
+        except Exception:
+            if entry is None:
+                raise
+            self.stale_served += 1
+            return entry.value
+
+    def _load(self, store: OrderedDict, key: Hashable, ttl: float,
+              loader: Callable[[], Awaitable[dict]]) -> asyncio.Future:
+        """发起查询，已有相同的查询时直接返回它"""
+        loading_key = (id(store), key)
+        future = self._loading.get(loading_key)
+        if future is not None:
+            return future
+
+        async def load() -> dict:
+            try:
+                value = await loader()
+            except Exception:
+                self.errors += 1
+                raise
+            # 查询期间缓存被作废（如刚好收到群名片修改的通知），结果可能已经过时，不写入
+            if self._loading.get(loading_key) is not future:
+                return value
+            store[key] = _Entry(value, ttl)
+            store.move_to_end(key)
+            if store is self._members:
+                while len(store) > self.MAX_MEMBERS:
+                    store.popitem(last=False)
+            return value
+
+        future = asyncio.ensure_future(load())
+        self._loading[loading_key] = future
+
+        def _done(done: asyncio.Future):
+            if self._loading.get(loading_key) is done:
+                del self._loading[loading_key]
+            # 后台刷新没有人等待结果，取出异常避免 "exception was never retrieved"
+            if not done.cancelled():
+                done.exception()
+
+        future.add_done_callback(_done)
+        return future
+
+    def peek_group(self, group_id: int) -> Optional[dict]:
+        """不发起查询，只看缓存中的群信息（可能已过期），用于同步的名称解析"""
+        entry = self._groups.get(group_id)
+        return entry.value if entry is not None else None
+
+    def peek_member(self, group_id: int, user_id: int) -> Optional[dict]:
+        """不发起查询，只看缓存中的群成员信息（可能已过期），用于同步的名称解析"""
+        entry = self._members.get((group_id, user_id))
+        return entry.value if entry is not None else None
+
+    def invalidate(self, group_id: int, user_id: Optional[int] = None):
+        """作废缓存：给出 user_id 时只作废该成员，否则作废整个群"""
+        self.invalidations += 1
+        if user_id is not None:
+            member_keys = [(group_id, user_id)]
+        else:
+            member_keys = [key for key in self._members if key[0] == group_id]
+            self._groups.pop(group_id, None)
+            self._loading.pop((id(self._groups), group_id), None)
+        for key in member_keys:
+            self._members.pop(key, None)
+            self._loading.pop((id(self._members), key), None)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取缓存的运行指标"""
+        total = self.hits + self.misses
+        return {"群信息/群成员": {
+            "群数": len(self._groups),
+            "成员数": len(self._members),
+            "命中率": f"{self.hits / total:.0%}" if total else "-",
+            "后台刷新": self.refreshes,
+            "查询失败": self.errors,
+            "使用过期数据": self.stale_served,
+            "作废次数": self.invalidations,
+        }}
@@ -0,0 +1,94 @@
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set
+
+import jieba
+
+from ..memory_system.memory import Hippocampus
+from .config import global_config
+from .message import Message
+
+
+class InterestEstimator:
+    """回复兴趣度的分级估计
+
+    兴趣度来自记忆激活（一次主题识别的模型请求）。大部分群聊消息和麦麦的记忆毫无关系，
+    先用本地规则判断是否值得请求模型，不值得时兴趣度直接记为0：
+    - 表情包、过短的消息
+    - 消息里没有任何词出现在记忆主题中
+    被提及（叫了麦麦的名字）的消息总是请求模型，识别出的主题之后生成回复时还会复用
+    """
+
+    # 记忆主题的索引最多多久重建一次（秒），记忆构建、遗忘、合并都会改变主题
+    INDEX_REFRESH_SECONDS = 60
+
+    def __init__(self, hippocampus: Hippocampus):
+        self.hippocampus = hippocampus
+        self._node_names: List[str] = []
+        # 记忆主题分词后的词，只保留两个字以上的
+        self._node_words: Set[str] = set()
+        self._index_time = 0.0
+        self._index_size = -1
+        # 指标
+        self.total = 0
+        self.skipped: Counter = Counter()
+
+    def _refresh_index(self):
+        graph = self.hippocampus.memory_graph.G
+        now = time.monotonic()
+        if graph.number_of_nodes() == self._index_size and now - self._index_time < self.INDEX_REFRESH_SECONDS:
+            return
+        self._node_names = [str(name) for name in graph.nodes() if len(str(name)) >= 2]
+        self._node_words = {
+            word for name in self._node_names for word in jieba.lcut(name) if len(word) >= 2
+        }
+        self._index_size = graph.number_of_nodes()
+        self._index_time = now
+
+    def _matches_memory(self, message: Message) -> bool:
+        """消息中是否有词出现在记忆主题中"""
+        self._refresh_index()
+        text = message.processed_plain_text
+        words = message.analysis.words if message.analysis is not None else jieba.lcut(text)
+        if any(len(word) >= 2 and word in self._node_words for word in words):
+            return True
+        # 分词可能把主题切开，再直接查一遍主题名
+        return any(name in text for name in self._node_names)
+
+    def check(self, message: Message, is_mentioned: bool) -> Optional[str]:
+        """判断是否需要请求模型
+
+        Returns:
+            不需要时返回原因，需要时返回 None
+        """
+        if not global_config.interest_local_tier or is_mentioned:
+            return None
+        if message.is_emoji:
+            return "表情包"
+        text = (message.processed_plain_text or "").strip()
+        if len(text) < global_config.MIN_TEXT_LENGTH:
+            return "消息过短"
+        if not self._matches_memory(message):
+            return "与记忆无关"
+        return None
+
+    async def estimate(self, message: Message, is_mentioned: bool) -> float:
+        """估计对这条消息的兴趣度（0~1）"""
+        self.total += 1
+        reason = self.check(message, is_mentioned)
+        if reason is not None:
+            self.skipped[reason] += 1
+            return 0.0
+        activation = await self.hippocampus.memory_activate_value(message.processed_plain_text, analysis=message.analysis)
+        return activation / 100
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取分级估计的运行指标"""
+        skipped = sum(self.skipped.values())
+        return {"兴趣度估计": {
+            "消息数": self.total,
+            "请求模型": self.total - skipped,
+            "本地判断": skipped,
+            "本地判断占比": f"{skipped / self.total:.0%}" if self.total else "-",
+            **{f"本地判断-{reason}": count for reason, count in self.skipped.items()},
+        }}
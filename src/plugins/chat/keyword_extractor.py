@@ -0,0 +1,164 @@
+import math
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+
+import jieba
+import jieba.analyse
+
+from ..models.timing import Histogram
+
+# 识别主题的方式：llm 请求主题判断模型，tfidf/textrank 用 jieba 在本地提取关键词
+TOPIC_MODES = ("llm", "tfidf", "textrank")
+LOCAL_TOPIC_MODES = ("tfidf", "textrank")
+
+# 与记忆构建时过滤 LLM 主题的关键词相同
+FILTER_KEYWORDS = ["表情包", "图片", "回复", "聊天记录"]
+# 群聊里常见、不能作为主题的词（"表情"来自 [表情包] 的分词）；IDF 表从聊天记录统计后大多权重很低，
+# 但只有这些词的消息仍会把它们当成主题
+STOP_WORDS = {
+    "表情", "什么", "这个", "那个", "我们", "你们", "他们", "就是", "还是", "可以",
+    "没有", "怎么", "一个", "不是", "知道", "觉得", "现在", "真的", "感觉", "然后",
+}
+
+
+class KeywordExtractor:
+    """本地关键词提取，代替主题判断模型识别主题
+
+    - tfidf: 词频乘以 IDF，IDF 从 messages 集合的历史消息中统计，群聊里天天出现的词权重很低；
+      消息数不足 MIN_DOCUMENTS 时使用 jieba 自带的 IDF 表
+    - textrank: jieba 的 TextRank，只看词性和词的共现，不需要 IDF，对很短的消息常常提取不出，这时退回 tfidf
+    都不需要网络请求，一条消息通常在 1 毫秒内完成
+    """
+    _instance: Optional["KeywordExtractor"] = None
+
+    # 统计 IDF 至少需要的消息数
+    MIN_DOCUMENTS = 200
+    # 只出现在这么少条消息中的词不放进 IDF 表，查不到的词按只出现过一次计算
+    MIN_DF = 2
+    # 本地提取耗时的分桶（秒）
+    BUCKETS = [0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, 0.1]
+
+    def __init__(self):
+        # 提前加载词典，否则第一条消息要等一秒左右
+        jieba.initialize()
+        self._idf: Dict[str, float] = {}
+        self._unknown_idf = 0.0
+        self.documents = 0
+        self.learned_at: Optional[float] = None
+        self._textrank = jieba.analyse.TextRank()
+        # 模式 -> 耗时直方图
+        self.timing: Dict[str, Histogram] = {}
+        self.empty: Counter = Counter()
+
+    @classmethod
+    def get_instance(cls) -> "KeywordExtractor":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def _is_keyword(word: str) -> bool:
+        """两个字以上、含文字（排除纯数字和标点）、不是同一个字的重复（哈哈哈）且不是停用词和过滤词"""
+        word = word.strip()
+        return (
+            len(word) >= 2
+            and len(set(word)) > 1
+            and any(ch.isalpha() for ch in word)
+            and word not in STOP_WORDS
+            and word.lower() not in jieba.analyse.default_tfidf.stop_words
+            and not any(keyword in word for keyword in FILTER_KEYWORDS)
+        )
+
+    def learn_idf(self, texts: Iterable[str]) -> int:
+        """从消息文本统计 IDF 表，消息数不足 MIN_DOCUMENTS 时不替换现有的表
+
+        Returns:
+            int: 统计的消息数
+        """
+        df: Counter = Counter()
+        documents = 0
+        for text in texts:
+            words = {word for word in jieba.lcut(text or "") if self._is_keyword(word)}
+            if not words:
+                continue
+            documents += 1
+            df.update(words)
+        if documents < self.MIN_DOCUMENTS:
+            return documents
+        # 平滑的 IDF：log((N+1)/(df+1)) + 1
+        self._idf = {
+            word: math.log((documents + 1) / (count + 1)) + 1
+            for word, count in df.items() if count >= self.MIN_DF
+        }
+        self._unknown_idf = math.log((documents + 1) / 2) + 1
+        self.documents = documents
+        self.learned_at = time.time()
+        return documents
+
+    def learn_idf_from_db(self, db, max_messages: int) -> int:
+        """从数据库最近的 max_messages 条消息统计 IDF 表（同步，会读取数据库）"""
+        cursor = db.db.messages.find(
+            {"processed_plain_text": {"$exists": True}},
+            {"processed_plain_text": 1},
+        ).sort("time", -1).limit(max_messages)
+        return self.learn_idf(record.get("processed_plain_text", "") for record in cursor)
+
+    def idf(self, word: str) -> float:
+        if self._idf:
+            return self._idf.get(word, self._unknown_idf)
+        default = jieba.analyse.default_tfidf
+        return default.idf_freq.get(word, default.median_idf)
+
+    def extract_tfidf(self, text: str, top_k: int = 5, words: Optional[List[str]] = None) -> List[str]:
+        """按 TF-IDF 提取关键词，words 为已有的分词结果"""
+        if words is None:
+            words = jieba.lcut(text)
+        freq = Counter(word.strip() for word in words if self._is_keyword(word))
+        if not freq:
+            return []
+        scores = {word: count * self.idf(word) for word, count in freq.items()}
+        return sorted(scores, key=scores.__getitem__, reverse=True)[:top_k]
+
+    def extract_textrank(self, text: str, top_k: int = 5, words: Optional[List[str]] = None) -> List[str]:
+        """按 TextRank 提取关键词，提取不出时退回 TF-IDF"""
+        keywords = [word for word in self._textrank.textrank(text, topK=top_k * 2) if self._is_keyword(word)]
+        return keywords[:top_k] or self.extract_tfidf(text, top_k, words)
+
+    def extract(self, text: str, top_k: int = 5, mode: str = "tfidf", words: Optional[List[str]] = None) -> List[str]:
+        """提取关键词作为主题
+
+        Args:
+            text: 输入文本
+            top_k: 最多返回的关键词数
+            mode: tfidf 或 textrank
+            words: text 已有的分词结果，只有 tfidf 会用到
+
+        Returns:
+            List[str]: 按权重从高到低排列的关键词
+        """
+        start = time.perf_counter()
+        if mode == "textrank":
+            keywords = self.extract_textrank(text, top_k, words)
+        else:
+            keywords = self.extract_tfidf(text, top_k, words)
+        self.timing.setdefault(mode, Histogram(self.BUCKETS)).observe(time.perf_counter() - start)
+        if not keywords:
+            self.empty[mode] += 1
+        return keywords
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取本地关键词提取的运行指标"""
+        stats: Dict[str, Dict[str, Any]] = {"IDF表": {
+            "来源": f"{self.documents}条消息" if self._idf else "jieba自带",
+            "词数": len(self._idf) if self._idf else len(jieba.analyse.default_tfidf.idf_freq),
+            "更新时间": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.learned_at)) if self.learned_at else "-",
+        }}
+        for mode, histogram in self.timing.items():
+            stats[mode] = {
+                "次数": histogram.count,
+                "未提取到": self.empty[mode],
+                "平均毫秒": f"{histogram.sum / histogram.count * 1000:.3f}",
+                "最大毫秒": f"{histogram.max * 1000:.3f}",
+            }
+        return stats
@@ -1,13 +1,16 @@
-import random
+import asyncio
 import time
-from typing import List, Optional, Tuple, Union
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 
 from nonebot import get_driver
 
 from ...common.database import Database
+from ..models.deadline import DeadlineExceeded
+from ..models.latency import get_latency_tracker
 from ..models.utils_model import LLM_request
 from .config import global_config
 from .message import Message
+from .model_router import ModelRouter
 from .prompt_builder import prompt_builder
 from .relationship_manager import relationship_manager
 from .utils import process_llm_response
@@ -16,30 +19,110 @@ driver = get_driver()
 config = driver.config
 
 
+class _ReplyAttempt:
+    """一次流式回复请求，对冲时同一条消息会同时有两个
+
+    整个回复的耗时按 model_type（路由名）记入"路由{路由名} 回复耗时"，供回复模型路由参考：生成完成记为一次耗时，出错记为失败，
+    因为超过字数上限、输掉对冲或思考超时被提前结束的按已等待的时间记为耗时的下限
+    """
+
+    def __init__(self, model: LLM_request, model_type: str, prompt: str):
+        self.model = model
+        self.model_type = model_type
+        self.stream = model.generate_response_stream(prompt)
+        self.started_at = time.monotonic()
+        self._recorded = False
+        self.iterator = self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        try:
+            async for delta in self.stream:
+                yield delta
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            self._record_reply(error=True)
+            raise
+        self._record_reply()
+
+    def _record_reply(self, error: bool = False, censored: bool = False):
+        if self._recorded:
+            return
+        self._recorded = True
+        tracker = ModelRouter.reply_tracker(self.model_type)
+        elapsed = time.monotonic() - self.started_at
+        if error:
+            tracker.record_error()
+        elif censored:
+            tracker.record_censored(elapsed)
+        else:
+            tracker.record(elapsed)
+
+    def next(self) -> asyncio.Future:
+        """在后台等待下一段内容"""
+        return asyncio.ensure_future(self.iterator.__anext__())
+
+    async def close(self, pending: Optional[asyncio.Future] = None):
+        """结束请求，pending 为还在等待的 next()"""
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        elif pending is not None and not pending.cancelled():
+            # 已经完成但没人读取结果（如和胜出者同时失败），取出异常避免 "exception was never retrieved"
+            pending.exception()
+        # 没有生成完就结束的请求，已等待的时间是回复耗时的下限
+        self._record_reply(censored=True)
+        self.stream.close()
+        await self.iterator.aclose()
+
+    async def abandon(self, pending: asyncio.Future):
+        """因为太慢放弃这次请求：还没有输出时把已等待的时间记为首字延迟的下限，再结束请求"""
+        if self.stream.first_token_latency is None:
+            get_latency_tracker(f"{self.model.model_name} 首字延迟").record_censored(time.monotonic() - self.started_at)
+        await self.close(pending)
+
+
 class ResponseGenerator:
     def __init__(self):
-        self.model_r1 = LLM_request(model=global_config.llm_reasoning, temperature=0.7,max_tokens=1000,stream=True)
-        self.model_v3 = LLM_request(model=global_config.llm_normal, temperature=0.7,max_tokens=1000)
-        self.model_r1_distill = LLM_request(model=global_config.llm_reasoning_minor, temperature=0.7,max_tokens=1000)
-        self.model_v25 = LLM_request(model=global_config.llm_normal_minor, temperature=0.7,max_tokens=1000)
+        self.model_r1 = LLM_request.get_instance(model=global_config.llm_reasoning, temperature=0.7,max_tokens=1000,stream=True)
+        self.model_v3 = LLM_request.get_instance(model=global_config.llm_normal, temperature=0.7,max_tokens=1000)
+        self.model_r1_distill = LLM_request.get_instance(model=global_config.llm_reasoning_minor, temperature=0.7,max_tokens=1000)
+        self.model_v25 = LLM_request.get_instance(model=global_config.llm_normal_minor, temperature=0.7,max_tokens=1000)
+        # 情绪标签只取决于回复内容，单独用一个开启响应缓存的实例，不影响生成回复
+        self.model_emotion = LLM_request.get_instance(model=global_config.llm_normal_minor, temperature=0.7,max_tokens=1000, cache_ttl=global_config.response_cache_ttl)
         self.db = Database.get_instance()
         self.current_model_type = 'r1'  # 默认使用 R1
+        # 按耗时和错误率调整回复模型的比例
+        self.router = ModelRouter({
+            'r1': self.model_r1,
+            'v3': self.model_v3,
+            'r1_distill': self.model_r1_distill,
+        })
+        # 对冲用的备用模型，第一次对冲时创建
+        self.model_hedge: Optional[LLM_request] = None
+        # 对冲指标
+        self.hedge_count = 0
+        self.hedge_wins = 0
 
-    async def generate_response(self, message: Message) -> Optional[Union[str, List[str]]]:
-        """根据当前模型类型选择对应的生成函数"""
+    def _select_model(self) -> LLM_request:
+        """按配置的概率选择回复模型，某个模型变慢或频繁出错时由路由临时调整比例"""
         # 从global_config中获取模型概率值并选择模型
-        rand = random.random()
-        if rand < global_config.MODEL_R1_PROBABILITY:
-            self.current_model_type = 'r1'
-            current_model = self.model_r1
-        elif rand < global_config.MODEL_R1_PROBABILITY + global_config.MODEL_V3_PROBABILITY:
-            self.current_model_type = 'v3'
-            current_model = self.model_v3
-        else:
-            self.current_model_type = 'r1_distill'
-            current_model = self.model_r1_distill
+        self.current_model_type = self.router.choose({
+            'r1': global_config.MODEL_R1_PROBABILITY,
+            'v3': global_config.MODEL_V3_PROBABILITY,
+            'r1_distill': max(0.0, 1 - global_config.MODEL_R1_PROBABILITY - global_config.MODEL_V3_PROBABILITY),
+        })
+        current_model = self.router.routes[self.current_model_type]
 
         print(f"+++++++++++++++++{global_config.BOT_NICKNAME}{self.current_model_type}思考中+++++++++++++++++")
+        return current_model
+
+    async def generate_response(self, message: Message) -> Optional[Union[str, List[str]]]:
+        """根据当前模型类型选择对应的生成函数"""
+        current_model = self._select_model()
         
         model_response = await self._generate_response_with_model(message, current_model)
         raw_content=model_response
@@ -52,8 +135,109 @@ class ResponseGenerator:
                 return model_response ,raw_content
         return None,raw_content
 
-    async def _generate_response_with_model(self, message: Message, model: LLM_request) -> Optional[str]:
-        """使用指定的模型生成回复"""
+    async def generate_response_stream(self, message: Message) -> AsyncIterator[str]:
+        """流式生成回复，逐段产出可见的回复内容（已过滤思维链）
+
+        调用方提前结束时需要调用 aclose()，上游请求会被取消；结束后回复记录照常保存
+        """
+        current_model = self._select_model()
+        sender_name, prompt, prompt_check = await self._build_reply_prompt(message, current_model)
+
+        attempt, delta = await self._start_reply(current_model, prompt)
+        try:
+            if delta is not None:
+                yield delta
+                async for delta in attempt.iterator:
+                    yield delta
+        finally:
+            await attempt.close()
+            print(f'{global_config.BOT_NICKNAME}的回复是：{attempt.stream.content}')
+            self._save_to_db(
+                message=message,
+                sender_name=sender_name,
+                prompt=prompt,
+                prompt_check=prompt_check,
+                content=attempt.stream.content,
+                reasoning_content=attempt.stream.reasoning_content,
+            )
+
+    def _hedge_delay(self, model: LLM_request) -> float:
+        """主模型多久没有输出就发起对冲：取该模型首字延迟的分位数，样本不足时用默认值"""
+        tracker = get_latency_tracker(f"{model.model_name} 首字延迟")
+        if len(tracker) < 10:
+            return global_config.hedge_default_delay
+        return max(global_config.hedge_min_delay, tracker.percentile(global_config.hedge_percentile))
+
+    def _start_hedge(self, prompt: str) -> _ReplyAttempt:
+        """向备用模型发起对冲请求"""
+        if self.model_hedge is None:
+            self.model_hedge = LLM_request.get_instance(
+                model=getattr(global_config, global_config.hedge_model), temperature=0.7, max_tokens=1000
+            )
+        self.hedge_count += 1
+        print(f"\033[1;33m[对冲]\033[0m 主模型没有及时输出，同时请求 {global_config.hedge_model}")
+        return _ReplyAttempt(self.model_hedge, global_config.hedge_model, prompt)
+
+    async def _start_reply(self, model: LLM_request, prompt: str) -> Tuple[_ReplyAttempt, Optional[str]]:
+        """开始流式生成回复，等到第一段可见内容
+        
+        开启对冲时，主模型在对冲延迟内没有输出（或直接失败）就同时请求备用模型，
+        先输出内容的一方胜出，另一方的请求被取消
+
+        Returns:
+            (胜出的请求, 第一段内容)，第一段内容为 None 表示回复为空
+        """
+        primary = _ReplyAttempt(model, self.current_model_type, prompt)
+        pending: Dict[asyncio.Future, _ReplyAttempt] = {primary.next(): primary}
+        hedged = not global_config.hedge_enable
+        delay = None if hedged else self._hedge_delay(model)
+        error = None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    backup = self._start_hedge(prompt)
+                    pending[backup.next()] = backup
+                    continue
+                for future in done:
+                    attempt = pending.pop(future)
+                    try:
+                        delta = future.result()
+                    except StopAsyncIteration:
+                        delta = None
+                    except Exception as e:
+                        error = e
+                        continue
+                    # 胜出，取消其他请求；输掉的请求也计入首字延迟，否则对冲延迟只按跑赢的样本计算，会越来越短
+                    for other_future, other in pending.items():
+                        await other.abandon(other_future)
+                    if attempt is not primary:
+                        self.hedge_wins += 1
+                    if attempt.stream.first_token_latency is not None:
+                        get_latency_tracker(f"{attempt.model.model_name} 首字延迟").record(attempt.stream.first_token_latency)
+                    self.current_model_type = attempt.model_type
+                    return attempt, delta
+                if not pending and not hedged:
+                    # 主模型直接失败，不必等到对冲延迟
+                    hedged = True
+                    backup = self._start_hedge(prompt)
+                    pending[backup.next()] = backup
+            raise error
+        except BaseException:
+            # 调用方取消（如思考超时）时，一并取消还在等待的请求
+            for other_future, other in pending.items():
+                await other.close(other_future)
+            raise
+
+    def get_hedge_stats(self) -> Dict[str, Dict[str, int]]:
+        """获取对冲的运行指标"""
+        return {"回复生成": {"对冲次数": self.hedge_count, "备用模型胜出": self.hedge_wins}}
+
+    async def _build_reply_prompt(self, message: Message, model: LLM_request) -> Tuple[str, str, str]:
+        """构建回复用的prompt，按回复模型的token预算裁剪，返回 (发送者名称, prompt, prompt_check)"""
         sender_name = message.user_nickname or f"用户{message.user_id}"
         if message.user_cardname:
             sender_name=f"[({message.user_id}){message.user_nickname}]{message.user_cardname}"
@@ -69,8 +253,15 @@ class ResponseGenerator:
             message_txt=message.processed_plain_text,
             sender_name=sender_name,
             relationship_value=relationship_value,
-            group_id=message.group_id
+            group_id=message.group_id,
+            max_tokens=model.max_prompt_tokens,
+            analysis=message.analysis
         )
+        return sender_name, prompt, prompt_check
+
+    async def _generate_response_with_model(self, message: Message, model: LLM_request) -> Optional[str]:
+        """使用指定的模型生成回复"""
+        sender_name, prompt, prompt_check = await self._build_reply_prompt(message, model)
 
         # 读空气模块 简化逻辑，先停用
         # if global_config.enable_kuuki_read:
@@ -89,12 +280,22 @@ class ResponseGenerator:
         #         )
         #         return None
 
-        # 生成回复
+        # 生成回复，超过字数上限的回复一定会被丢弃，一旦超过就停止生成，不再等待和消耗token
+        attempt = None
         try:
-            content, reasoning_content = await model.generate_response(prompt)
+            attempt, delta = await self._start_reply(model, prompt)
+            if delta is not None:
+                async for _ in attempt.iterator:
+                    if len(attempt.stream.content) > global_config.max_reply_length:
+                        print(f"回复已超过{global_config.max_reply_length}字，提前停止生成")
+                        break
         except Exception as e:
             print(f"生成回复时出错: {e}")
             return None
+        finally:
+            if attempt is not None:
+                await attempt.close()
+        content, reasoning_content = attempt.stream.content, attempt.stream.reasoning_content
         
         # 保存到数据库
         self._save_to_db(
@@ -137,7 +338,7 @@ class ResponseGenerator:
             内容：{content}
             输出：
             '''
-            content, _ = await self.model_v25.generate_response(prompt)
+            content, _ = await self.model_emotion.generate_response(prompt, request_type="emotion")
             content=content.strip()
             if content in ['happy','angry','sad','surprised','disgusted','fearful','neutral']:
                 return [content]
@@ -161,9 +362,9 @@ class ResponseGenerator:
 class InitiativeMessageGenerate:
     def __init__(self):
         self.db = Database.get_instance()
-        self.model_r1 = LLM_request(model=global_config.llm_reasoning, temperature=0.7)
-        self.model_v3 = LLM_request(model=global_config.llm_normal, temperature=0.7)
-        self.model_r1_distill = LLM_request(
+        self.model_r1 = LLM_request.get_instance(model=global_config.llm_reasoning, temperature=0.7)
+        self.model_v3 = LLM_request.get_instance(model=global_config.llm_normal, temperature=0.7)
+        self.model_r1_distill = LLM_request.get_instance(
             model=global_config.llm_reasoning_minor, temperature=0.7
         )
 
@@ -1,9 +1,11 @@
+import asyncio
 import time
 from dataclasses import dataclass
-from typing import Dict, ForwardRef, List, Optional
+from typing import Any, Dict, ForwardRef, List, Optional
 
 import urllib3
 
+from .config import global_config
 from .cq_code import CQCode, cq_code_tool
 from .utils_cq import parse_cq_code
 from .utils_user import get_groupname, get_user_cardname, get_user_nickname
@@ -41,6 +43,7 @@ class Message:
     message_segments: List[Dict] = None  # 存储解析后的消息片段
     processed_plain_text: str = None  # 用于存储处理后的plain_text
     detailed_plain_text: str = None  # 用于存储详细可读文本
+    analysis: Any = None  # 消息的分析结果（MessageAnalysis），收到消息时创建，生成回复时复用
 
     # 状态标志
     is_emoji: bool = False
@@ -54,8 +57,8 @@ class Message:
 
         # 异步获取补充信息
         self.group_name = self.group_name or get_groupname(self.group_id)
-        self.user_nickname = self.user_nickname or get_user_nickname(self.user_id)
-        self.user_cardname = self.user_cardname or get_user_cardname(self.user_id)
+        self.user_nickname = self.user_nickname or get_user_nickname(self.user_id, self.group_id)
+        self.user_cardname = self.user_cardname or get_user_cardname(self.user_id, self.group_id)
 
         # 消息解析
         if self.raw_message:
@@ -160,9 +163,22 @@ class Message_Thinking:
         self.thinking_start_time = int(time.time())
         self.thinking_time = 0
         self.interupt=False
+
+        # 超过截止时间仍没有回复就放弃，生成回复的任务连同其中的模型请求一起取消
+        self.deadline = time.time() + global_config.thinking_timeout
+        self.reply_task: Optional[asyncio.Future] = None
+        self.cancel_reason: Optional[str] = None
+        # 开始思考后群里收到的新消息数
+        self.newer_messages = 0
     
     def update_thinking_time(self):
         self.thinking_time = round(time.time(), 2) - self.thinking_start_time
+
+    def cancel_reply(self, reason: str):
+        """取消还在生成的回复，reason 会在日志中显示"""
+        self.cancel_reason = reason
+        if self.reply_task is not None and not self.reply_task.done():
+            self.reply_task.cancel()
     
 
 @dataclass
@@ -0,0 +1,73 @@
+import asyncio
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import jieba
+
+from .utils import get_embedding
+
+
+class MessageAnalysis:
+    """一条消息的分析结果：主题、分词、词频向量和 embedding
+
+    记忆激活、记忆检索和知识检索都要分析同一条消息，每项结果在第一次用到时计算，之后直接复用；
+    并发的调用共享同一次计算，计算失败或所有调用方都放弃等待时下次调用重新计算
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self._words: Optional[List[str]] = None
+        # 消息本身的词频向量
+        self._vector: Optional[Counter] = None
+        # 识别方式 -> 主题，记忆激活和记忆检索可能用不同的方式识别主题
+        self._topics: Dict[str, asyncio.Future] = {}
+        # 识别方式 -> 正在等待主题的调用方数
+        self._topic_waiters: Counter = Counter()
+        self._embedding: Optional[asyncio.Future] = None
+
+    @property
+    def words(self) -> List[str]:
+        """消息的 jieba 分词结果"""
+        if self._words is None:
+            self._words = jieba.lcut(self.text)
+        return self._words
+
+    def vector(self, text: str) -> Counter:
+        """文本的词频向量，与 text_to_vector 的结果相同；只缓存消息本身的向量，其他文本每次重新计算"""
+        if text != self.text:
+            return Counter(jieba.lcut(text))
+        if self._vector is None:
+            self._vector = Counter(self.words)
+        return self._vector
+
+    @staticmethod
+    def _reusable(future: Optional[asyncio.Future]) -> bool:
+        return future is not None and not (future.done() and (future.cancelled() or future.exception() is not None))
+
+    async def get_topics(self, identify: Callable[[str], Awaitable[list]], mode: str = "llm") -> list:
+        """消息的主题
+
+        Args:
+            identify: 第一次调用时用来识别主题的函数，如 Hippocampus._identify_topics
+            mode: 识别方式，不同方式的结果分别缓存
+        """
+        future = self._topics.get(mode)
+        if not self._reusable(future):
+            future = asyncio.ensure_future(identify(self.text))
+            self._topics[mode] = future
+        # 某个调用方被取消（如回复超时）时不影响其他调用方，所有调用方都放弃等待时才取消识别
+        self._topic_waiters[mode] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if self._topic_waiters[mode] == 1 and not future.done():
+                future.cancel()
+            raise
+        finally:
+            self._topic_waiters[mode] -= 1
+
+    async def get_embedding(self) -> Optional[list]:
+        """消息的 embedding 向量"""
+        if not self._reusable(self._embedding):
+            self._embedding = asyncio.ensure_future(get_embedding(self.text))
+        return await asyncio.shield(self._embedding)
@@ -89,6 +89,11 @@ class MessageContainer:
                     
         return timeout_messages
         
+    def get_expired_thinking_messages(self) -> List[Message_Thinking]:
+        """获取所有超过截止时间的思考消息"""
+        current_time = time.time()
+        return [msg for msg in self.get_thinking_messages() if current_time > msg.deadline]
+
     def get_earliest_message(self) -> Optional[Union[Message_Thinking, Message_Sending]]:
         """获取thinking_start_time最早的消息对象"""
         if not self.messages:
@@ -111,6 +116,27 @@ class MessageContainer:
         else:
             self.messages.append(message)
             
+    def insert_before(self, message: Message_Sending, anchor: Message_Thinking) -> bool:
+        """把消息插入到 anchor 之前，anchor 不存在时返回False
+        
+        流式回复的句子与思考消息的 thinking_start_time 相同，排在思考消息前面才会先被发送
+        """
+        for index, msg in enumerate(self.messages):
+            if msg is anchor:
+                self.messages.insert(index, message)
+                return True
+        return False
+
+    def get_thinking_messages(self) -> List[Message_Thinking]:
+        """获取所有还在思考的消息"""
+        return [msg for msg in self.messages if isinstance(msg, Message_Thinking)]
+
+    def cancel_thinking(self, message: Message_Thinking, reason: str) -> None:
+        """放弃一条思考消息：取消还在进行的回复生成并立即移除"""
+        print(f"\033[1;33m[警告]\033[0m {reason}，取消回复生成并移除思考消息")
+        message.cancel_reply(reason)
+        self.remove_message(message)
+
     def remove_message(self, message: Union[Message_Thinking, Message_Sending]) -> bool:
         """移除消息，如果消息存在则返回True，否则返回False"""
         try:
@@ -146,13 +172,30 @@ class MessageManager:
         
     def add_message(self, message: Union[Message_Thinking, Message_Sending, MessageSet]) -> None:
         container = self.get_container(message.group_id)
+        # 开始新的回复时，还在思考的旧回复已经过时
+        if isinstance(message, Message_Thinking) and global_config.supersede_on_new_reply:
+            for thinking_message in container.get_thinking_messages():
+                container.cancel_thinking(thinking_message, "同一个群开始了新的回复")
         container.add_message(message)
+
+    def notify_new_message(self, group_id: int) -> None:
+        """群里收到一条新消息，思考期间错过太多消息的回复被放弃，释放模型请求名额"""
+        limit = global_config.supersede_message_count
+        container = self.get_container(group_id)
+        for thinking_message in container.get_thinking_messages():
+            thinking_message.newer_messages += 1
+            if limit and thinking_message.newer_messages >= limit:
+                container.cancel_thinking(thinking_message, f"思考期间群里已有{thinking_message.newer_messages}条新消息")
         
     async def process_group_messages(self, group_id: int):
         """处理群消息"""
         # if int(time.time() / 3) == time.time() / 3:
             # print(f"\033[1;34m[调试]\033[0m 开始处理群{group_id}的消息")
         container = self.get_container(group_id)
+        # 思考超时的消息：取消还在进行的回复生成，不再占用模型请求名额
+        for thinking_message in container.get_expired_thinking_messages():
+            thinking_message.update_thinking_time()
+            container.cancel_thinking(thinking_message, f"消息思考超时({thinking_message.thinking_time}秒)")
         if container.has_messages():
             #最早的对象，可能是思考消息，也可能是发送消息
             message_earliest = container.get_earliest_message() #一个message_thinking or message_sending
@@ -163,11 +206,6 @@ class MessageManager:
                 message_earliest.update_thinking_time()
                 thinking_time = message_earliest.thinking_time
                 print(f"\033[1;34m[调试]\033[0m 消息正在思考中，已思考{int(thinking_time)}秒\033[K\r", end='', flush=True)
-                
-                # 检查是否超时
-                if thinking_time > global_config.thinking_timeout:
-                    print(f"\033[1;33m[警告]\033[0m 消息思考超时({thinking_time}秒)，移除该消息")
-                    container.remove_message(message_earliest)
             else:# 如果不是message_thinking就只能是message_sending    
                 print(f"\033[1;34m[调试]\033[0m 消息'{message_earliest.processed_plain_text}'正在发送中")
                 #直接发，等什么呢
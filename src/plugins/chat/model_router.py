@@ -0,0 +1,119 @@
+import random
+from typing import Any, Dict, Optional
+
+from ..models.latency import get_latency_tracker
+from ..models.utils_model import LLM_request
+from .config import global_config
+
+
+class ModelRouter:
+    """回复模型的自适应路由
+
+    平时按配置的概率选择回复模型；某个模型最近的 p95 耗时超过 SLO 或错误率过高时，
+    把它的大部分流量临时转给其他正常的模型，恢复后回到配置的比例。
+    耗时和错误率来自生成回复时按路由记录的"回复耗时"（不含识图、主题识别等其他请求，含被提前结束的慢请求），
+    多个路由使用同一个模型时分别统计
+    """
+
+    def __init__(self, routes: Dict[str, LLM_request]):
+        """
+        Args:
+            routes: 路由名到模型的映射，如 {"r1": model_r1}
+        """
+        self.routes = routes
+        # 被降权的路由及原因
+        self.degraded: Dict[str, str] = {}
+        self.weights: Dict[str, float] = {}
+        self.base_weights: Dict[str, float] = {}
+
+    @staticmethod
+    def reply_tracker(name: str):
+        """路由的回复耗时记录器，按路由名而不是模型名区分"""
+        return get_latency_tracker(f"路由{name} 回复耗时")
+
+    def _tracker(self, name: str):
+        return self.reply_tracker(name)
+
+    def _check(self, name: str) -> Optional[str]:
+        """检查路由是否应该降权，返回原因；正常时返回 None
+
+        已降权的路由要回到 SLO 的 80% 以内才恢复，避免在阈值附近来回切换
+        """
+        tracker = self._tracker(name)
+        window = global_config.router_window
+        if tracker.count(window) < global_config.router_min_samples:
+            # 样本太少（包括降权后流量变少、旧样本过期）时按正常处理，顺便试探是否已恢复
+            return None
+        slo = global_config.router_p95_slo
+        if name in self.degraded:
+            slo *= 0.8
+        p95 = tracker.percentile(0.95, window)
+        if p95 is not None and p95 > slo:
+            return f"p95耗时 {p95:.1f}秒 超过 {slo:.1f}秒"
+        error_rate = tracker.error_rate(window)
+        if error_rate >= global_config.router_error_rate:
+            return f"错误率 {error_rate:.0%}"
+        return None
+
+    def _update(self, base_weights: Dict[str, float]):
+        """根据最近的耗时和错误率重新计算权重"""
+        self.base_weights = dict(base_weights)
+        for name in self.routes:
+            reason = self._check(name) if global_config.router_enable else None
+            if reason and name not in self.degraded:
+                print(f"\033[1;33m[模型路由]\033[0m {name} {reason}，转移流量到其他模型")
+            elif not reason and name in self.degraded:
+                print(f"\033[1;32m[模型路由]\033[0m {name} 已恢复，回到配置的比例")
+            if reason:
+                self.degraded[name] = reason
+            else:
+                self.degraded.pop(name, None)
+
+        weights = dict(base_weights)
+        healthy = [name for name in weights if name not in self.degraded and weights[name] > 0]
+        if self.degraded and healthy:
+            freed = 0.0
+            for name in self.degraded:
+                shifted = weights[name] * (1 - global_config.router_shift_factor)
+                weights[name] -= shifted
+                freed += shifted
+            healthy_total = sum(base_weights[name] for name in healthy)
+            for name in healthy:
+                weights[name] += freed * base_weights[name] / healthy_total
+        self.weights = weights
+
+    def choose(self, base_weights: Dict[str, float]) -> str:
+        """按调整后的权重选择一个路由
+
+        Args:
+            base_weights: 配置的各路由概率
+
+        Returns:
+            str: 路由名
+        """
+        self._update(base_weights)
+        total = sum(self.weights.values())
+        rand = random.random() * total
+        for name, weight in self.weights.items():
+            if rand < weight:
+                return name
+            rand -= weight
+        return list(self.weights)[-1]
+
+    def get_state(self) -> Dict[str, Dict[str, Any]]:
+        """获取各路由当前的权重、耗时和降权原因"""
+        window = global_config.router_window
+        state = {}
+        for name, model in self.routes.items():
+            tracker = self._tracker(name)
+            p50, p95 = tracker.percentile(0.5, window), tracker.percentile(0.95, window)
+            state[name] = {
+                "模型": model.model_name,
+                "配置权重": f"{self.base_weights.get(name, 0):.2f}",
+                "当前权重": f"{self.weights.get(name, 0):.2f}",
+                "p50": f"{p50:.1f}秒" if p50 is not None else "-",
+                "p95": f"{p95:.1f}秒" if p95 is not None else "-",
+                "错误率": f"{tracker.error_rate(window):.0%}",
+                "原因": self.degraded.get(name, "正常"),
+            }
+        return state
@@ -0,0 +1,164 @@
+from typing import Dict, List, Optional, Tuple
+
+from ..models.token_counter import estimate_tokens
+
+TRUNCATE_MARKER = "……"
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截断文本，使估算token数（含省略号）不超过 max_tokens
+
+    Args:
+        text: 原文本
+        max_tokens: token上限
+
+    Returns:
+        str: 不超过上限时原样返回，否则返回截断后加省略号的文本；放不下任何内容时返回空字符串
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(TRUNCATE_MARKER)
+    if budget <= 0:
+        return ""
+    # 二分查找能放下的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + TRUNCATE_MARKER if low else ""
+
+
+class PromptSection:
+    """prompt 中可以裁剪的一部分，由若干条目组成，预算不足时先丢弃价值最低的条目"""
+
+    def __init__(self, name: str, items: List[Tuple[str, float]], priority: int,
+                 header: str = "", footer: str = "", separator: str = "",
+                 max_share: float = 1.0, truncate: bool = False, contiguous: bool = True):
+        """
+        Args:
+            name: 名称，用于打印裁剪情况
+            items: (文本, 价值) 列表，按在 prompt 中的顺序排列
+            priority: 优先级，越大越先分配预算
+            header: 至少保留一个条目时加在前面的文本
+            footer: 至少保留一个条目时加在后面的文本
+            separator: 条目之间的分隔
+            max_share: 第一轮分配时最多占用总预算的比例，其他部分用不完的预算会在第二轮补给它
+            truncate: 放不下的条目是否截断保留前半部分，否则整条丢弃
+            contiguous: 遇到放不下的条目就停止（如聊天记录不能跳着保留），否则跳过它继续尝试价值更低的条目
+        """
+        self.name = name
+        self.items = items
+        self.priority = priority
+        self.header = header
+        self.footer = footer
+        self.separator = separator
+        self.max_share = max_share
+        self.truncate = truncate
+        self.contiguous = contiguous
+        # 保留的条目下标 -> 文本（可能被截断）
+        self.kept: Dict[int, str] = {}
+        self.tokens = 0
+
+    @property
+    def trimmed(self) -> bool:
+        return len(self.kept) < len(self.items) or any(
+            self.kept[index] != self.items[index][0] for index in self.kept
+        )
+
+    def fill(self, limit: int):
+        """在 limit 个token内按价值从高到低保留条目"""
+        self.kept = {}
+        self.tokens = 0
+        if not self.items:
+            return
+        used = estimate_tokens(self.header) + estimate_tokens(self.footer)
+        separator_tokens = estimate_tokens(self.separator)
+        order = sorted(range(len(self.items)), key=lambda i: self.items[i][1], reverse=True)
+        for index in order:
+            text = self.items[index][0]
+            cost = estimate_tokens(text) + (separator_tokens if self.kept else 0)
+            if used + cost > limit:
+                if self.truncate:
+                    text = truncate_to_tokens(text, limit - used - (cost - estimate_tokens(text)))
+                    if text:
+                        self.kept[index] = text
+                        used = limit
+                    break
+                if self.contiguous:
+                    break
+                continue
+            self.kept[index] = text
+            used += cost
+        if self.kept:
+            self.tokens = used
+
+    def render(self) -> str:
+        if not self.kept:
+            return ""
+        body = self.separator.join(self.kept[index] for index in sorted(self.kept))
+        return f"{self.header}{body}{self.footer}"
+
+
+class PromptBudget:
+    """按token预算组装 prompt
+
+    固定部分（人设、当前消息、输出要求等）先用 reserve() 扣除，剩余预算按优先级分给各个可裁剪部分：
+    第一轮每部分最多用到 max_share 的比例，第二轮把剩下的预算按优先级补给还有条目没放下的部分
+    """
+
+    def __init__(self, max_tokens: int):
+        """
+        Args:
+            max_tokens: 整个 prompt 的估算token上限，0为不限
+        """
+        self.max_tokens = max_tokens
+        self.reserved = 0
+        self.sections: Dict[str, PromptSection] = {}
+
+    def reserve(self, *texts: str):
+        """扣除不可裁剪的固定部分"""
+        self.reserved += sum(estimate_tokens(text) for text in texts)
+
+    def add(self, name: str, items: List[Tuple[str, float]], priority: int, **kwargs) -> PromptSection:
+        """添加一个可裁剪部分，参数见 PromptSection"""
+        section = PromptSection(name, items, priority, **kwargs)
+        self.sections[name] = section
+        return section
+
+    def build(self) -> Dict[str, str]:
+        """分配预算，返回各部分裁剪后的文本"""
+        sections = sorted(self.sections.values(), key=lambda s: s.priority, reverse=True)
+        if self.max_tokens <= 0:
+            for section in sections:
+                section.fill(float("inf"))
+            return {section.name: section.render() for section in sections}
+
+        available = max(0, self.max_tokens - self.reserved)
+        for section in sections:
+            section.fill(min(available, int(self.max_tokens * section.max_share)))
+            available -= section.tokens
+        for section in sections:
+            if available <= 0:
+                break
+            if section.trimmed:
+                before = section.tokens
+                section.fill(before + available)
+                available -= section.tokens - before
+        return {section.name: section.render() for section in sections}
+
+    @property
+    def used_tokens(self) -> int:
+        return self.reserved + sum(section.tokens for section in self.sections.values())
+
+    def summary(self) -> Optional[str]:
+        """有部分被裁剪时返回裁剪情况，否则返回 None"""
+        trimmed = [
+            f"{section.name} {len(section.kept)}/{len(section.items)}条"
+            for section in self.sections.values() if section.trimmed
+        ]
+        if not trimmed:
+            return None
+        return f"预算{self.max_tokens} 固定部分{self.reserved} 共使用{self.used_tokens}，裁剪了: {'，'.join(trimmed)}"
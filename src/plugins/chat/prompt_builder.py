@@ -7,6 +7,8 @@ from ..memory_system.memory import hippocampus, memory_graph
 from ..moods.moods import MoodManager
 from ..schedule.schedule_generator import bot_schedule
 from .config import global_config
+from .message_analysis import MessageAnalysis
+from .prompt_budget import PromptBudget, truncate_to_tokens
 from .utils import get_embedding, get_recent_group_detailed_plain_text
 
 
@@ -22,7 +24,9 @@ class PromptBuilder:
                     message_txt: str, 
                     sender_name: str = "某人",
                     relationship_value: float = 0.0,
-                    group_id: Optional[int] = None) -> tuple[str, str]:
+                    group_id: Optional[int] = None,
+                    max_tokens: Optional[int] = None,
+                    analysis: Optional[MessageAnalysis] = None) -> tuple[str, str]:
         """构建prompt
         
         Args:
@@ -30,6 +34,8 @@ class PromptBuilder:
             sender_name: 发送者昵称
             relationship_value: 关系值
             group_id: 群组ID
+            max_tokens: prompt的估算token上限，不填时使用配置的 prompt_max_tokens
+            analysis: 消息的分析结果，复用记忆激活时已经识别的主题和 embedding
             
         Returns:
             str: 构建好的prompt
@@ -57,31 +63,26 @@ class PromptBuilder:
         current_date = time.strftime("%Y-%m-%d", time.localtime())
         current_time = time.strftime("%H:%M:%S", time.localtime())
         bot_schedule_now_time,bot_schedule_now_activity = bot_schedule.get_current_task()
-        prompt_date = f'''今天是{current_date}，现在是{current_time}，你今天的日程是：\n{bot_schedule.today_schedule}\n你现在正在{bot_schedule_now_activity}\n'''
 
         #知识构建
         start_time = time.time()
         
-        prompt_info = ''
         promt_info_prompt = ''
-        prompt_info = await self.get_prompt_info(message_txt,threshold=0.5)
-        if prompt_info:
-            prompt_info = f'''\n----------------------------------------------------\n你有以下这些[知识]：\n{prompt_info}\n请你记住上面的[知识]，之后可能会用到\n----------------------------------------------------\n'''
+        knowledge = await self.get_prompt_info(message_txt,threshold=0.5,analysis=analysis)
             
         end_time = time.time()
         print(f"\033[1;32m[知识检索]\033[0m 耗时: {(end_time - start_time):.3f}秒")
             
-        # 获取聊天上下文
-        chat_talking_prompt = ''
+        # 获取聊天上下文，过长的单条消息（如图片描述）先截断
+        chat_lines = []
         if group_id:
-            chat_talking_prompt = get_recent_group_detailed_plain_text(self.db, group_id, limit=global_config.MAX_CONTEXT_SIZE,combine = True)
-        
-        chat_talking_prompt = f"以下是群里正在聊天的内容：\n{chat_talking_prompt}"
+            chat_lines = [str(line) for line in get_recent_group_detailed_plain_text(self.db, group_id, limit=global_config.MAX_CONTEXT_SIZE)]
+        if global_config.prompt_max_line_tokens:
+            chat_lines = [truncate_to_tokens(line.rstrip("\n"), global_config.prompt_max_line_tokens) + "\n" for line in chat_lines]
         
         
         
         # 使用新的记忆获取方法
-        memory_prompt = ''
         start_time = time.time()
         
         # 调用 hippocampus 的 get_relevant_memories 方法
@@ -89,17 +90,11 @@ class PromptBuilder:
             text=message_txt,
             max_topics=5,
             similarity_threshold=0.4,
-            max_memory_num=5
+            max_memory_num=5,
+            analysis=analysis
         )
         
         if relevant_memories:
-            # 格式化记忆内容
-            memory_items = []
-            for memory in relevant_memories:
-                memory_items.append(f"关于「{memory['topic']}」的记忆：{memory['content']}")
-            
-            memory_prompt = "看到这些聊天，你想起来：\n" + "\n".join(memory_items) + "\n"
-            
             # 打印调试信息
             print("\n\033[1;32m[记忆检索]\033[0m 找到以下相关记忆：")
             for memory in relevant_memories:
@@ -108,12 +103,6 @@ class PromptBuilder:
         end_time = time.time()
         print(f"\033[1;32m[回忆耗时]\033[0m 耗时: {(end_time - start_time):.3f}秒")
         
-        
-            
-        #激活prompt构建
-        activate_prompt = ''
-        activate_prompt = f"以上是群里正在进行的聊天，{memory_prompt} 现在昵称为 '{sender_name}' 的用户说的:{message_txt}。引起了你的注意,你和他{relation_prompt},{mood_prompt},你想要{relation_prompt_2}。"          
-        
         #检测机器人相关词汇，改为关键词检测与反应功能了，提取到全局配置中
         # bot_keywords = ['人机', 'bot', '机器', '入机', 'robot', '机器人']
         # is_bot = any(keyword in message_txt.lower() for keyword in bot_keywords)
@@ -139,15 +128,15 @@ class PromptBuilder:
         prompt_personality = ''
         personality_choice = random.random()
         if personality_choice < probability_1:  # 第一种人格
-            prompt_personality = f'''{activate_prompt}你的网名叫{global_config.BOT_NICKNAME}，{personality[0]}, 你正在浏览qq群,{promt_info_prompt},
+            prompt_personality = f'''你的网名叫{global_config.BOT_NICKNAME}，{personality[0]}, 你正在浏览qq群,{promt_info_prompt},
             现在请你给出日常且口语化的回复，平淡一些，尽量简短一些。{keywords_reaction_prompt}
             请注意把握群里的聊天内容，不要刻意突出自身学科背景，不要回复的太有条理，可以有个性。'''
         elif personality_choice < probability_1 + probability_2:  # 第二种人格
-            prompt_personality = f'''{activate_prompt}你的网名叫{global_config.BOT_NICKNAME}，{personality[1]}, 你正在浏览qq群，{promt_info_prompt},
+            prompt_personality = f'''你的网名叫{global_config.BOT_NICKNAME}，{personality[1]}, 你正在浏览qq群，{promt_info_prompt},
             现在请你给出日常且口语化的回复，请表现你自己的见解，不要一昧迎合，尽量简短一些。{keywords_reaction_prompt}
             请你表达自己的见解和观点。可以有个性。'''
         else:  # 第三种人格
-            prompt_personality = f'''{activate_prompt}你的网名叫{global_config.BOT_NICKNAME}，{personality[2]}, 你正在浏览qq群，{promt_info_prompt},
+            prompt_personality = f'''你的网名叫{global_config.BOT_NICKNAME}，{personality[2]}, 你正在浏览qq群，{promt_info_prompt},
             现在请你给出日常且口语化的回复，请表现你自己的见解，不要一昧迎合，尽量简短一些。{keywords_reaction_prompt}
             请你表达自己的见解和观点。可以有个性。'''
         
@@ -162,6 +151,40 @@ class PromptBuilder:
         
         #额外信息要求
         extra_info = '''但是记得回复平淡一些，简短一些，尤其注意在没明确提到时不要过多提及自身的背景, 不要直接回复别人发的表情包，记住不要输出多余内容(包括前后缀，冒号和引号，括号，表情等)，只需要输出回复内容就好，不要输出其他任何内容''' 
+
+        #按token预算裁剪知识、日程、聊天记录和记忆：聊天记录先丢最早的，记忆先丢相似度最低的
+        def build_activate_prompt(memory_prompt: str) -> str:
+            return f"以上是群里正在进行的聊天，{memory_prompt} 现在昵称为 '{sender_name}' 的用户说的:{message_txt}。引起了你的注意,你和他{relation_prompt},{mood_prompt},你想要{relation_prompt_2}。"
+
+        chat_header = "以下是群里正在聊天的内容：\n"
+        date_header = f'''今天是{current_date}，现在是{current_time}，你今天的日程是：\n'''
+        date_footer = f'''\n你现在正在{bot_schedule_now_activity}\n'''
+        budget = PromptBudget(max_tokens if max_tokens is not None else global_config.prompt_max_tokens)
+        budget.reserve(build_activate_prompt(""), prompt_personality, prompt_ger, extra_info, chat_header, date_header, date_footer)
+        budget.add("聊天记录", [(line, index) for index, line in enumerate(chat_lines)], priority=4, max_share=0.6)
+        budget.add(
+            "记忆",
+            [(f"关于「{memory['topic']}」的记忆：{memory['content']}", memory['similarity']) for memory in relevant_memories or []],
+            priority=3, header="看到这些聊天，你想起来：\n", footer="\n", separator="\n", max_share=0.2, contiguous=False,
+        )
+        budget.add(
+            "知识", [(knowledge, 1)] if knowledge else [], priority=2, truncate=True, max_share=0.2,
+            header="\n----------------------------------------------------\n你有以下这些[知识]：\n",
+            footer="\n请你记住上面的[知识]，之后可能会用到\n----------------------------------------------------\n",
+        )
+        budget.add("日程", [(str(bot_schedule.today_schedule), 1)], priority=1, truncate=True, max_share=0.15)
+        sections = budget.build()
+        summary = budget.summary()
+        if summary:
+            print(f"\033[1;33m[prompt预算]\033[0m {summary}")
+
+        prompt_info = sections["知识"]
+        prompt_date = f"{date_header}{sections['日程']}{date_footer}"
+        chat_talking_prompt = f"{chat_header}{sections['聊天记录']}"
+        
+        #激活prompt构建
+        activate_prompt = build_activate_prompt(sections["记忆"])
+        prompt_personality = f"{activate_prompt}{prompt_personality}"
         
         #合并prompt
         prompt = ""
@@ -239,10 +262,13 @@ class PromptBuilder:
         return prompt_for_initiative
         
 
-    async def get_prompt_info(self,message:str,threshold:float):
+    async def get_prompt_info(self,message:str,threshold:float,analysis:Optional[MessageAnalysis]=None):
         related_info = ''
         print(f"\033[1;34m[调试]\033[0m 获取知识库内容，元消息：{message[:30]}...，消息长度: {len(message)}")
-        embedding = await get_embedding(message)
+        if analysis is not None and analysis.text == message:
+            embedding = await analysis.get_embedding()
+        else:
+            embedding = await get_embedding(message)
         related_info += self.get_info_from_db(embedding,threshold=threshold)
             
         return related_info
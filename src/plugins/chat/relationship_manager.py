@@ -147,7 +147,9 @@ class RelationshipManager:
         saved = relationship.saved
         
         db = Database.get_instance()
-        db.db.relationships.update_one(
+        # 同步的数据库写入放到线程池，不阻塞事件循环
+        await asyncio.to_thread(
+            db.db.relationships.update_one,
             {'user_id': user_id},
             {'$set': {
                 'nickname': nickname,
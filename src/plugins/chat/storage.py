@@ -1,3 +1,4 @@
+import asyncio
 from typing import Optional
 
 from ...common.database import Database
@@ -42,7 +43,8 @@ class MessageStorage:
                     "detailed_plain_text": message.detailed_plain_text,
                 }
                 
-            self.db.db.messages.insert_one(message_data)
+            # 同步的数据库写入放到线程池，不阻塞事件循环
+            await asyncio.to_thread(self.db.db.messages.insert_one, message_data)
         except Exception as e:
             print(f"\033[1;31m[错误]\033[0m 存储消息失败: {e}") 
 
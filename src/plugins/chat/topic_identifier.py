@@ -4,13 +4,14 @@ from nonebot import get_driver
 
 from ..models.utils_model import LLM_request
 from .config import global_config
+from .keyword_extractor import LOCAL_TOPIC_MODES, KeywordExtractor
 
 driver = get_driver()
 config = driver.config  
 
 class TopicIdentifier:
     def __init__(self):
-        self.llm_topic_judge = LLM_request(model=global_config.llm_topic_judge)
+        self.llm_topic_judge = LLM_request.get_instance(model=global_config.llm_topic_judge, cache_ttl=global_config.response_cache_ttl)
 
     async def identify_topic_llm(self, text: str) -> Optional[List[str]]:
         """识别消息主题，返回主题列表"""
@@ -22,7 +23,7 @@ class TopicIdentifier:
 消息内容：{text}"""
 
         # 使用 LLM_request 类进行请求
-        topic, _ = await self.llm_topic_judge.generate_response(prompt)
+        topic, _ = await self.llm_topic_judge.generate_response(prompt, request_type="topic")
         
         if not topic:
             print("\033[1;31m[错误]\033[0m LLM API 返回为空")
@@ -38,4 +39,16 @@ class TopicIdentifier:
         print(f"\033[1;32m[主题识别]\033[0m 主题: {topic_list}")
         return topic_list if topic_list else None
 
+    def identify_topic_local(self, text: str, mode: str = "tfidf") -> Optional[List[str]]:
+        """用 jieba 在本地提取关键词作为主题，不请求模型"""
+        topic_list = KeywordExtractor.get_instance().extract(text, 5, mode)
+        print(f"\033[1;32m[主题识别]\033[0m 本地({mode})主题: {topic_list}")
+        return topic_list if topic_list else None
+
+    async def identify_topic(self, text: str, mode: str = "llm") -> Optional[List[str]]:
+        """按 mode（llm/tfidf/textrank）识别消息主题"""
+        if mode in LOCAL_TOPIC_MODES:
+            return self.identify_topic_local(text, mode)
+        return await self.identify_topic_llm(text)
+
 topic_identifier = TopicIdentifier()
\ No newline at end of file
@@ -2,10 +2,11 @@ import math
 import random
 import time
 from collections import Counter
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import jieba
 import numpy as np
+from loguru import logger
 from nonebot import get_driver
 
 from ..models.utils_model import LLM_request
@@ -72,11 +73,17 @@ def is_mentioned_bot_in_txt(message: str) -> bool:
 
 async def get_embedding(text):
     """获取文本的embedding向量"""
-    llm = LLM_request(model=global_config.embedding)
+    llm = LLM_request.get_instance(model=global_config.embedding)
     # return llm.get_embedding_sync(text)
     return await llm.get_embedding(text)
 
 
+async def get_embeddings(texts):
+    """批量获取文本的embedding向量，结果顺序与输入一致"""
+    llm = LLM_request.get_instance(model=global_config.embedding)
+    return await llm.get_embeddings(texts)
+
+
 def cosine_similarity(v1, v2):
     dot_product = np.dot(v1, v2)
     norm1 = np.linalg.norm(v1)
@@ -325,33 +332,104 @@ def random_remove_punctuation(text: str) -> str:
 
 
 
-def process_llm_response(text: str) -> List[str]:
-    # processed_response = process_text_with_typos(content)
-    if len(text) > 200:
-        print(f"回复过长 ({len(text)} 字符)，返回默认回复")
-        return ['懒得说']
-    # 处理长消息
-    typo_generator = ChineseTypoGenerator(
-        error_rate=global_config.chinese_typo_error_rate,
-        min_freq=global_config.chinese_typo_min_freq,
-        tone_error_rate=global_config.chinese_typo_tone_error_rate,
-        word_replace_rate=global_config.chinese_typo_word_replace_rate
-    )
+_typo_generator: Optional[ChineseTypoGenerator] = None
+
+
+def get_typo_generator() -> ChineseTypoGenerator:
+    """错别字生成器，初始化要遍历所有汉字的拼音并读取字频文件，只在第一次用到时创建一次"""
+    global _typo_generator
+    if _typo_generator is None:
+        _typo_generator = ChineseTypoGenerator(
+            error_rate=global_config.chinese_typo_error_rate,
+            min_freq=global_config.chinese_typo_min_freq,
+            tone_error_rate=global_config.chinese_typo_tone_error_rate,
+            word_replace_rate=global_config.chinese_typo_word_replace_rate
+        )
+    return _typo_generator
+
+
+def _split_and_add_typos(text: str) -> List[str]:
+    """把一段回复拆成要发送的句子，并按配置加入错别字"""
     split_sentences = split_into_sentences_w_remove_punctuation(text)
     sentences = []
     for sentence in split_sentences:
+        if not sentence:
+            continue
         if global_config.chinese_typo_enable:
-            typoed_text, typo_corrections = typo_generator.create_typo_sentence(sentence)
+            typoed_text, typo_corrections = get_typo_generator().create_typo_sentence(sentence)
             sentences.append(typoed_text)
             if typo_corrections:
                 sentences.append(typo_corrections)
         else:
             sentences.append(sentence)
-    # 检查分割后的消息数量是否过多（超过3条）
-    
-    if len(sentences) > 5:
-        print(f"分割后消息数量过多 ({len(sentences)} 条)，返回默认回复")
-        return [f'{global_config.BOT_NICKNAME}不知道哦']
+    return sentences
+
+
+class StreamSentenceSplitter:
+    """流式回复的增量分句
+
+    模型每输出一个分片就调用 feed，凑齐以句末标点结尾的一段后，
+    按与 process_llm_response 相同的规则拆成要发送的句子
+    """
+
+    SENTENCE_ENDINGS = "。！？!?…~～\n"
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """输入一个分片，返回已经完整的句子"""
+        self._buffer += text
+        segments = []
+        while True:
+            index = next((i for i, char in enumerate(self._buffer) if char in self.SENTENCE_ENDINGS), -1)
+            if index < 0:
+                break
+            end = index + 1
+            # 连续的标点（如"！！"、"……"）属于同一句
+            while end < len(self._buffer) and self._buffer[end] in self.SENTENCE_ENDINGS:
+                end += 1
+            # 标点在末尾时可能还有后续的标点，等下一个分片再切
+            if end == len(self._buffer):
+                break
+            segment, self._buffer = self._buffer[:end], self._buffer[end:]
+            if segment.strip():
+                segments.append(segment.strip())
+        return [sentence for segment in segments for sentence in _split_and_add_typos(segment)]
+
+    def flush(self) -> List[str]:
+        """输出结束时调用，返回剩余的句子"""
+        rest, self._buffer = self._buffer.strip(), ""
+        return _split_and_add_typos(rest) if rest else []
+
+
+def reply_over_limit(text: str, sentence_count: int) -> Optional[str]:
+    """回复超过字数或句数上限时返回代替它发送的默认回复，否则返回 None，流式和非流式回复共用
+
+    Args:
+        text: 原始回复（流式时为目前生成的部分）
+        sentence_count: 分句后的句数
+    """
+    if len(text) > global_config.max_reply_length:
+        logger.info(f"回复过长 ({len(text)} 字符)，返回默认回复")
+        return '懒得说'
+    if sentence_count > global_config.max_reply_sentences:
+        logger.info(f"分割后消息数量过多 ({sentence_count} 条)，返回默认回复")
+        return f'{global_config.BOT_NICKNAME}不知道哦'
+    return None
+
+
+def process_llm_response(text: str) -> List[str]:
+    # processed_response = process_text_with_typos(content)
+    fallback = reply_over_limit(text, 0)
+    if fallback:
+        return [fallback]
+    # 处理长消息
+    sentences = _split_and_add_typos(text)
+    # 检查分割后的消息数量是否过多
+    fallback = reply_over_limit(text, len(sentences))
+    if fallback:
+        return [fallback]
 
     return sentences
 
@@ -1,18 +1,33 @@
+from typing import Optional
+
 from .config import global_config
+from .group_info_cache import GroupInfoCache
 from .relationship_manager import relationship_manager
 
 
-def get_user_nickname(user_id: int) -> str:
+def get_user_nickname(user_id: int, group_id: Optional[int] = None) -> str:
     if int(user_id) == int(global_config.BOT_QQ):
         return global_config.BOT_NICKNAME
 #     print(user_id)
+    # 还没有关系记录的用户，用缓存的群成员信息中的昵称
+    if int(user_id) not in relationship_manager.relationships and group_id is not None:
+        member_info = GroupInfoCache.get_instance().peek_member(group_id, int(user_id))
+        if member_info and member_info.get('nickname'):
+            return member_info['nickname']
     return relationship_manager.get_name(user_id)
 
-def get_user_cardname(user_id: int) -> str:
+def get_user_cardname(user_id: int, group_id: Optional[int] = None) -> str:
     if int(user_id) == int(global_config.BOT_QQ):
         return global_config.BOT_NICKNAME
 #     print(user_id)
+    if group_id is not None:
+        member_info = GroupInfoCache.get_instance().peek_member(group_id, int(user_id))
+        if member_info:
+            return member_info.get('card') or ''
     return ''
 
 def get_groupname(group_id: int) -> str:
+    group_info = GroupInfoCache.get_instance().peek_group(group_id)
+    if group_info and group_info.get('group_name'):
+        return group_info['group_name']
     return f"群{group_id}"
\ No newline at end of file
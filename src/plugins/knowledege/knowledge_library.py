@@ -15,7 +15,10 @@ if not os.path.exists(env_path):
     raise FileNotFoundError(f"配置文件不存在: {env_path}")
 load_dotenv(env_path)
 
+from pymongo import UpdateOne
+
 from src.common.database import Database
+from src.plugins.models.token_counter import split_batches
 
 # 从环境变量获取配置
 Database.initialize(
@@ -59,6 +62,28 @@ class KnowledgeLibrary:
             return None
             
         return response.json()['data'][0]['embedding']
+
+    def get_embeddings(self, texts: list, batch_size: int = 32, max_tokens: int = 8000) -> list:
+        """批量获取文本的embedding向量，按条数和token数分批请求，结果顺序与输入一致，失败的批次为None"""
+        url = "https://api.siliconflow.cn/v1/embeddings"
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        results = [None] * len(texts)
+        for batch in split_batches(texts, batch_size, max_tokens):
+            payload = {
+                "model": "BAAI/bge-m3",
+                "input": [texts[i] for i in batch],
+                "encoding_format": "float"
+            }
+            response = requests.post(url, json=payload, headers=headers)
+            if response.status_code != 200:
+                print(f"批量获取embedding失败: {response.text}")
+                continue
+            for position, item in enumerate(response.json()['data']):
+                results[batch[item.get('index', position)]] = item['embedding']
+        return results
         
     def process_files(self):
         """处理raw_info目录下的所有txt文件"""
@@ -81,13 +106,14 @@ class KnowledgeLibrary:
             # 按1024字符分段
             segments = [content[i:i+600] for i in range(0, len(content), 600)]
             
-            # 处理每个分段
-            for segment in segments:
-                if not segment.strip():  # 跳过空段
-                    continue
-                    
-                # 获取embedding
-                embedding = self.get_embedding(segment)
+            # 跳过空段
+            segments = [segment for segment in segments if segment.strip()]
+            
+            # 批量获取embedding
+            embeddings = self.get_embeddings(segments)
+            
+            operations = []
+            for segment, embedding in zip(segments, embeddings):
                 if not embedding:
                     continue
                     
@@ -103,11 +129,13 @@ class KnowledgeLibrary:
                 content_hash = hash(segment)
                 
                 # 更新或插入文档
-                self.db.db.knowledges.update_one(
+                operations.append(UpdateOne(
                     {"content_hash": content_hash},
                     {"$set": doc},
                     upsert=True
-                )
+                ))
+            if operations:
+                self.db.db.knowledges.bulk_write(operations, ordered=False)
                 
             # 记录文件已处理
             self.db.db.processed_files.insert_one({
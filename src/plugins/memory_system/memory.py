@@ -3,6 +3,7 @@ import datetime
 import math
 import random
 import time
+from typing import Optional
 
 import jieba
 import networkx as nx
@@ -15,6 +16,8 @@ from ..chat.utils import (
     get_cloest_chat_from_db,
     text_to_vector,
 )
+from ..chat.keyword_extractor import LOCAL_TOPIC_MODES, KeywordExtractor
+from ..chat.message_analysis import MessageAnalysis
 from ..models.utils_model import LLM_request
 
 
@@ -133,8 +136,9 @@ class Memory_graph:
 class Hippocampus:
     def __init__(self,memory_graph:Memory_graph):
         self.memory_graph = memory_graph
-        self.llm_topic_judge = LLM_request(model = global_config.llm_topic_judge,temperature=0.5)
-        self.llm_summary_by_topic = LLM_request(model = global_config.llm_summary_by_topic,temperature=0.5)
+        self.llm_topic_judge = LLM_request.get_instance(model = global_config.llm_topic_judge,temperature=0.5,cache_ttl=global_config.response_cache_ttl)
+        self.llm_summary_by_topic = LLM_request.get_instance(model = global_config.llm_summary_by_topic,temperature=0.5)
+        self.keyword_extractor = KeywordExtractor.get_instance()
         
     def get_all_node_names(self) -> list:
         """获取记忆图中所有节点的名字列表
@@ -175,19 +179,25 @@ class Hippocampus:
             chat_text.append(chat_)
         return [text for text in chat_text if text]
     
-    async def memory_compress(self, input_text, compress_rate=0.1):
+    async def memory_compress(self, input_text, compress_rate=0.1, topic_mode: Optional[str] = None):
         print(input_text)
         
         #获取topics
         topic_num = self.calculate_topic_num(input_text, compress_rate)
-        topics_response = await self.llm_topic_judge.generate_response(self.find_topic_llm(input_text, topic_num))
-        # 修改话题处理逻辑
-        # 定义需要过滤的关键词
-        filter_keywords = ['表情包', '图片', '回复', '聊天记录']
-        
-        # 过滤topics
-        topics = [topic.strip() for topic in topics_response[0].replace("，", ",").replace("、", ",").replace(" ", ",").split(",") if topic.strip()]
-        filtered_topics = [topic for topic in topics if not any(keyword in topic for keyword in filter_keywords)]
+        topic_mode = topic_mode or global_config.topic_extract_build
+        if topic_mode in LOCAL_TOPIC_MODES:
+            # 本地提取的关键词已经排除了过滤词
+            filtered_topics = self.keyword_extractor.extract(input_text, max(1, topic_num), topic_mode)
+        else:
+            topics_response = await self.llm_topic_judge.generate_response(
+                self.find_topic_llm(input_text, topic_num), request_type="topic")
+            # 修改话题处理逻辑
+            # 定义需要过滤的关键词
+            filter_keywords = ['表情包', '图片', '回复', '聊天记录']
+            
+            # 过滤topics
+            topics = [topic.strip() for topic in topics_response[0].replace("，", ",").replace("、", ",").replace(" ", ",").split(",") if topic.strip()]
+            filtered_topics = [topic for topic in topics if not any(keyword in topic for keyword in filter_keywords)]
         
         # print(f"原始话题: {topics}")
         print(f"过滤后话题: {filtered_topics}")
@@ -197,7 +207,7 @@ class Hippocampus:
         for topic in filtered_topics:
             topic_what_prompt = self.topic_what(input_text, topic)
             # 创建异步任务
-            task = self.llm_summary_by_topic.generate_response_async(topic_what_prompt)
+            task = self.llm_summary_by_topic.generate_response_async(topic_what_prompt, request_type="memory")
             tasks.append((topic.strip(), task))
             
         # 等待所有任务完成
@@ -498,34 +508,49 @@ class Hippocampus:
         prompt = f'这是一段文字：{text}。我想让你基于这段文字来概括"{topic}"这个概念，帮我总结成一句自然的话，可以包含时间和人物，以及具体的观点。只输出这句话就好'
         return prompt
 
-    async def _identify_topics(self, text: str) -> list:
+    async def _identify_topics(self, text: str, mode: str = "llm", words: Optional[list] = None) -> list:
         """从文本中识别可能的主题
         
         Args:
             text: 输入文本
+            mode: 识别方式，llm 请求主题判断模型，tfidf/textrank 在本地提取关键词
+            words: text 已有的分词结果，本地提取时复用
             
         Returns:
             list: 识别出的主题列表
         """
-        topics_response = await self.llm_topic_judge.generate_response(self.find_topic_llm(text, 5))
+        if mode in LOCAL_TOPIC_MODES:
+            return self.keyword_extractor.extract(text, 5, mode, words)
+        topics_response = await self.llm_topic_judge.generate_response(self.find_topic_llm(text, 5), request_type="topic")
         # print(f"话题: {topics_response[0]}")
         topics = [topic.strip() for topic in topics_response[0].replace("，", ",").replace("、", ",").replace(" ", ",").split(",") if topic.strip()]
         # print(f"话题: {topics}")
                     
         return topics
-        
-    def _find_similar_topics(self, topics: list, similarity_threshold: float = 0.4, debug_info: str = "") -> list:
+
+    async def _get_topics(self, text: str, analysis: Optional[MessageAnalysis] = None, mode: str = "llm") -> list:
+        """识别主题，给出同一文本的分析结果时复用其中用同一方式识别过的主题"""
+        if analysis is not None and analysis.text == text:
+            return await analysis.get_topics(lambda t: self._identify_topics(t, mode, analysis.words), mode)
+        return await self._identify_topics(text, mode)
+        
+    def _find_similar_topics(self, topics: list, similarity_threshold: float = 0.4, debug_info: str = "",
+                             analysis: Optional[MessageAnalysis] = None) -> list:
         """查找与给定主题相似的记忆主题
         
         Args:
             topics: 主题列表
             similarity_threshold: 相似度阈值
             debug_info: 调试信息前缀
+            analysis: 消息的分析结果，给出时复用其中缓存的词频向量
             
         Returns:
             list: (主题, 相似度) 元组列表
         """
+        vectorize = analysis.vector if analysis is not None else text_to_vector
         all_memory_topics = self.get_all_node_names()
+        # 记忆主题的向量在本次调用内只计算一次，不随每个识别出的主题重复分词
+        memory_vectors = [(memory_topic, text_to_vector(memory_topic)) for memory_topic in all_memory_topics]
         all_similar_topics = []
         
         # 计算每个识别出的主题与记忆主题的相似度
@@ -534,11 +559,10 @@ class Hippocampus:
                 # print(f"\033[1;32m[{debug_info}]\033[0m 正在思考有没有见过: {topic}")
                 pass
                 
-            topic_vector = text_to_vector(topic)
+            topic_vector = vectorize(topic)
             has_similar_topic = False
             
-            for memory_topic in all_memory_topics:
-                memory_vector = text_to_vector(memory_topic)
+            for memory_topic, memory_vector in memory_vectors:
                 # 获取所有唯一词
                 all_words = set(topic_vector.keys()) | set(memory_vector.keys())
                 # 构建向量
@@ -580,12 +604,13 @@ class Hippocampus:
                 
         return top_topics
 
-    async def memory_activate_value(self, text: str, max_topics: int = 5, similarity_threshold: float = 0.3) -> int:
-        """计算输入文本对记忆的激活程度"""
-        print(f"\033[1;32m[记忆激活]\033[0m 识别主题: {await self._identify_topics(text)}")
-        
+    async def memory_activate_value(self, text: str, max_topics: int = 5, similarity_threshold: float = 0.3,
+                                    analysis: Optional[MessageAnalysis] = None, topic_mode: Optional[str] = None) -> int:
+        """计算输入文本对记忆的激活程度，analysis 为同一文本的分析结果，识别出的主题会留给之后的记忆检索复用；
+        topic_mode 为识别主题的方式，默认使用配置的 topic_extract_activate"""
         # 识别主题
-        identified_topics = await self._identify_topics(text)
+        identified_topics = await self._get_topics(text, analysis, topic_mode or global_config.topic_extract_activate)
+        print(f"\033[1;32m[记忆激活]\033[0m 识别主题: {identified_topics}")
         if not identified_topics:
             return 0
             
@@ -593,7 +618,8 @@ class Hippocampus:
         all_similar_topics = self._find_similar_topics(
             identified_topics, 
             similarity_threshold=similarity_threshold,
-            debug_info="记忆激活"
+            debug_info="记忆激活",
+            analysis=analysis
         )
         
         if not all_similar_topics:
@@ -619,6 +645,8 @@ class Hippocampus:
         # 计算关键词匹配率，同时考虑内容数量
         matched_topics = set()
         topic_similarities = {}
+        vectorize = analysis.vector if analysis is not None else text_to_vector
+        topic_vectors = {input_topic: vectorize(input_topic) for input_topic in identified_topics}
         
         for memory_topic, similarity in top_topics:
             # 计算内容数量惩罚
@@ -629,9 +657,9 @@ class Hippocampus:
             penalty = 1.0 / (1 + math.log(content_count + 1))
             
             # 对每个记忆主题，检查它与哪些输入主题相似
+            memory_vector = text_to_vector(memory_topic)
             for input_topic in identified_topics:
-                topic_vector = text_to_vector(input_topic)
-                memory_vector = text_to_vector(memory_topic)
+                topic_vector = topic_vectors[input_topic]
                 all_words = set(topic_vector.keys()) | set(memory_vector.keys())
                 v1 = [topic_vector.get(word, 0) for word in all_words]
                 v2 = [memory_vector.get(word, 0) for word in all_words]
@@ -652,16 +680,18 @@ class Hippocampus:
         
         return activation
 
-    async def get_relevant_memories(self, text: str, max_topics: int = 5, similarity_threshold: float = 0.4, max_memory_num: int = 5) -> list:
-        """根据输入文本获取相关的记忆内容"""
+    async def get_relevant_memories(self, text: str, max_topics: int = 5, similarity_threshold: float = 0.4, max_memory_num: int = 5,
+                                    analysis: Optional[MessageAnalysis] = None, topic_mode: Optional[str] = None) -> list:
+        """根据输入文本获取相关的记忆内容，analysis 为同一文本的分析结果，topic_mode 默认使用配置的 topic_extract_retrieve"""
         # 识别主题
-        identified_topics = await self._identify_topics(text)
+        identified_topics = await self._get_topics(text, analysis, topic_mode or global_config.topic_extract_retrieve)
         
         # 查找相似主题
         all_similar_topics = self._find_similar_topics(
             identified_topics, 
             similarity_threshold=similarity_threshold,
-            debug_info="记忆检索"
+            debug_info="记忆检索",
+            analysis=analysis
         )
         
         # 获取最相关的主题
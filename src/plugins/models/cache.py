@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from pymongo import UpdateOne
+
+from ...common.database import Database
+from ..chat.config import global_config
+
+
+def text_digest(text: str) -> str:
+    """文本内容的稳定摘要，用作缓存键（不能用内置 hash，它在每次启动时都不同）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """带可选过期时间的进程内 LRU 缓存"""
+
+    def __init__(self, max_size: int = 1000, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()  # key -> (value, 过期时间)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expire_at = item
+        if expire_at is not None and time.time() > expire_at:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        """写入缓存，ttl 不填时使用缓存默认的过期时间"""
+        ttl = ttl or self.ttl
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+        self._data.move_to_end(key)
+        while self.max_size and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class EmbeddingCache:
+    """按 (模型名, 文本摘要) 缓存 embedding 向量
+
+    内存里是一层 LRU，后面是 MongoDB 的 embedding_cache 集合，重启后依然有效；
+    同样的文本对同一个模型只会请求一次
+    """
+    _instance: Optional["EmbeddingCache"] = None
+
+    def __init__(self):
+        self.memory = LRUCache(max_size=global_config.embedding_cache_size)
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get_instance(cls) -> "EmbeddingCache":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def init_database():
+        """创建缓存集合的唯一索引"""
+        db = Database.get_instance()
+        db.db.embedding_cache.create_index([("model", 1), ("digest", 1)], unique=True)
+
+    def get_from_memory(self, model_name: str, text: str) -> Optional[list]:
+        """只查内存缓存，未命中时不计数，交给之后的 get_many 处理"""
+        embedding = self.memory.get((model_name, text_digest(text)))
+        if embedding is not None:
+            self.memory_hits += 1
+        return embedding
+
+    async def get_many(self, model_name: str, texts: List[str]) -> List[Optional[list]]:
+        """批量查询缓存，同步的数据库查询放到线程池，不阻塞事件循环
+
+        Args:
+            model_name: embedding 模型名
+            texts: 文本列表
+
+        Returns:
+            List[Optional[list]]: 与 texts 一一对应的向量，未命中为 None
+        """
+        results: List[Optional[list]] = [None] * len(texts)
+        digests = [text_digest(text) for text in texts]
+        missing: Dict[str, List[int]] = {}
+        for i, digest in enumerate(digests):
+            embedding = self.memory.get((model_name, digest))
+            if embedding is not None:
+                results[i] = embedding
+                self.memory_hits += 1
+            else:
+                missing.setdefault(digest, []).append(i)
+
+        if missing and global_config.embedding_cache_persist:
+            try:
+                collection = Database.get_instance().db.embedding_cache
+                docs = await asyncio.to_thread(lambda: list(collection.find(
+                    {"model": model_name, "digest": {"$in": list(missing)}},
+                    {"digest": 1, "embedding": 1},
+                )))
+                for doc in docs:
+                    self.memory.set((model_name, doc["digest"]), doc["embedding"])
+                    for i in missing.pop(doc["digest"], []):
+                        results[i] = doc["embedding"]
+                        self.db_hits += 1
+            except Exception as e:
+                logger.error(f"读取embedding缓存失败: {e}")
+
+        self.misses += sum(len(indexes) for indexes in missing.values())
+        return results
+
+    async def set_many(self, model_name: str, texts: List[str], embeddings: List[Optional[list]]):
+        """写入缓存，值为 None 的跳过"""
+        operations = []
+        for text, embedding in zip(texts, embeddings):
+            if embedding is None:
+                continue
+            digest = text_digest(text)
+            self.memory.set((model_name, digest), embedding)
+            operations.append(UpdateOne(
+                {"model": model_name, "digest": digest},
+                {"$setOnInsert": {"embedding": embedding, "timestamp": datetime.now()}},
+                upsert=True,
+            ))
+        if operations and global_config.embedding_cache_persist:
+            try:
+                await asyncio.to_thread(
+                    Database.get_instance().db.embedding_cache.bulk_write, operations, ordered=False
+                )
+            except Exception as e:
+                logger.error(f"写入embedding缓存失败: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存的命中指标"""
+        total = self.memory_hits + self.db_hits + self.misses
+        hits = self.memory_hits + self.db_hits
+        return {
+            "内存命中": self.memory_hits,
+            "数据库命中": self.db_hits,
+            "未命中": self.misses,
+            "命中率": f"{hits / total:.1%}" if total else "0.0%",
+            "内存条目": len(self.memory),
+        }
+
+
+class ResponseCache:
+    """辅助模型调用的响应缓存
+
+    情绪标签、主题识别这类调用基本只取决于输入，相同的请求体在过期时间内直接复用上次的结果。
+    内存里是一层 LRU，可选持久化到 MongoDB 的 llm_response_cache 集合（由 TTL 索引自动清理）
+    """
+    _instance: Optional["ResponseCache"] = None
+
+    def __init__(self):
+        self.memory = LRUCache(max_size=global_config.response_cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get_instance(cls) -> "ResponseCache":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def init_database():
+        """创建缓存集合的索引，过期的记录由 MongoDB 自动删除（TTL 索引按 UTC 时间判断）"""
+        db = Database.get_instance()
+        db.db.llm_response_cache.create_index([("key", 1)], unique=True)
+        db.db.llm_response_cache.create_index([("expire_at", 1)], expireAfterSeconds=0)
+
+    async def get(self, key: str) -> Optional[Any]:
+        """查询缓存，未命中返回 None；内存未命中时在线程池中查询数据库"""
+        value = self.memory.get(key)
+        if value is None and global_config.response_cache_persist:
+            try:
+                doc = await asyncio.to_thread(
+                    Database.get_instance().db.llm_response_cache.find_one,
+                    {"key": key, "expire_at": {"$gt": datetime.utcnow()}},
+                )
+                if doc:
+                    value = doc["value"]
+                    ttl = (doc["expire_at"] - datetime.utcnow()).total_seconds()
+                    self.memory.set(key, value, ttl=max(ttl, 1))
+            except Exception as e:
+                logger.error(f"读取响应缓存失败: {e}")
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float):
+        """写入缓存"""
+        self.memory.set(key, value, ttl=ttl)
+        if global_config.response_cache_persist:
+            try:
+                await asyncio.to_thread(
+                    Database.get_instance().db.llm_response_cache.update_one,
+                    {"key": key},
+                    {"$set": {"value": value, "expire_at": datetime.utcnow() + timedelta(seconds=ttl)}},
+                    upsert=True,
+                )
+            except Exception as e:
+                logger.error(f"写入响应缓存失败: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存的命中指标"""
+        total = self.hits + self.misses
+        return {
+            "命中": self.hits,
+            "未命中": self.misses,
+            "命中率": f"{self.hits / total:.1%}" if total else "0.0%",
+            "内存条目": len(self.memory),
+        }
+
+
+def get_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """获取所有模型缓存的运行指标"""
+    return {
+        "embedding": EmbeddingCache.get_instance().get_stats(),
+        "辅助模型响应": ResponseCache.get_instance().get_stats(),
+    }
@@ -0,0 +1,133 @@
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from ..chat.config import global_config
+
+
+class CircuitOpenError(RuntimeError):
+    """服务商熔断中，请求被直接拒绝"""
+
+
+class CircuitBreaker:
+    """单个服务商的熔断器
+
+    统计最近一段时间内请求的失败率和慢请求比例，超过阈值后熔断（打开），
+    熔断期间的请求立即失败，不再排队重试；冷却时间过后进入半开状态，
+    只放行少量探测请求，探测成功则恢复，失败则继续熔断
+    """
+
+    CLOSED = "正常"
+    OPEN = "熔断"
+    HALF_OPEN = "半开"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        # 最近的请求结果 (时间, 是否成功, 耗时)
+        self._outcomes: deque = deque()
+
+        # 指标
+        self.open_count = 0
+        self.rejected_count = 0
+
+    def _prune(self, now: float):
+        window = global_config.circuit_window
+        while self._outcomes and now - self._outcomes[0][0] > window:
+            self._outcomes.popleft()
+
+    def _rates(self):
+        """返回 (请求数, 失败率, 慢请求率)"""
+        total = len(self._outcomes)
+        if not total:
+            return 0, 0.0, 0.0
+        failures = sum(1 for _, success, _ in self._outcomes if not success)
+        slow = sum(1 for _, _, latency in self._outcomes if latency >= global_config.circuit_slow_call_seconds)
+        return total, failures / total, slow / total
+
+    def _open(self, reason: str):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.open_count += 1
+        logger.warning(f"服务商 {self.name} 熔断 {global_config.circuit_open_seconds} 秒: {reason}")
+
+    def before_request(self):
+        """发出请求前调用，熔断中时抛出 CircuitOpenError"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < global_config.circuit_open_seconds:
+                self.rejected_count += 1
+                raise CircuitOpenError(f"服务商 {self.name} 熔断中，请求被拒绝")
+            self.state = self.HALF_OPEN
+            self.probes_in_flight = 0
+            logger.info(f"服务商 {self.name} 熔断冷却结束，开始探测")
+        if self.state == self.HALF_OPEN:
+            if self.probes_in_flight >= global_config.circuit_half_open_probes:
+                self.rejected_count += 1
+                raise CircuitOpenError(f"服务商 {self.name} 正在探测恢复，请求被拒绝")
+            self.probes_in_flight += 1
+
+    def record(self, success: Optional[bool], latency: float):
+        """记录一次请求的结果
+
+        Args:
+            success: 是否成功；None 表示结果与服务商健康无关（如429、请求被取消），只归还探测名额
+            latency: 请求耗时（秒）
+        """
+        if self.state == self.HALF_OPEN:
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+            if success is None:
+                return
+            if success and latency < global_config.circuit_slow_call_seconds:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                logger.success(f"服务商 {self.name} 探测成功，恢复正常")
+            else:
+                self._open("探测请求失败")
+            return
+        if success is None or self.state == self.OPEN:
+            return
+
+        now = time.monotonic()
+        self._outcomes.append((now, success, latency))
+        self._prune(now)
+        total, failure_rate, slow_rate = self._rates()
+        if total < global_config.circuit_min_requests:
+            return
+        if failure_rate >= global_config.circuit_failure_rate:
+            self._open(f"最近{total}次请求失败率 {failure_rate:.0%}")
+        elif slow_rate >= global_config.circuit_failure_rate:
+            self._open(f"最近{total}次请求慢请求比例 {slow_rate:.0%}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取熔断器的运行指标"""
+        self._prune(time.monotonic())
+        total, failure_rate, slow_rate = self._rates()
+        return {
+            "状态": self.state,
+            "近期请求": total,
+            "失败率": f"{failure_rate:.0%}",
+            "慢请求率": f"{slow_rate:.0%}",
+            "熔断次数": self.open_count,
+            "快速失败次数": self.rejected_count,
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    """获取服务商共享的熔断器"""
+    breaker = _breakers.get(provider)
+    if breaker is None:
+        breaker = CircuitBreaker(provider)
+        _breakers[provider] = breaker
+    return breaker
+
+
+def get_circuit_stats() -> Dict[str, Dict[str, Any]]:
+    """获取所有熔断器的运行指标"""
+    return {name: breaker.get_stats() for name, breaker in _breakers.items()}
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+import aiohttp
+from loguru import logger
+
+from ..chat.config import global_config
+
+
+class ClientSessionPool:
+    """进程级的HTTP会话池
+
+    按 base_url 复用 aiohttp.ClientSession，同一个API地址的请求共用一个带连接池的
+    TCPConnector，连接保持 keep-alive，避免每次请求都重新进行 TCP+TLS 握手
+    """
+    _instance: Optional["ClientSessionPool"] = None
+
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        # 会话绑定创建时的事件循环，循环变化时需要重建
+        self._loops: Dict[str, asyncio.AbstractEventLoop] = {}
+
+    @classmethod
+    def get_instance(cls) -> "ClientSessionPool":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def _create_trace_config() -> aiohttp.TraceConfig:
+        """记录新建连接的耗时
+
+        请求时通过 trace_request_ctx 传入一个字典，建立新连接的耗时（秒）累加到其中的 "connect"
+        """
+        async def on_create_start(session, context, params):
+            context.connect_start = time.monotonic()
+
+        async def on_create_end(session, context, params):
+            ctx = context.trace_request_ctx
+            if isinstance(ctx, dict) and hasattr(context, "connect_start"):
+                ctx["connect"] = ctx.get("connect", 0.0) + time.monotonic() - context.connect_start
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(on_create_start)
+        trace_config.on_connection_create_end.append(on_create_end)
+        return trace_config
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        """按配置创建带连接池的会话"""
+        connector = aiohttp.TCPConnector(
+            limit=global_config.llm_pool_limit,
+            limit_per_host=global_config.llm_pool_limit_per_host,
+            keepalive_timeout=global_config.llm_keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=global_config.llm_dns_cache_ttl,
+        )
+        # 只限制建立连接的时间，推理模型的流式输出可能持续很久，不设置总超时
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=global_config.llm_connect_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     trace_configs=[self._create_trace_config()])
+
+    def get_session(self, base_url: str) -> aiohttp.ClientSession:
+        """获取 base_url 对应的共享会话，必须在事件循环中调用
+
+        Args:
+            base_url: API地址
+
+        Returns:
+            aiohttp.ClientSession: 共享的会话对象，调用方不要关闭它
+        """
+        key = base_url.rstrip('/')
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(key)
+        if session is None or session.closed or self._loops.get(key) is not loop:
+            session = self._create_session()
+            self._sessions[key] = session
+            self._loops[key] = loop
+            logger.debug(f"为 {key} 创建新的HTTP连接池")
+        return session
+
+    async def close_all(self):
+        """关闭所有会话，在 bot 退出时调用"""
+        for key, session in list(self._sessions.items()):
+            if session.closed:
+                continue
+            try:
+                await session.close()
+            except Exception as e:
+                logger.error(f"关闭 {key} 的HTTP会话失败: {e}")
+        self._sessions.clear()
+        self._loops.clear()
@@ -0,0 +1,52 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+class DeadlineExceeded(RuntimeError):
+    """调用方给出的截止时间已到（或来不及再重试），请求被放弃"""
+
+
+# 当前上下文中模型请求的截止时间（time.time() 时间戳），None 表示不限
+_current_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+
+@contextmanager
+def llm_deadline(deadline: Optional[float]):
+    """在此上下文中发起的模型请求（包括其中创建的任务）都在 deadline 之前放弃
+
+    已有更早的截止时间时保留更早的那个
+
+    Example:
+        with llm_deadline(time.time() + 60):
+            await llm.generate_response(prompt)
+    """
+    current = _current_deadline.get()
+    if current is not None and deadline is not None:
+        deadline = min(current, deadline)
+    token = _current_deadline.set(deadline if deadline is not None else current)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """距离当前截止时间的秒数，没有截止时间时返回 None"""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+async def detach_deadline(coro):
+    """在不受截止时间约束的上下文中执行 coro
+
+    用于多个调用方共享的请求（相同请求合并、embedding 批量请求），不能因为其中一个调用方超时而失败
+    """
+    token = _current_deadline.set(None)
+    try:
+        return await coro
+    finally:
+        _current_deadline.reset(token)
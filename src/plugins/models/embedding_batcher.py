@@ -0,0 +1,62 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+from loguru import logger
+
+from .deadline import detach_deadline
+from .rate_limiter import get_current_priority, llm_priority
+
+
+class EmbeddingBatcher:
+    """把短时间内并发的单条 embedding 请求合并成一次批量请求
+
+    第一条请求到达后等待 wait_ms 毫秒，期间到达的请求一起发出；
+    攒满 max_batch_size 条时立即发出，不再等待。合并后的请求使用这批中最高的优先级
+    """
+
+    def __init__(
+        self,
+        batch_func: Callable[[List[str]], Awaitable[List[Optional[list]]]],
+        max_batch_size: int = 32,
+        wait_ms: float = 5,
+    ):
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size
+        self.wait_ms = wait_ms
+        self._pending: List[tuple] = []  # (text, future, priority)
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, text: str) -> Optional[list]:
+        """提交一条文本，返回它的 embedding 向量"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future, get_current_priority()))
+        if self.max_batch_size and len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.wait_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.create_task(detach_deadline(self._run(pending)))
+
+    async def _run(self, pending: List[tuple]):
+        texts = [text for text, _, _ in pending]
+        priority = min(item_priority for _, _, item_priority in pending)
+        try:
+            with llm_priority(priority):
+                embeddings = await self.batch_func(texts)
+        except Exception as e:
+            logger.error(f"批量获取embedding失败: {e}")
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), embedding in zip(pending, embeddings):
+            if not future.done():
+                future.set_result(embedding)
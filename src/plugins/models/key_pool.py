@@ -0,0 +1,119 @@
+import time
+from typing import Any, Dict, List, Union
+
+from loguru import logger
+
+from ..chat.config import global_config
+
+
+def parse_keys(value: Union[str, List[str], None]) -> List[str]:
+    """解析 .env 中的 key 配置，支持单个 key、逗号分隔的多个 key 和列表"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(key).strip() for key in value if str(key).strip()]
+
+
+def mask_key(key: str) -> str:
+    """只显示 key 的末尾几位，防止日志和统计里泄露完整的 key"""
+    return f"...{key[-4:]}" if len(key) > 4 else "****"
+
+
+class KeyPool:
+    """同一服务商的多个 API key
+
+    服务商的频率限制是按 key 计算的，轮流使用多个 key 可以成倍提高可用的吞吐量；
+    被限流（429）或额度用尽（402/403）的 key 会暂时停用，到期后自动恢复
+    """
+
+    def __init__(self, name: str, keys: List[str]):
+        self.name = name
+        self.keys = keys
+        self._next = 0
+        self.benched_until: Dict[str, float] = {key: 0.0 for key in keys}
+        # 指标
+        self.request_counts: Dict[str, int] = {key: 0 for key in keys}
+        self.rate_limited_counts: Dict[str, int] = {key: 0 for key in keys}
+        self.quota_exhausted_counts: Dict[str, int] = {key: 0 for key in keys}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def acquire(self) -> str:
+        """轮流取出一个可用的 key；全部停用时返回最早恢复的那个"""
+        now = time.monotonic()
+        for _ in range(len(self.keys)):
+            key = self.keys[self._next]
+            self._next = (self._next + 1) % len(self.keys)
+            if self.benched_until[key] <= now:
+                self.request_counts[key] += 1
+                return key
+        key = min(self.keys, key=lambda k: self.benched_until[k])
+        self.request_counts[key] += 1
+        return key
+
+    def has_available(self, exclude: str = None) -> bool:
+        """除 exclude 之外是否还有未停用的 key"""
+        now = time.monotonic()
+        return any(key != exclude and until <= now for key, until in self.benched_until.items())
+
+    def report_rate_limited(self, key: str, seconds: float):
+        """key 被限流，停用 seconds 秒"""
+        self.rate_limited_counts[key] += 1
+        self.benched_until[key] = max(self.benched_until[key], time.monotonic() + seconds)
+        logger.warning(f"{self.name} 的 key {mask_key(key)} 被限流，停用{seconds}秒")
+
+    def report_quota_exhausted(self, key: str):
+        """key 额度用尽或被拒绝，较长时间停用"""
+        self.quota_exhausted_counts[key] += 1
+        seconds = global_config.key_quota_bench_seconds
+        self.benched_until[key] = max(self.benched_until[key], time.monotonic() + seconds)
+        logger.error(f"{self.name} 的 key {mask_key(key)} 余额不足或被拒绝，停用{seconds}秒")
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取每个 key 的运行指标"""
+        now = time.monotonic()
+        stats = {}
+        for key in self.keys:
+            remaining = self.benched_until[key] - now
+            stats[f"{self.name} {mask_key(key)}"] = {
+                "状态": f"停用中({remaining:.0f}秒)" if remaining > 0 else "可用",
+                "请求数": self.request_counts[key],
+                "被限流次数": self.rate_limited_counts[key],
+                "额度用尽次数": self.quota_exhausted_counts[key],
+            }
+        return stats
+
+
+_pools: Dict[str, KeyPool] = {}
+
+
+def get_key_pool(name: str, value: Union[str, List[str]]) -> KeyPool:
+    """获取 key 配置对应的共享 key 池
+
+    Args:
+        name: key 的配置名，如 SILICONFLOW_KEY
+        value: .env 中的值
+
+    Returns:
+        KeyPool: 同一配置名的所有模型共享
+    """
+    pool = _pools.get(name)
+    if pool is None:
+        # 没有填写 key 时保留一个空 key，和以前一样在请求时由服务商报认证失败
+        keys = parse_keys(value) or [""]
+        pool = KeyPool(name, keys)
+        _pools[name] = pool
+        if len(keys) > 1:
+            logger.info(f"{name} 配置了 {len(keys)} 个 key，将轮流使用")
+    return pool
+
+
+def get_key_stats() -> Dict[str, Dict[str, Any]]:
+    """获取所有 key 池的运行指标"""
+    stats = {}
+    for pool in _pools.values():
+        if len(pool) > 1:
+            stats.update(pool.get_stats())
+    return stats
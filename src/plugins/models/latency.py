@@ -0,0 +1,88 @@
+import math
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+class LatencyTracker:
+    """记录一个模型最近若干次请求的延迟和失败，用于计算分位数和错误率
+
+    因为太慢被提前取消的请求（如输给对冲的请求）按取消时已等待的时间记录，作为真实延迟的下限；
+    只统计完成的请求会让分位数越来越低
+    """
+
+    def __init__(self, name: str, window: int = 200):
+        self.name = name
+        # 最近的样本 (时间, 秒, 是否被提前取消)，失败的请求延迟为 None
+        self._samples: deque = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def _recent(self, max_age: Optional[float]) -> list:
+        now = time.monotonic()
+        return [latency for at, latency, _ in self._samples if max_age is None or now - at <= max_age]
+
+    def record(self, latency: float):
+        """记录一次成功请求的延迟（秒）"""
+        self._samples.append((time.monotonic(), latency, False))
+
+    def record_censored(self, elapsed: float):
+        """记录一次因为太慢被提前取消的请求，elapsed 为取消时已等待的时间（秒），真实延迟至少这么长"""
+        self._samples.append((time.monotonic(), elapsed, True))
+
+    def record_error(self):
+        """记录一次失败的请求"""
+        self._samples.append((time.monotonic(), None, False))
+
+    def count(self, max_age: Optional[float] = None) -> int:
+        """最近 max_age 秒内的样本数（含失败）"""
+        return len(self._recent(max_age))
+
+    def error_rate(self, max_age: Optional[float] = None) -> float:
+        """最近 max_age 秒内失败请求的比例"""
+        samples = self._recent(max_age)
+        if not samples:
+            return 0.0
+        return sum(1 for latency in samples if latency is None) / len(samples)
+
+    def percentile(self, p: float, max_age: Optional[float] = None) -> Optional[float]:
+        """延迟的 p 分位数（p 取 0~1），没有样本时返回 None
+
+        Args:
+            p: 分位，如 0.95
+            max_age: 只统计最近 max_age 秒内的样本，不填则统计全部
+        """
+        values = sorted(latency for latency in self._recent(max_age) if latency is not None)
+        if not values:
+            return None
+        index = min(len(values) - 1, max(0, math.ceil(p * len(values)) - 1))
+        return values[index]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取延迟分位数"""
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "样本数": len(self._samples),
+            "提前取消": sum(1 for _, _, censored in self._samples if censored),
+            "p50": f"{p50:.2f}秒" if p50 is not None else "-",
+            "p95": f"{p95:.2f}秒" if p95 is not None else "-",
+            "错误率": f"{self.error_rate():.0%}",
+        }
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+
+
+def get_latency_tracker(name: str) -> LatencyTracker:
+    """获取共享的延迟记录器，name 一般为 "模型名 指标名"，如 "DeepSeek-V3 首字延迟" """
+    tracker = _trackers.get(name)
+    if tracker is None:
+        tracker = LatencyTracker(name)
+        _trackers[name] = tracker
+    return tracker
+
+
+def get_latency_stats() -> Dict[str, Dict[str, Any]]:
+    """获取所有延迟记录器的指标"""
+    return {name: tracker.get_stats() for name, tracker in _trackers.items() if len(tracker)}
@@ -0,0 +1,325 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from ..chat.config import global_config
+
+
+class RequestPriority(IntEnum):
+    """模型请求的优先级，数值越小越优先"""
+    MENTION_REPLY = 0  # 被提及时的回复
+    NORMAL_REPLY = 1  # 普通回复，以及回复流程中的识图、主题识别等
+    BACKGROUND = 2  # 记忆构建、表情包注册、日程生成等后台任务
+
+
+# 当前协程上下文中模型请求的优先级，asyncio 创建的子任务会继承
+_current_priority: ContextVar[RequestPriority] = ContextVar("llm_priority", default=RequestPriority.NORMAL_REPLY)
+
+
+@contextmanager
+def llm_priority(priority: RequestPriority):
+    """在 with 块内发出的模型请求都使用指定的优先级
+
+    Example:
+        with llm_priority(RequestPriority.BACKGROUND):
+            await hippocampus.operation_build_memory()
+    """
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def get_current_priority() -> RequestPriority:
+    """获取当前上下文的请求优先级"""
+    return _current_priority.get()
+
+
+class TokenBucket:
+    """按分钟补充的令牌桶"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.fill_rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """距离可以取出 amount 个令牌还需要等待的秒数"""
+        self._refill()
+        # 单次用量超过桶容量时按桶满处理，否则永远等不到
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.fill_rate
+
+    def consume(self, amount: float):
+        """取出令牌，允许透支，透支的部分由之后的补充偿还"""
+        self._refill()
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """单个服务商或单个模型的限流器
+
+    同时限制并发数、每分钟请求数(rpm)和每分钟token数(tpm)，超出限制的请求在本地排队，
+    收到 429 时按 Retry-After 暂停放行，避免请求打到服务商后再被退回
+
+    排队按优先级出队，同优先级按到达顺序；后台请求最多只能占用一部分并发名额，
+    给回复留出余量，这样记忆构建等批量任务开始时回复不会被堵在后面
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 0, rpm: int = 0, tpm: int = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency or 0
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.blocked_until = 0.0  # 429 之后暂停放行的截止时间(monotonic)
+        # 排队中的请求，小顶堆，元素为 (优先级, 到达序号, waiter)
+        self._waiters: list = []
+        self._sequence = itertools.count()
+
+        # 指标
+        self.total_requests = 0
+        self.queued_requests = 0  # 需要排队的请求数
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.throttled_count = 0
+        self.queued_by_priority: Dict[RequestPriority, int] = {priority: 0 for priority in RequestPriority}
+
+    def _has_slot(self, priority: RequestPriority) -> bool:
+        if not self.max_concurrency:
+            return True
+        if self.in_flight >= self.max_concurrency:
+            return False
+        if priority == RequestPriority.BACKGROUND:
+            background_limit = max(1, int(self.max_concurrency * global_config.llm_background_max_share))
+            return self.background_in_flight < background_limit
+        return True
+
+    def _delay(self, tokens: int) -> float:
+        """当前还需要等待多久才满足频率限制"""
+        delay = max(0.0, self.blocked_until - time.monotonic())
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.wait_time(1))
+        if self.token_bucket:
+            delay = max(delay, self.token_bucket.wait_time(tokens))
+        return delay
+
+    def _wake_next(self):
+        """唤醒排在最前面的请求，让它重新检查是否可以放行"""
+        if self._waiters:
+            future = self._waiters[0][2]["future"]
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def acquire(self, tokens: int = 0, priority: RequestPriority = RequestPriority.NORMAL_REPLY,
+                      timeout: Optional[float] = None) -> float:
+        """获取一个请求名额，必要时排队等待
+
+        超时在限流器内部判断，不要在外面套 asyncio.wait_for：名额分配后、返回前被取消时名额会泄漏
+
+        Args:
+            tokens: 预估的token用量，用于tpm限制
+            priority: 请求优先级
+            timeout: 最多排队的秒数，None 为不限
+
+        Returns:
+            float: 排队等待的秒数
+
+        Raises:
+            asyncio.TimeoutError: 超过 timeout 仍未轮到
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        deadline = start + timeout if timeout is not None else None
+        waiter = {"future": None}
+        entry = (priority, next(self._sequence), waiter)
+        heapq.heappush(self._waiters, entry)
+        queued = False
+        try:
+            while True:
+                wait = None
+                if self._waiters[0] is entry and self._has_slot(priority):
+                    delay = self._delay(tokens)
+                    if delay <= 0:
+                        break
+                    wait = delay
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        raise asyncio.TimeoutError(f"限流器 {self.name} 排队超时")
+                    wait = left if wait is None else min(wait, left)
+                if not queued:
+                    queued = True
+                    self.queued_requests += 1
+                    self.queued_by_priority[priority] += 1
+                    self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+                waiter["future"] = loop.create_future()
+                try:
+                    await asyncio.wait_for(waiter["future"], wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.in_flight += 1
+            if priority == RequestPriority.BACKGROUND:
+                self.background_in_flight += 1
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(tokens)
+        finally:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            self._wake_next()
+
+        wait_time = time.monotonic() - start
+        self.total_requests += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return wait_time
+
+    def release(self, extra_tokens: int = 0, priority: RequestPriority = RequestPriority.NORMAL_REPLY):
+        """归还请求名额
+
+        Args:
+            extra_tokens: 实际token用量与预估值的差，用于修正tpm
+            priority: 获取名额时使用的优先级
+        """
+        if self.token_bucket and extra_tokens:
+            self.token_bucket.consume(extra_tokens)
+        self.in_flight = max(0, self.in_flight - 1)
+        if priority == RequestPriority.BACKGROUND:
+            self.background_in_flight = max(0, self.background_in_flight - 1)
+        self._wake_next()
+
+    def throttle(self, seconds: float):
+        """收到限流响应后，在 seconds 秒内暂停放行新请求"""
+        self.throttled_count += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取限流器的运行指标"""
+        return {
+            "并发": self.in_flight,
+            "后台并发": self.background_in_flight,
+            "排队": len(self._waiters),
+            "最大排队": self.max_queue_depth,
+            "请求数": self.total_requests,
+            "排队请求数": self.queued_requests,
+            "平均等待": round(self.total_wait_time / self.total_requests, 3) if self.total_requests else 0,
+            "最长等待": round(self.max_wait_time, 3),
+            "被限流次数": self.throttled_count,
+            "后台排队请求数": self.queued_by_priority[RequestPriority.BACKGROUND],
+        }
+
+
+class LimiterChain:
+    """一次请求需要依次通过的限流器（模型级 + 服务商级）"""
+
+    def __init__(self, limiters: List[RateLimiter]):
+        self.limiters = limiters
+
+    async def acquire(self, tokens: int = 0, priority: RequestPriority = RequestPriority.NORMAL_REPLY,
+                      timeout: Optional[float] = None) -> float:
+        """按顺序获取所有限流器的名额，返回总等待秒数；timeout 为所有限流器合计最多排队的秒数"""
+        acquired = []
+        wait_time = 0.0
+        try:
+            for limiter in self.limiters:
+                left = timeout - wait_time if timeout is not None else None
+                wait_time += await limiter.acquire(tokens, priority, left)
+                acquired.append(limiter)
+        except BaseException:
+            for limiter in acquired:
+                limiter.release(priority=priority)
+            raise
+        return wait_time
+
+    def release(self, extra_tokens: int = 0, priority: RequestPriority = RequestPriority.NORMAL_REPLY):
+        for limiter in self.limiters:
+            limiter.release(extra_tokens, priority)
+
+    def throttle(self, seconds: float):
+        for limiter in self.limiters:
+            limiter.throttle(seconds)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def _get_limiter(name: str, limits: dict) -> RateLimiter:
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = RateLimiter(
+            name,
+            max_concurrency=limits.get("max_concurrency", 0),
+            rpm=limits.get("rpm", 0),
+            tpm=limits.get("tpm", 0),
+        )
+        _limiters[name] = limiter
+        logger.debug(f"创建限流器 {name}: {limits}")
+    return limiter
+
+
+def get_limiter_chain(provider: str, model: dict) -> LimiterChain:
+    """获取模型对应的限流器链
+
+    服务商级限流器对该服务商的所有模型共享，模型级限流器只有在模型配置了
+    max_concurrency/rpm/tpm 时才会创建
+
+    Args:
+        provider: 服务商名，如 SILICONFLOW
+        model: 模型配置字典
+
+    Returns:
+        LimiterChain: 先模型后服务商的限流器链
+    """
+    limiters = []
+    limit_keys = ("max_concurrency", "rpm", "tpm")
+    if any(model.get(key) for key in limit_keys):
+        model_limits = {key: model.get(key, 0) for key in limit_keys}
+        limiters.append(_get_limiter(f"{provider}/{model['name']}", model_limits))
+
+    provider_limits = {"max_concurrency": global_config.llm_default_max_concurrency}
+    provider_limits.update(global_config.llm_provider_limits.get(provider, {}))
+    limiters.append(_get_limiter(provider, provider_limits))
+    return LimiterChain(limiters)
+
+
+def get_limiter_stats() -> Dict[str, Dict[str, Any]]:
+    """获取所有限流器的运行指标"""
+    return {name: limiter.get_stats() for name, limiter in _limiters.items()}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头，支持秒数和HTTP日期两种格式"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+
+class ThinkFilter:
+    """在流式输出中实时过滤 <think>...</think> 思维链
+
+    标签可能被拆在两个分片里，末尾可能是半个标签的内容会先留在缓冲区，等下一个分片再判断
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_think = False
+        self.reasoning = ""
+
+    @staticmethod
+    def _partial_tag_length(text: str, tag: str) -> int:
+        """text 末尾与 tag 开头重合的最大长度"""
+        for length in range(min(len(text), len(tag) - 1), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, text: str) -> str:
+        """输入一个分片，返回其中可见的内容"""
+        self._buffer += text
+        output = ""
+        while self._buffer:
+            tag = self.CLOSE_TAG if self._in_think else self.OPEN_TAG
+            index = self._buffer.find(tag)
+            if index >= 0:
+                part, self._buffer = self._buffer[:index], self._buffer[index + len(tag):]
+                self._in_think = not self._in_think
+            else:
+                keep = self._partial_tag_length(self._buffer, tag)
+                cut = len(self._buffer) - keep
+                part, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            if tag == self.CLOSE_TAG:
+                self.reasoning += part
+            else:
+                output += part
+            if index < 0:
+                break
+        return output
+
+    def flush(self) -> str:
+        """输出结束时调用，返回缓冲区中剩余的可见内容"""
+        rest, self._buffer = self._buffer, ""
+        if self._in_think:
+            self.reasoning += rest
+            return ""
+        return rest
+
+
+class StreamResponse:
+    """流式回复
+
+    异步迭代得到可见内容的增量（已过滤思维链），迭代结束后 content 和 reasoning_content
+    为完整内容。提前结束迭代时调用 close() 取消上游请求，不再消耗token
+    """
+
+    def __init__(self, request_factory: Callable[[Callable[[str, str], None]], Awaitable]):
+        """
+        Args:
+            request_factory: 接收分片回调 (content, reasoning) 并返回请求协程的函数
+        """
+        self._request_factory = request_factory
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._filter = ThinkFilter()
+        self._task: Optional[asyncio.Future] = None
+        self.content = ""
+        self._reasoning = ""
+        # 从开始请求到收到第一段可见内容的耗时（秒），还没有收到时为 None
+        self.first_token_latency: Optional[float] = None
+
+    @property
+    def reasoning_content(self) -> str:
+        """思维链：服务商单独返回的部分加上从 <think> 标签中过滤出的部分"""
+        return self._reasoning + self._filter.reasoning
+
+    def _on_delta(self, content: str, reasoning: str):
+        self._queue.put_nowait((content or "", reasoning or ""))
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        start = time.monotonic()
+        self._task = asyncio.ensure_future(self._request_factory(self._on_delta))
+        self._task.add_done_callback(lambda _: self._queue.put_nowait(None))
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                content, reasoning = item
+                self._reasoning += reasoning
+                visible = self._filter.feed(content)
+                if visible:
+                    if self.first_token_latency is None:
+                        self.first_token_latency = time.monotonic() - start
+                    self.content += visible
+                    yield visible
+            visible = self._filter.flush()
+            if visible:
+                if self.first_token_latency is None:
+                    self.first_token_latency = time.monotonic() - start
+                self.content += visible
+                yield visible
+            # 请求失败时在这里抛出异常
+            self._task.result()
+        finally:
+            self.close()
+
+    def close(self):
+        """取消还在进行的上游请求"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
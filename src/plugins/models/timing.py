@@ -0,0 +1,176 @@
+import asyncio
+import bisect
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class Histogram:
+    """固定分桶的直方图，分位数按桶的上界估算"""
+
+    # 秒
+    BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]
+
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """估算 p 分位数（p 取 0~1），落在最后一个桶时返回最大值"""
+        if not self.count:
+            return None
+        target = p * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self) -> str:
+        if not self.count:
+            return "-"
+        return (f"平均{self.sum / self.count:.2f} p50≤{self.percentile(0.5):.2f} "
+                f"p95≤{self.percentile(0.95):.2f} 最大{self.max:.2f}")
+
+
+# (模型名, 请求类型) -> 指标名 -> 直方图
+_histograms: Dict[Tuple[str, str], Dict[str, Histogram]] = {}
+# 每秒token数用单独的分桶
+_RATE_BUCKETS = [1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500]
+
+
+def _observe(model_name: str, request_type: str, metric: str, value: float):
+    metrics = _histograms.setdefault((model_name, request_type), {})
+    histogram = metrics.get(metric)
+    if histogram is None:
+        histogram = Histogram(_RATE_BUCKETS if metric == "token/秒" else None)
+        metrics[metric] = histogram
+    histogram.observe(value)
+
+
+class RequestTiming:
+    """一次模型调用的耗时分解
+
+    排队（本地限流）、建立连接、首字延迟、退避等待分开记录，总耗时减去这几项
+    就是服务商生成的时间和我们自己（事件循环）的开销
+    """
+
+    def __init__(self, model_name: str, request_type: str):
+        self.model_name = model_name
+        self.request_type = request_type
+        self.start = time.monotonic()
+        self.queue_wait = 0.0  # 本地限流排队
+        self.connect = 0.0  # 建立连接（DNS+TCP+TLS），复用连接时为0
+        self.ttft: Optional[float] = None  # 最后一次尝试从发出请求到收到第一个token（非流式为响应头）
+        self.backoff = 0.0  # 重试前的退避等待
+        self.attempts = 0
+        self.total: Optional[float] = None
+        self.tokens_per_second: Optional[float] = None
+        # 最后一次尝试发出请求、收到第一个token的时间
+        self._attempt_start: Optional[float] = None
+        self._first_token: Optional[float] = None
+
+    def start_attempt(self):
+        self.attempts += 1
+        self._attempt_start = time.monotonic()
+        self._first_token = None
+        self.ttft = None
+
+    def first_token(self):
+        """收到第一个token（或非流式的响应头）时调用，重复调用只记录第一次"""
+        if self._first_token is None and self._attempt_start is not None:
+            self._first_token = time.monotonic()
+            self.ttft = self._first_token - self._attempt_start
+
+    def finish(self, completion_tokens: Optional[int] = None):
+        """请求成功结束时调用，记入直方图"""
+        end = time.monotonic()
+        self.total = end - self.start
+        generation_start = self._first_token or self._attempt_start
+        if completion_tokens and generation_start and end > generation_start:
+            self.tokens_per_second = completion_tokens / (end - generation_start)
+
+        _observe(self.model_name, self.request_type, "总耗时", self.total)
+        _observe(self.model_name, self.request_type, "排队", self.queue_wait)
+        _observe(self.model_name, self.request_type, "建立连接", self.connect)
+        _observe(self.model_name, self.request_type, "退避", self.backoff)
+        if self.ttft is not None:
+            _observe(self.model_name, self.request_type, "首字延迟", self.ttft)
+        if self.tokens_per_second is not None:
+            _observe(self.model_name, self.request_type, "token/秒", self.tokens_per_second)
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """保存到 llm_usage 的耗时字段（秒）"""
+        return {
+            "queue_wait": round(self.queue_wait, 3),
+            "connect": round(self.connect, 3),
+            "ttft": round(self.ttft, 3) if self.ttft is not None else None,
+            "total": round(self.total, 3) if self.total is not None else None,
+            "retries": self.retries,
+            "backoff": round(self.backoff, 3),
+            "tokens_per_second": round(self.tokens_per_second, 1) if self.tokens_per_second is not None else None,
+        }
+
+    def __str__(self) -> str:
+        ttft = f"{self.ttft:.2f}" if self.ttft is not None else "-"
+        total = f"{self.total:.2f}" if self.total is not None else "-"
+        rate = f"{self.tokens_per_second:.1f}" if self.tokens_per_second is not None else "-"
+        return (f"总耗时{total}秒 排队{self.queue_wait:.2f}秒 连接{self.connect:.2f}秒 首字{ttft}秒 "
+                f"重试{self.retries}次 退避{self.backoff:.1f}秒 {rate}token/秒")
+
+
+class EventLoopMonitor:
+    """测量事件循环的调度延迟：定时器实际触发时间比预定晚了多少
+
+    延迟高说明有同步代码（如同步的数据库操作）阻塞了事件循环，所有请求都会被拖慢
+    """
+    _instance: Optional["EventLoopMonitor"] = None
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.histogram = Histogram()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def get_instance(cls) -> "EventLoopMonitor":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def start(self):
+        """开始测量，必须在事件循环中调用"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.histogram.observe(max(0.0, time.monotonic() - expected))
+
+
+def get_timing_stats() -> Dict[str, Dict[str, Any]]:
+    """获取各模型、请求类型的耗时直方图摘要（秒，token/秒）"""
+    stats = {}
+    for (model_name, request_type), metrics in _histograms.items():
+        stats[f"{model_name} ({request_type})"] = {
+            "次数": metrics["总耗时"].count,
+            **{metric: histogram.summary() for metric, histogram in metrics.items()},
+        }
+    loop_histogram = EventLoopMonitor.get_instance().histogram
+    if loop_histogram.count:
+        stats["事件循环调度延迟"] = {"次数": loop_histogram.count, "延迟": loop_histogram.summary()}
+    return stats
@@ -0,0 +1,92 @@
+import re
+from typing import List
+
+# 英文单词、数字等连续的非中文片段
+_LATIN_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+# 中日韩字符
+_CJK_PATTERN = re.compile(r"[\u4e00-\u9fff\u3040-\u30ff\uac00-\ud7af]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数，不需要加载分词器
+
+    估算规则参考常见的BPE分词结果：
+    - 中日韩字符大约每个字1个token
+    - 英文单词和数字按约4个字符1个token计算
+    - 其余标点、空白等按每个字符0.5个token计算
+
+    Args:
+        text: 需要估算的文本
+
+    Returns:
+        int: 估算的token数，偏保守（略大于真实值）
+    """
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    latin_chars = 0
+    latin_tokens = 0
+    for word in _LATIN_PATTERN.findall(text):
+        latin_chars += len(word)
+        latin_tokens += (len(word) + 3) // 4
+    other_count = len(text) - cjk_count - latin_chars
+    return cjk_count + latin_tokens + (other_count + 1) // 2
+
+
+def estimate_payload_tokens(payload: dict) -> int:
+    """估算一个 chat/completions 或 embeddings 请求体的输入token数
+
+    Args:
+        payload: 请求体
+
+    Returns:
+        int: 估算的输入token数，图片按固定值计算
+    """
+    total = 0
+    for message in payload.get("messages", []) or []:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += estimate_tokens(part.get("text", ""))
+                else:
+                    # 识图模型的图片输入大约按几百token计费，这里取一个保守的固定值
+                    total += 500
+    inputs = payload.get("input")
+    if isinstance(inputs, str):
+        total += estimate_tokens(inputs)
+    elif isinstance(inputs, list):
+        total += sum(estimate_tokens(text) for text in inputs if isinstance(text, str))
+    return total
+
+
+def split_batches(texts: List[str], max_count: int, max_tokens: int) -> List[List[int]]:
+    """按条数和估算token数把文本切成若干批，用于批量请求embedding
+
+    Args:
+        texts: 文本列表
+        max_count: 每批最多的条数，0为不限制
+        max_tokens: 每批最多的估算token数，0为不限制；单条超过上限时单独成批
+
+    Returns:
+        List[List[int]]: 每批包含的文本下标，保持原有顺序
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for index, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (
+            (max_count and len(current) >= max_count)
+            or (max_tokens and current_tokens + tokens > max_tokens)
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
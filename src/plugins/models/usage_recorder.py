@@ -0,0 +1,122 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from pymongo.errors import BulkWriteError
+
+from ...common.database import Database
+from ..chat.config import global_config
+
+
+class UsageRecorder:
+    """模型调用记录的批量写入
+
+    每次调用的用量记录先放在内存里，攒够 usage_flush_size 条或等待 usage_flush_interval 秒后
+    用一次 insert_many 写入 llm_usage 集合；写数据库在线程池里执行，不阻塞事件循环。
+    退出时调用 flush() 写入剩余的记录
+    """
+    _instance: Optional["UsageRecorder"] = None
+
+    # 数据库一直不可用时最多在内存里保留的记录数
+    MAX_BUFFER = 10000
+
+    def __init__(self):
+        self._buffer: List[Dict[str, Any]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # 保证同一时间只有一批在写，第一次写入时创建
+        self._lock: Optional[asyncio.Lock] = None
+        # 指标
+        self.written = 0
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+
+    @classmethod
+    def get_instance(cls) -> "UsageRecorder":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def record(self, doc: Dict[str, Any]):
+        """加入一条调用记录，不在事件循环中时直接同步写入"""
+        self._buffer.append(doc)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._take())
+            return
+        if len(self._buffer) >= global_config.usage_flush_size:
+            self._schedule(loop, 0)
+        elif self._flush_handle is None:
+            self._schedule(loop, global_config.usage_flush_interval)
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    def _take(self) -> List[Dict[str, Any]]:
+        docs, self._buffer = self._buffer, []
+        return docs
+
+    @staticmethod
+    def _insert(docs: List[Dict[str, Any]]):
+        """写入一批记录，在线程池中执行"""
+        Database.get_instance().db.llm_usage.insert_many(docs, ordered=False)
+
+    def _write(self, docs: List[Dict[str, Any]]):
+        """同步写入一批记录"""
+        try:
+            self._insert(docs)
+        except Exception as e:
+            self._on_failed(docs, e)
+        else:
+            self._on_written(docs)
+
+    def _on_written(self, docs: List[Dict[str, Any]]):
+        self.written += len(docs)
+        self.flush_count += 1
+
+    def _on_failed(self, docs: List[Dict[str, Any]], error: Exception):
+        """写入失败时放回缓冲区等下次再写；部分写入成功的批次不再重写，避免重复"""
+        self.failed_flushes += 1
+        logger.error(f"写入模型调用记录失败: {error}")
+        if isinstance(error, BulkWriteError):
+            return
+        self._buffer = docs + self._buffer
+        overflow = len(self._buffer) - self.MAX_BUFFER
+        if overflow > 0:
+            self._buffer = self._buffer[overflow:]
+            self.dropped += overflow
+            logger.error(f"模型调用记录积压过多，丢弃了最早的 {overflow} 条")
+
+    async def flush(self):
+        """把缓冲区中的记录写入数据库"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # 上一批还在写时等它写完，保持写入顺序
+        async with self._lock:
+            docs = self._take()
+            if docs:
+                try:
+                    await asyncio.to_thread(self._insert, docs)
+                except Exception as e:
+                    self._on_failed(docs, e)
+                else:
+                    self._on_written(docs)
+        # 写入期间又攒了记录，按间隔再写一次
+        if self._buffer and self._flush_handle is None:
+            self._schedule(asyncio.get_running_loop(), global_config.usage_flush_interval)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取批量写入的运行指标"""
+        return {"llm_usage": {
+            "待写入": len(self._buffer),
+            "已写入": self.written,
+            "批次数": self.flush_count,
+            "写入失败次数": self.failed_flushes,
+            "丢弃条数": self.dropped,
+        }}
@@ -1,8 +1,9 @@
 import asyncio
 import json
 import re
+import time
 from datetime import datetime
-from typing import Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import aiohttp
 from loguru import logger
@@ -11,53 +12,135 @@ from nonebot import get_driver
 from ...common.database import Database
 from ..chat.config import global_config
 from ..chat.utils_image import compress_base64_image_by_scale
+from .cache import EmbeddingCache, ResponseCache, text_digest
+from .circuit_breaker import CircuitBreaker, CircuitOpenError, get_circuit_breaker
+from .client_pool import ClientSessionPool
+from .deadline import DeadlineExceeded, detach_deadline, remaining_time
+from .embedding_batcher import EmbeddingBatcher
+from .key_pool import get_key_pool
+from .latency import get_latency_tracker
+from .rate_limiter import get_current_priority, get_limiter_chain, parse_retry_after
+from .streaming import StreamResponse
+from .timing import RequestTiming
+from .token_counter import estimate_payload_tokens, estimate_tokens, split_batches
+from .usage_recorder import UsageRecorder
 
 driver = get_driver()
 config = driver.config
 
 
+class PayloadTooLargeError(RuntimeError):
+    """服务商返回 413，且请求体无法压缩（不含图片），需要调用方拆小后重新请求"""
+
+
 class LLM_request:
-    def __init__(self, model, **kwargs):
+    # 按模型配置和请求参数共享的实例，见 get_instance
+    _instances: Dict[tuple, "LLM_request"] = {}
+    # llm_usage 集合的索引是否已经创建
+    _indexes_ready: bool = False
+    # 正在进行的请求，(API地址, 端点, 请求体摘要) -> {"task", "waiters"}
+    _in_flight: Dict[tuple, dict] = {}
+    _coalesced_requests: int = 0
+
+    def __init__(self, model, cache_ttl: float = 0, coalesce: bool = False, **kwargs):
         # 将大写的配置键转换为小写并从config中获取实际值
         try:
-            self.api_key = getattr(config, model["key"])
+            key_value = getattr(config, model["key"])
             self.base_url = getattr(config, model["base_url"])
         except AttributeError as e:
             logger.error(f"原始 model dict 信息：{model}")
             logger.error(f"配置错误：找不到对应的配置项 - {str(e)}")
             raise ValueError(f"配置错误：找不到对应的配置项 - {str(e)}") from e
+        # .env 中的 key 可以是逗号分隔的多个 key 或列表，请求时轮流使用
+        self.key_pool = get_key_pool(model["key"], key_value)
+        self.api_key = self.key_pool.keys[0]
         self.model_name = model["name"]
         self.params = kwargs
+        # 响应缓存的过期时间（秒），0为不缓存；只给结果基本只取决于输入的辅助调用开启
+        self.cache_ttl = cache_ttl
+        # 并发的相同请求是否共享结果；带采样温度的调用（如生成回复）每次结果不同，不能共享，
+        # 所以只有 temperature 为 0、开启了响应缓存或显式指定 coalesce 的调用才合并（embedding 由批量合并器合并）
+        self.coalesce = coalesce or bool(cache_ttl)
         
         self.pri_in = model.get("pri_in", 0)
         self.pri_out = model.get("pri_out", 0)
+
+        # 服务商名，旧版配置没有 provider 字段时从 base_url 的配置名推断
+        self.provider = model.get("provider") or model["base_url"].replace("_BASE_URL", "")
+        # 本地限流，同一服务商的所有模型共享服务商级限流器
+        self.limiter = get_limiter_chain(self.provider, model)
+        # 服务商熔断器，同一服务商的所有模型共享
+        self.breaker = get_circuit_breaker(self.provider)
+        # 服务商熔断时改用的模型（global_config 中的模型项名，如 llm_normal）
+        self.fallback = model.get("fallback")
+        # 模型级的停止序列，输出到这些内容时服务商直接结束生成
+        self.stop = model.get("stop")
+        # 用作回复模型时 prompt 的估算token上限，不填时使用全局配置
+        self.max_prompt_tokens = model.get("max_prompt_tokens")
+        # 单条 embedding 请求的合并器，第一次调用 get_embedding 时创建
+        self._embedding_batcher: Optional[EmbeddingBatcher] = None
         
         # 获取数据库实例
         self.db = Database.get_instance()
-        self._init_database()
+        # 正常情况下启动时已经建好索引，这里只是兜底，不会重复请求数据库
+        self.init_database()
 
-    def _init_database(self):
-        """初始化数据库集合"""
+    @classmethod
+    def get_instance(cls, model: dict, **kwargs) -> "LLM_request":
+        """获取共享的模型客户端
+        
+        相同的模型配置和请求参数只会创建一个实例，调用方不需要自己缓存
+        
+        Args:
+            model: 模型配置字典（global_config 中的模型项）
+            **kwargs: 请求参数，如 temperature、max_tokens；cache_ttl 开启响应缓存，coalesce 允许合并并发的相同请求，
+                这两项不会发给服务商
+            
+        Returns:
+            LLM_request: 共享的实例
+        """
+        key = (
+            model.get("name"),
+            model.get("base_url"),
+            model.get("key"),
+            json.dumps(kwargs, sort_keys=True, default=str),
+        )
+        instance = cls._instances.get(key)
+        if instance is None:
+            instance = cls(model, **kwargs)
+            cls._instances[key] = instance
+        return instance
+
+    @classmethod
+    def init_database(cls):
+        """初始化数据库集合，整个进程只执行一次"""
+        if cls._indexes_ready:
+            return
         try:
+            db = Database.get_instance()
             # 创建llm_usage集合的索引
-            self.db.db.llm_usage.create_index([("timestamp", 1)])
-            self.db.db.llm_usage.create_index([("model_name", 1)])
-            self.db.db.llm_usage.create_index([("user_id", 1)])
-            self.db.db.llm_usage.create_index([("request_type", 1)])
+            db.db.llm_usage.create_index([("timestamp", 1)])
+            db.db.llm_usage.create_index([("model_name", 1)])
+            db.db.llm_usage.create_index([("user_id", 1)])
+            db.db.llm_usage.create_index([("request_type", 1)])
+            EmbeddingCache.init_database()
+            ResponseCache.init_database()
+            cls._indexes_ready = True
         except Exception as e:
             logger.error(f"创建数据库索引失败: {e}")
 
     def _record_usage(self, prompt_tokens: int, completion_tokens: int, total_tokens: int, 
                      user_id: str = "system", request_type: str = "chat", 
-                     endpoint: str = "/chat/completions"):
-        """记录模型使用情况到数据库
+                     endpoint: str = "/chat/completions", timing: RequestTiming = None):
+        """记录模型使用情况到数据库，由 UsageRecorder 批量写入，不阻塞请求
         Args:
             prompt_tokens: 输入token数
             completion_tokens: 输出token数
             total_tokens: 总token数
             user_id: 用户ID，默认为system
-            request_type: 请求类型(chat/embedding/image等)
+            request_type: 请求类型(chat/embedding/image/topic/memory等)
             endpoint: API端点
+            timing: 本次调用的耗时分解
         """
         try:
             usage_data = {
@@ -72,13 +155,17 @@ class LLM_request:
                 "status": "success",
                 "timestamp": datetime.now()
             }
-            self.db.db.llm_usage.insert_one(usage_data)
+            if timing is not None:
+                usage_data["timing"] = timing.to_dict()
+            UsageRecorder.get_instance().record(usage_data)
             logger.info(
                 f"Token使用情况 - 模型: {self.model_name}, "
                 f"用户: {user_id}, 类型: {request_type}, "
                 f"提示词: {prompt_tokens}, 完成: {completion_tokens}, "
                 f"总计: {total_tokens}"
             )
+            if timing is not None:
+                logger.debug(f"耗时 - 模型: {self.model_name}, 类型: {request_type}, {timing}")
         except Exception as e:
             logger.error(f"记录token使用情况失败: {e}")
 
@@ -107,9 +194,177 @@ class LLM_request:
             retry_policy: dict = None,
             response_handler: callable = None,
             user_id: str = "system",
-            request_type: str = "chat"
+            request_type: str = "chat",
+            allow_fallback: bool = True,
+            stream_callback: Callable[[str, str], None] = None
     ):
         """统一请求执行入口
+        
+        结果只取决于输入的调用（见 coalesce），同一API地址上请求体完全相同、且使用默认响应解析的
+        并发请求只发出一次，所有调用方共享同一个结果（如多个群同时收到同一张表情包）；
+        开启了 cache_ttl 的实例在过期时间内直接返回缓存的结果；
+        服务商熔断时如果配置了 fallback，改用备用模型
+        
+        Args:
+            endpoint: API端点路径 (如 "chat/completions")
+            prompt: prompt文本
+            image_base64: 图片的base64编码
+            payload: 请求体数据
+            retry_policy: 自定义重试策略
+            response_handler: 自定义响应处理器
+            user_id: 用户ID
+            request_type: 请求类型
+            allow_fallback: 熔断时是否允许改用备用模型
+            stream_callback: 流式输出时每收到一个分片调用一次，参数为 (content, reasoning_content)
+        """
+        if payload is None:
+            payload = await self._build_payload(prompt, image_base64)
+
+        # 自定义处理器的返回值不一定能序列化，只缓存默认解析的 (content, reasoning)
+        use_cache = bool(self.cache_ttl) and response_handler is None and stream_callback is None
+        if use_cache:
+            cache_key = text_digest(json.dumps(
+                {"base_url": self.base_url, "endpoint": endpoint, "payload": payload},
+                sort_keys=True, ensure_ascii=False,
+            ))
+            cached = await ResponseCache.get_instance().get(cache_key)
+            if cached is not None:
+                logger.debug(f"模型 {self.model_name} 命中响应缓存")
+                return tuple(cached)
+
+        try:
+            result = await self._execute_uncached(endpoint, prompt, image_base64, payload, retry_policy,
+                                                  response_handler, user_id, request_type, stream_callback)
+        except CircuitOpenError:
+            fallback = self._get_fallback() if allow_fallback else None
+            if fallback is None:
+                raise
+            logger.warning(f"服务商 {self.provider} 熔断中，模型 {self.model_name} 改用备用模型 {fallback.model_name}")
+            return await fallback._execute_request(
+                endpoint, prompt, image_base64, {**payload, "model": fallback.model_name}, retry_policy,
+                response_handler, user_id, request_type, allow_fallback=False, stream_callback=stream_callback,
+            )
+        # 没有返回内容的结果不缓存
+        if use_cache and result[0] and result[0] != "没有返回结果":
+            await ResponseCache.get_instance().set(cache_key, list(result), self.cache_ttl)
+        return result
+
+    async def _execute_uncached(
+            self,
+            endpoint: str,
+            prompt: str,
+            image_base64: str,
+            payload: dict,
+            retry_policy: dict,
+            response_handler: callable,
+            user_id: str,
+            request_type: str,
+            stream_callback: Callable[[str, str], None] = None
+    ):
+        """合并相同的进行中请求后发送"""
+        request = self._send_timed(endpoint, prompt, image_base64, payload, retry_policy,
+                                   response_handler, user_id, request_type, stream_callback)
+        # 自定义处理器和流式回调可能依赖调用方的状态，结果不能共享
+        if (response_handler is not None or stream_callback is not None or not global_config.llm_single_flight
+                or not self._is_shareable(endpoint, payload)):
+            return await request
+
+        key = (
+            self.base_url,
+            endpoint,
+            text_digest(json.dumps(payload, sort_keys=True, ensure_ascii=False)),
+        )
+        flight = LLM_request._in_flight.get(key)
+        if flight is None:
+            flight = {"task": asyncio.ensure_future(detach_deadline(request)), "waiters": 0}
+            LLM_request._in_flight[key] = flight
+
+            def _forget(_task, key=key, flight=flight):
+                if LLM_request._in_flight.get(key) is flight:
+                    del LLM_request._in_flight[key]
+
+            flight["task"].add_done_callback(_forget)
+        else:
+            request.close()
+            LLM_request._coalesced_requests += 1
+            logger.debug(f"模型 {self.model_name} 的相同请求正在进行，等待共享结果")
+
+        flight["waiters"] += 1
+        try:
+            return await asyncio.shield(flight["task"])
+        except asyncio.CancelledError:
+            # 所有调用方都放弃等待时才取消上游请求
+            if flight["waiters"] == 1 and not flight["task"].done():
+                flight["task"].cancel()
+            raise
+        finally:
+            flight["waiters"] -= 1
+
+    async def _send_timed(
+            self,
+            endpoint: str,
+            prompt: str,
+            image_base64: str,
+            payload: dict,
+            retry_policy: dict,
+            response_handler: callable,
+            user_id: str,
+            request_type: str,
+            stream_callback: Callable[[str, str], None] = None
+    ):
+        """发送请求并记录耗时和失败率，合并的请求只由实际发出请求的一方记录一次
+
+        回复模型路由使用生成回复时单独记录的"回复耗时"；调用方主动取消、超过截止时间
+        以及熔断中直接失败、请求体过大的请求不计入
+        """
+        tracker = get_latency_tracker(f"{self.model_name} 请求耗时")
+        start = time.monotonic()
+        try:
+            result = await self._send_request(endpoint, prompt, image_base64, payload, retry_policy,
+                                              response_handler, user_id, request_type, stream_callback)
+        except (CircuitOpenError, DeadlineExceeded, PayloadTooLargeError):
+            raise
+        except Exception:
+            tracker.record_error()
+            raise
+        tracker.record(time.monotonic() - start)
+        return result
+
+    def _is_shareable(self, endpoint: str, payload: dict) -> bool:
+        """请求的结果是否只取决于请求体，可以与并发的相同请求共享"""
+        return self.coalesce or payload.get("temperature") == 0
+
+    def _get_fallback(self) -> Optional["LLM_request"]:
+        """获取备用模型的实例，使用与本实例相同的请求参数"""
+        if not self.fallback:
+            return None
+        fallback_model = getattr(global_config, self.fallback, None)
+        if not isinstance(fallback_model, dict) or not fallback_model.get("name"):
+            logger.error(f"模型 {self.model_name} 的备用模型 {self.fallback} 不存在，请检查配置")
+            return None
+        return LLM_request.get_instance(fallback_model, cache_ttl=self.cache_ttl, coalesce=self.coalesce, **self.params)
+
+    @classmethod
+    def get_single_flight_stats(cls) -> Dict[str, Dict[str, int]]:
+        """获取相同请求合并的运行指标"""
+        return {"合并": {"进行中": len(cls._in_flight), "合并次数": cls._coalesced_requests}}
+
+    async def _send_request(
+            self,
+            endpoint: str,
+            prompt: str = None,
+            image_base64: str = None,
+            payload: dict = None,
+            retry_policy: dict = None,
+            response_handler: callable = None,
+            user_id: str = "system",
+            request_type: str = "chat",
+            stream_callback: Callable[[str, str], None] = None
+    ):
+        """实际发送请求，负责限流、重试和响应解析
+        
+        流式请求一旦已经把分片交给 stream_callback，失败后不再重试，避免调用方收到重复的内容
+        
         Args:
             endpoint: API端点路径 (如 "chat/completions")
             prompt: prompt文本
@@ -119,6 +374,7 @@ class LLM_request:
             response_handler: 自定义响应处理器
             user_id: 用户ID
             request_type: 请求类型
+            stream_callback: 流式输出的分片回调
         """
         # 合并重试策略
         default_retry = {
@@ -140,48 +396,106 @@ class LLM_request:
         }
 
         api_url = f"{self.base_url.rstrip('/')}/{endpoint.lstrip('/')}"
+        # 构建请求体
+        if payload is None:
+            payload = await self._build_payload(prompt, image_base64)
+
         #判断是否为流式
-        stream_mode = self.params.get("stream", False)
-        if self.params.get("stream", False) is True:
+        stream_mode = payload.get("stream", False) is True
+        if stream_mode:
             logger.info(f"进入流式输出模式，发送请求到URL: {api_url}")
         else:
             logger.info(f"发送请求到URL: {api_url}")
         logger.info(f"使用模型: {self.model_name}")
+        # 是否已经有分片交给了 stream_callback
+        streamed = False
 
-        # 构建请求体
-        if image_base64:
-            payload = await self._build_payload(prompt, image_base64)
-        elif payload is None:
-            payload = await self._build_payload(prompt)
+        # 预估输入token数，用于本地的tpm限流
+        estimated_tokens = estimate_payload_tokens(payload)
+        # 优先级由调用方所在的上下文决定，回复优先于记忆构建等后台任务
+        priority = get_current_priority()
+        # 排队、连接、首字延迟、重试等耗时分解，随用量记录保存
+        timing = RequestTiming(self.model_name, request_type)
 
         for retry in range(policy["max_retries"]):
             try:
                 # 使用上下文管理器处理会话
-                headers = await self._build_headers()
+                api_key = self.key_pool.acquire()
+                headers = await self._build_headers(api_key=api_key)
                 #似乎是openai流式必须要的东西,不过阿里云的qwq-plus加了这个没有影响
                 if stream_mode:
                     headers["Accept"] = "text/event-stream"
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(api_url, headers=headers, json=payload) as response:
+                # 复用同一API地址的连接池，避免每次请求重新握手
+                session = ClientSessionPool.get_instance().get_session(self.base_url)
+                # 调用方的截止时间已到（如思考超时），不再发出请求
+                remaining = remaining_time()
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded(f"模型 {self.model_name} 的请求已超过截止时间")
+                # 熔断中的服务商直接失败，不再排队和重试
+                self.breaker.before_request()
+                # 在本地排队获取请求名额，名额在每次尝试结束后立即归还，退避等待期间不占用
+                try:
+                    wait_time = await self.limiter.acquire(estimated_tokens, priority, timeout=remaining)
+                except BaseException as e:
+                    self.breaker.record(None, 0)
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise DeadlineExceeded(f"模型 {self.model_name} 排队到截止时间仍未轮到") from e
+                    raise
+                timing.queue_wait += wait_time
+                if wait_time > 1:
+                    logger.info(f"模型 {self.model_name} ({priority.name}) 排队等待了 {wait_time:.2f} 秒")
+                used_tokens = None
+                # 流式输出已收到的内容
+                accumulated_content = ""
+                # 本次尝试对服务商健康状况的判断，None 表示与服务商健康无关（如429、请求被拒绝）
+                healthy = None
+                request_start = time.monotonic()
+                # 以收到响应头的时间作为延迟，流式输出的总时长与服务商健康无关
+                first_byte_time = None
+                timing.start_attempt()
+                # 连接池的 trace 回调把新建连接的耗时写到这里
+                trace_ctx = {}
+                try:
+                    async with session.post(api_url, headers=headers, json=payload, trace_request_ctx=trace_ctx) as response:
+                        first_byte_time = time.monotonic()
+                        timing.connect += trace_ctx.get("connect", 0.0)
+                        if not stream_mode:
+                            timing.first_token()
                         # 处理需要重试的状态码
                         if response.status in policy["retry_codes"]:
                             wait_time = policy["base_wait"] * (2 ** retry)
-                            logger.warning(f"错误码: {response.status}, 等待 {wait_time}秒后重试")
                             if response.status == 413:
+                                # 只有图片可以压缩，其他请求体（如批量 embedding）原样重试没有意义，交给调用方拆分
+                                if not image_base64:
+                                    raise PayloadTooLargeError(f"模型 {self.model_name} 的请求体过大")
                                 logger.warning("请求体过大，尝试压缩...")
                                 image_base64 = compress_base64_image_by_scale(image_base64)
                                 payload = await self._build_payload(prompt, image_base64)
+                                continue
                             elif response.status in [500, 503]:
+                                healthy = False
                                 logger.error(f"错误码: {response.status} - {error_code_mapping.get(response.status)}")
                                 raise RuntimeError("服务器负载过高，模型恢复失败QAQ")
                             else:
-                                logger.warning(f"请求限制(429)，等待{wait_time}秒后重试...")
-
-                            await asyncio.sleep(wait_time)
-                            continue
+                                # 优先使用服务商给出的 Retry-After，暂停期间同一服务商的请求都在本地排队
+                                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                                if retry_after is not None:
+                                    wait_time = retry_after
+                                # 限流按 key 计算，还有其他可用的 key 时只停用这个 key，立即换 key 重试
+                                self.key_pool.report_rate_limited(api_key, wait_time)
+                                if self.key_pool.has_available(exclude=api_key):
+                                    continue
+                                logger.warning(f"请求限制(429)，{self.provider} 暂停{wait_time}秒后重试...")
+                                self.limiter.throttle(wait_time)
+                                continue
                         elif response.status in policy["abort_codes"]:
                             logger.error(f"错误码: {response.status} - {error_code_mapping.get(response.status)}")
+                            # 余额不足或认证失败的 key 停用，有其他 key 时换 key 重试
+                            if response.status in [401, 402, 403] and len(self.key_pool) > 1:
+                                self.key_pool.report_quota_exhausted(api_key)
+                                if self.key_pool.has_available(exclude=api_key):
+                                    continue
                             if response.status == 403 :
                                 if global_config.llm_normal == "Pro/deepseek-ai/DeepSeek-V3":
                                     logger.error("可能是没有给硅基流动充钱，普通模型自动退化至非Pro模型，反应速度可能会变慢")
@@ -191,11 +505,17 @@ class LLM_request:
                                     global_config.llm_reasoning = "deepseek-ai/DeepSeek-R1"
                             raise RuntimeError(f"请求被拒绝: {error_code_mapping.get(response.status)}")
                             
-                        response.raise_for_status()
+                        try:
+                            response.raise_for_status()
+                        except aiohttp.ClientResponseError:
+                            healthy = False
+                            raise
+                        healthy = True
                         
                         #将流式输出转化为非流式输出
                         if stream_mode:
-                            accumulated_content = ""
+                            # 部分服务商在最后一个分片里给出用量，没有时按估算值记录
+                            stream_usage = None
                             async for line_bytes in response.content:
                                 line = line_bytes.decode("utf-8").strip()
                                 if not line:
@@ -206,13 +526,30 @@ class LLM_request:
                                         break
                                     try:
                                         chunk = json.loads(data_str)
+                                        stream_usage = chunk.get("usage") or stream_usage
+                                        if not chunk.get("choices"):
+                                            continue
                                         delta = chunk["choices"][0]["delta"]
                                         delta_content = delta.get("content")
                                         if delta_content is None:
                                             delta_content = ""
                                         accumulated_content += delta_content
+                                        delta_reasoning = delta.get("reasoning_content") or ""
+                                        if delta_content or delta_reasoning:
+                                            timing.first_token()
+                                        if stream_callback and (delta_content or delta_reasoning):
+                                            streamed = True
+                                            stream_callback(delta_content, delta_reasoning)
                                     except Exception as e:
                                         logger.error(f"解析流式输出错误: {e}")
+                            if not stream_usage:
+                                completion_tokens = estimate_tokens(accumulated_content)
+                                stream_usage = {
+                                    "prompt_tokens": estimated_tokens,
+                                    "completion_tokens": completion_tokens,
+                                    "total_tokens": estimated_tokens + completion_tokens,
+                                }
+                            used_tokens = stream_usage.get("total_tokens")
                             content = accumulated_content
                             reasoning_content = ""
                             think_match = re.search(r'<think>(.*?)</think>', content, re.DOTALL)
@@ -220,18 +557,59 @@ class LLM_request:
                                 reasoning_content = think_match.group(1).strip()
                             content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL).strip()
                             # 构造一个伪result以便调用自定义响应处理器或默认处理器
-                            result = {"choices": [{"message": {"content": content, "reasoning_content": reasoning_content}}]}
-                            return response_handler(result) if response_handler else self._default_response_handler(result, user_id, request_type, endpoint)
+                            result = {
+                                "choices": [{"message": {"content": content, "reasoning_content": reasoning_content}}],
+                                "usage": stream_usage,
+                            }
+                            timing.finish(stream_usage.get("completion_tokens"))
+                            return self._handle_response(result, response_handler, user_id, request_type, endpoint, timing)
                         else:
                             result = await response.json()
+                            used_tokens = (result.get("usage") or {}).get("total_tokens")
+                            timing.finish((result.get("usage") or {}).get("completion_tokens"))
                             # 使用自定义处理器或默认处理
-                            return response_handler(result) if response_handler else self._default_response_handler(result, user_id, request_type, endpoint)
-
+                            return self._handle_response(result, response_handler, user_id, request_type, endpoint, timing)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    # 连接失败、超时、连接中断
+                    healthy = False
+                    raise
+                except asyncio.CancelledError:
+                    # 调用方提前结束了流式输出，已经生成的部分同样计费，按估算值记录
+                    if accumulated_content:
+                        completion_tokens = estimate_tokens(accumulated_content)
+                        self._record_usage(
+                            prompt_tokens=estimated_tokens,
+                            completion_tokens=completion_tokens,
+                            total_tokens=estimated_tokens + completion_tokens,
+                            user_id=user_id,
+                            request_type=request_type,
+                            endpoint=endpoint
+                        )
+                    raise
+                finally:
+                    # 用实际用量修正预估值
+                    self.limiter.release(used_tokens - estimated_tokens if used_tokens else 0, priority)
+                    self.breaker.record(healthy, (first_byte_time or time.monotonic()) - request_start)
+
+            except (CircuitOpenError, DeadlineExceeded, PayloadTooLargeError):
+                raise
             except Exception as e:
+                if streamed:
+                    logger.error(f"流式输出中断: {str(e)}")
+                    raise RuntimeError(f"流式输出中断: {str(e)}") from e
+                # 重试期间服务商被熔断，不再继续等待
+                if self.breaker.state != CircuitBreaker.CLOSED:
+                    raise CircuitOpenError(f"服务商 {self.provider} 已熔断，放弃重试: {str(e)}") from e
                 if retry < policy["max_retries"] - 1:
                     wait_time = policy["base_wait"] * (2 ** retry)
+                    # 等到截止时间之后的重试没有意义
+                    remaining = remaining_time()
+                    if remaining is not None and remaining <= wait_time:
+                        raise DeadlineExceeded(f"距离截止时间不足{wait_time}秒，放弃重试: {str(e)}") from e
                     logger.error(f"请求失败，等待{wait_time}秒后重试... 错误: {str(e)}")
+                    backoff_start = time.monotonic()
                     await asyncio.sleep(wait_time)
+                    timing.backoff += time.monotonic() - backoff_start
                 else:
                     logger.critical(f"请求失败: {str(e)}")
                     logger.critical(f"请求头: {await self._build_headers(no_key=True)} 请求体: {payload}")
@@ -284,14 +662,39 @@ class LLM_request:
                 "max_tokens": global_config.max_response_length,
                 **params_copy
             }
+        self._apply_stop(payload)
         # 如果 payload 中依然存在 max_tokens 且需要转换，在这里进行再次检查
         if self.model_name.lower() in ["o3-mini", "o1-mini", "o1-preview", "o1-2024-12-17", "o1-preview-2024-09-12", "o3-mini-2025-01-31", "o1-mini-2024-09-12"] and "max_tokens" in payload:
             payload["max_completion_tokens"] = payload.pop("max_tokens")
         return payload
         
 
+    def _apply_stop(self, payload: dict):
+        """加入模型配置的停止序列，调用方在请求参数里指定的优先"""
+        if self.stop and "stop" not in payload:
+            payload["stop"] = self.stop
+
+    def _handle_response(self, result: dict, response_handler: callable, user_id: str,
+                         request_type: str, endpoint: str, timing: RequestTiming):
+        """解析响应；自定义处理器（如 embedding）只负责解析结果，用量和耗时在这里记录"""
+        if response_handler is None:
+            return self._default_response_handler(result, user_id, request_type, endpoint, timing)
+        usage = result.get("usage") or {}
+        if usage:
+            self._record_usage(
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+                total_tokens=usage.get("total_tokens", 0),
+                user_id=user_id,
+                request_type=request_type,
+                endpoint=endpoint,
+                timing=timing
+            )
+        return response_handler(result)
+
     def _default_response_handler(self, result: dict, user_id: str = "system", 
-                                request_type: str = "chat", endpoint: str = "/chat/completions") -> Tuple:
+                                request_type: str = "chat", endpoint: str = "/chat/completions",
+                                timing: RequestTiming = None) -> Tuple:
         """默认响应解析"""
         if "choices" in result and result["choices"]:
             message = result["choices"][0]["message"]
@@ -315,7 +718,8 @@ class LLM_request:
                     total_tokens=total_tokens,
                     user_id=user_id,
                     request_type=request_type,
-                    endpoint=endpoint
+                    endpoint=endpoint,
+                    timing=timing
                 )
 
             return content, reasoning_content
@@ -332,7 +736,7 @@ class LLM_request:
             reasoning = ""
         return content, reasoning
 
-    async def _build_headers(self, no_key: bool = False) -> dict:
+    async def _build_headers(self, no_key: bool = False, api_key: str = None) -> dict:
         """构建请求头"""
         if no_key:
             return {
@@ -341,31 +745,58 @@ class LLM_request:
             }
         else:
             return {
-                "Authorization": f"Bearer {self.api_key}",
+                "Authorization": f"Bearer {api_key or self.api_key}",
                 "Content-Type": "application/json"
             } 
         # 防止小朋友们截图自己的key
 
-    async def generate_response(self, prompt: str) -> Tuple[str, str]:
-        """根据输入的提示生成模型的异步响应"""
+    async def generate_response(self, prompt: str, request_type: str = "chat") -> Tuple[str, str]:
+        """根据输入的提示生成模型的异步响应，request_type 用于区分用量记录和耗时统计（如 topic、memory）"""
 
         content, reasoning_content = await self._execute_request(
             endpoint="/chat/completions",
-            prompt=prompt
+            prompt=prompt,
+            request_type=request_type
         )
         return content, reasoning_content
 
-    async def generate_response_for_image(self, prompt: str, image_base64: str) -> Tuple[str, str]:
+    def generate_response_stream(self, prompt: str) -> StreamResponse:
+        """流式生成响应，异步迭代得到可见内容的增量（<think> 思维链已实时过滤）
+        
+        Example:
+            stream = llm.generate_response_stream(prompt)
+            try:
+                async for delta in stream:
+                    ...
+            finally:
+                stream.close()
+            content, reasoning = stream.content, stream.reasoning_content
+        """
+        async def request(callback):
+            payload = await self._build_payload(prompt)
+            payload["stream"] = True
+            return await self._execute_request(
+                endpoint="/chat/completions",
+                prompt=prompt,
+                payload=payload,
+                stream_callback=callback
+            )
+        return StreamResponse(request)
+
+    async def generate_response_for_image(self, prompt: str, image_base64: str,
+                                          request_type: str = "image") -> Tuple[str, str]:
         """根据输入的提示和图片生成模型的异步响应"""
 
         content, reasoning_content = await self._execute_request(
             endpoint="/chat/completions",
             prompt=prompt,
-            image_base64=image_base64
+            image_base64=image_base64,
+            request_type=request_type
         )
         return content, reasoning_content
 
-    async def generate_response_async(self, prompt: str, **kwargs) -> Union[str, Tuple[str, str]]:
+    async def generate_response_async(self, prompt: str, request_type: str = "chat",
+                                      **kwargs) -> Union[str, Tuple[str, str]]:
         """异步方式根据输入的提示生成模型的响应"""
         # 构建请求体
         data = {
@@ -374,42 +805,107 @@ class LLM_request:
             "max_tokens": global_config.max_response_length,
             **self.params
         }
+        self._apply_stop(data)
 
         content, reasoning_content = await self._execute_request(
             endpoint="/chat/completions",
             payload=data,
-            prompt=prompt
+            prompt=prompt,
+            request_type=request_type
         )
         return content, reasoning_content
 
     async def get_embedding(self, text: str) -> Union[list, None]:
         """异步方法：获取文本的embedding向量
         
+        并发的单条调用会在几毫秒内合并成一次批量请求，见 get_embeddings
+        
         Args:
             text: 需要获取embedding的文本
             
         Returns:
             list: embedding向量，如果失败则返回None
         """
-        def embedding_handler(result):
-            """处理响应"""
-            if "data" in result and len(result["data"]) > 0:
-                return result["data"][0].get("embedding", None)
-            return None
+        # 内存缓存命中时直接返回，不必等待合并
+        embedding = EmbeddingCache.get_instance().get_from_memory(self.model_name, text) if text else None
+        if embedding is not None:
+            return embedding
+        if self._embedding_batcher is None:
+            self._embedding_batcher = EmbeddingBatcher(
+                self.get_embeddings,
+                max_batch_size=global_config.embedding_batch_size,
+                wait_ms=global_config.embedding_batch_wait_ms,
+            )
+        return await self._embedding_batcher.submit(text)
 
-        embedding = await self._execute_request(
-            endpoint="/embeddings",
-            prompt=text,
-            payload={
-                "model": self.model_name,
-                "input": text,
-                "encoding_format": "float"
-            },
-            retry_policy={
-                "max_retries": 2,
-                "base_wait": 6
-            },
-            response_handler=embedding_handler
-        )
-        return embedding
+    async def get_embeddings(self, texts: List[str]) -> List[Optional[list]]:
+        """异步方法：批量获取文本的embedding向量
+        
+        先查 embedding 缓存，只请求未命中的文本；按条数和估算token数自动分批，
+        各批并发请求（受限流器约束），结果顺序与输入一致
+        
+        Args:
+            texts: 需要获取embedding的文本列表
+            
+        Returns:
+            List[Optional[list]]: 与 texts 一一对应的embedding向量，空文本或所在批次失败时为None
+        """
+        results: List[Optional[list]] = [None] * len(texts)
+        # 服务商不接受空字符串输入，直接跳过
+        candidates = [i for i, text in enumerate(texts) if text and text.strip()]
+        cache = EmbeddingCache.get_instance()
+        cached = await cache.get_many(self.model_name, [texts[i] for i in candidates])
+        # 未命中的文本 -> 它在 texts 中的所有位置，重复的文本只请求一次
+        pending: Dict[str, List[int]] = {}
+        for i, embedding in zip(candidates, cached):
+            if embedding is not None:
+                results[i] = embedding
+            else:
+                pending.setdefault(texts[i], []).append(i)
+        valid_texts = list(pending)
+        batches = split_batches(valid_texts, global_config.embedding_batch_size, global_config.embedding_batch_max_tokens)
+
+        def embedding_handler(result):
+            """处理响应，按返回的 index 还原顺序"""
+            embeddings = [None] * len(result.get("data") or [])
+            for position, item in enumerate(result.get("data") or []):
+                embeddings[item.get("index", position)] = item.get("embedding", None)
+            return embeddings
+
+        async def request_batch(batch: List[int]):
+            batch_texts = [valid_texts[i] for i in batch]
+            try:
+                embeddings = await self._execute_request(
+                    endpoint="/embeddings",
+                    payload={
+                        "model": self.model_name,
+                        "input": batch_texts,
+                        "encoding_format": "float"
+                    },
+                    retry_policy={
+                        "max_retries": 2,
+                        "base_wait": 6
+                    },
+                    response_handler=embedding_handler,
+                    request_type="embedding"
+                )
+            except PayloadTooLargeError:
+                # 估算的token数偏小，服务商拒收时对半拆分后重新请求
+                if len(batch) == 1:
+                    logger.error(f"获取embedding失败，文本过长: {batch_texts[0][:20]}...")
+                    return
+                logger.warning(f"批量embedding请求体过大，拆分为两批重新请求，共{len(batch)}条")
+                middle = len(batch) // 2
+                await asyncio.gather(request_batch(batch[:middle]), request_batch(batch[middle:]))
+                return
+            except Exception as e:
+                logger.error(f"批量获取embedding失败，共{len(batch_texts)}条: {e}")
+                return
+            for i, embedding in zip(batch, embeddings):
+                for position in pending[valid_texts[i]]:
+                    results[position] = embedding
+
+        await asyncio.gather(*(request_batch(batch) for batch in batches))
+        await cache.set_many(self.model_name, valid_texts, [results[pending[text][0]] for text in valid_texts])
+        return results
 
@@ -27,7 +27,7 @@ class ScheduleGenerator:
     def __init__(self):
         #根据global_config.llm_normal这一字典配置指定模型
         # self.llm_scheduler = LLMModel(model = global_config.llm_normal,temperature=0.9)
-        self.llm_scheduler = LLM_request(model = global_config.llm_normal,temperature=0.9)
+        self.llm_scheduler = LLM_request.get_instance(model = global_config.llm_normal,temperature=0.9)
         self.db = Database.get_instance()
         self.today_schedule_text = ""
         self.today_schedule = {}
@@ -69,7 +69,7 @@ class ScheduleGenerator:
             请按照时间顺序列出具体时间点和对应的活动，用一个时间点而不是时间段来表示时间，用JSON格式返回日程表，仅返回内容，不要返回注释，时间采用24小时制，格式为{"时间": "活动","时间": "活动",...}。"""
             
             try:
-                schedule_text, _ = await self.llm_scheduler.generate_response(prompt)
+                schedule_text, _ = await self.llm_scheduler.generate_response(prompt, request_type="schedule")
                 self.db.db.schedule.insert_one({"date": date_str, "schedule": schedule_text})
             except Exception as e:
                 logger.error(f"生成日程失败: {str(e)}")
@@ -1,8 +1,10 @@
+import asyncio
+import concurrent.futures
 import threading
 import time
 from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional
 
 from ...common.database import Database
 
@@ -18,10 +20,27 @@ class LLMStatistics:
         self.output_file = output_file
         self.running = False
         self.stats_thread = None
+        # 进程内的运行时指标来源，标题 -> 返回 {名称: {指标: 值}} 的函数
+        self.runtime_sources: Dict[str, Callable[[], Dict[str, Dict[str, Any]]]] = {}
+        # 运行时指标所在的事件循环，指标对象只在事件循环中修改，统计线程要回到事件循环中读取
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        
+    def register_runtime_source(self, title: str, getter: Callable[[], Dict[str, Dict[str, Any]]]):
+        """注册运行时指标来源，统计报告中会附带这些指标
+        
+        Args:
+            title: 报告中的小节标题
+            getter: 返回 {名称: {指标: 值}} 的函数
+        """
+        self.runtime_sources[title] = getter
         
     def start(self):
-        """启动统计线程"""
+        """启动统计线程，在事件循环中调用时运行时指标会回到这个事件循环中读取"""
         if not self.running:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._loop = None
             self.running = True
             self.stats_thread = threading.Thread(target=self._stats_loop)
             self.stats_thread.daemon = True
@@ -124,6 +143,43 @@ class LLMStatistics:
         
         return "\n".join(output)
     
+    def _format_runtime_section(self, title: str, getter: Callable[[], Dict[str, Dict[str, Any]]]) -> str:
+        """格式化运行时指标的输出"""
+        output = []
+        output.append(f"\n{title}")
+        output.append("=" * len(title))
+        try:
+            metrics = getter()
+        except Exception as e:
+            output.append(f"获取指标失败: {e}")
+            return "\n".join(output)
+        if not metrics:
+            output.append("暂无数据")
+        for name, values in metrics.items():
+            if isinstance(values, dict):
+                items = ", ".join(f"{key}: {value}" for key, value in values.items())
+                output.append(f"- {name}: {items}")
+            else:
+                output.append(f"- {name}: {values}")
+        return "\n".join(output)
+    
+    def _format_runtime_sections(self) -> List[str]:
+        return [self._format_runtime_section(title, getter) for title, getter in list(self.runtime_sources.items())]
+
+    async def _snapshot_runtime_sections(self) -> List[str]:
+        return self._format_runtime_sections()
+
+    def _collect_runtime_sections(self) -> List[str]:
+        """在事件循环中读取并格式化运行时指标，避免统计线程遍历字典、队列的同时被协程修改"""
+        if self._loop is None or not self._loop.is_running():
+            return self._format_runtime_sections()
+        future = asyncio.run_coroutine_threadsafe(self._snapshot_runtime_sections(), self._loop)
+        try:
+            return future.result(timeout=10)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return ["\n运行时指标\n==========\n事件循环繁忙，获取指标超时"]
+
     def _save_statistics(self, all_stats: Dict[str, Dict[str, Any]]):
         """将统计结果保存到文件"""
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -143,6 +199,9 @@ class LLMStatistics:
         for title, key in sections:
             output.append(self._format_stats_section(all_stats[key], title))
             
+        # 添加运行时指标
+        output.extend(self._collect_runtime_sections())
+            
         # 写入文件
         with open(self.output_file, "w", encoding="utf-8") as f:
             f.write("\n".join(output))
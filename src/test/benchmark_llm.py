@@ -0,0 +1,197 @@
+"""
+模型请求层的压测脚本 - 配合 mock_provider.py 在本地测量吞吐和延迟分位数
+
+按目标并发驱动 LLM_request（普通、流式、embedding 请求）或 ResponseGenerator 的回复流程
+（路由选择、对冲、流式首字），所有模型都指向模拟服务商，不消耗真实额度
+
+用法（在项目根目录运行，需要能加载 .env 和 config/bot_config.toml，MongoDB 不可用时只会记录写入失败）:
+    python src/test/benchmark_llm.py --mode stream --concurrency 32 --requests 500 --start-mock
+    python src/test/benchmark_llm.py --mode reply --base-url http://127.0.0.1:8765/v1
+
+--start-mock 会在同一进程中启动模拟服务商，--mock-args 传给它的参数，如 --mock-args="--ttft 1 --error-429 0.05"
+"""
+
+import argparse
+import asyncio
+import os
+import shlex
+import sys
+import time
+from typing import Dict, List, Optional
+
+import nonebot
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["chat", "stream", "embedding", "image", "reply"]
+# 1x1 的透明 PNG
+TINY_PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="模型请求层压测")
+    parser.add_argument("--mode", choices=MODES, default="chat")
+    parser.add_argument("--concurrency", type=int, default=16, help="同时进行的请求数")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8765/v1", help="模拟服务商地址")
+    parser.add_argument("--model", default="mock-chat", help="请求时使用的模型名")
+    parser.add_argument("--prompt-chars", type=int, default=500, help="每个 prompt 的长度")
+    parser.add_argument("--unique-prompts", action="store_true", help="每个请求的 prompt 都不同，避免命中缓存和合并")
+    parser.add_argument("--start-mock", action="store_true", help="在同一进程中启动模拟服务商")
+    parser.add_argument("--mock-args", default="", help="传给模拟服务商的参数")
+    return parser.parse_args()
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class BenchmarkResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.first_token: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.characters = 0
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+
+    def add_error(self, error: BaseException):
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, mode: str, concurrency: int):
+        elapsed = (self.end or time.monotonic()) - self.start
+        done = len(self.latencies)
+        print(f"\n===== {mode} 并发{concurrency} =====")
+        print(f"成功 {done} 次，失败 {sum(self.errors.values())} 次 {self.errors or ''}")
+        print(f"耗时 {elapsed:.2f}秒，吞吐 {done / elapsed:.2f} 次/秒，输出 {self.characters / elapsed:.1f} 字/秒")
+        for name, values in (("总耗时", self.latencies), ("首字延迟", self.first_token)):
+            if values:
+                print(f"{name}: p50 {percentile(values, 0.5):.3f}秒  p95 {percentile(values, 0.95):.3f}秒  "
+                      f"p99 {percentile(values, 0.99):.3f}秒  最大 {max(values):.3f}秒")
+
+
+def mock_model(name: str) -> dict:
+    return {"name": name, "base_url": "MOCK_BASE_URL", "key": "MOCK_KEY", "provider": "MOCK"}
+
+
+def make_prompt(index: int, args: argparse.Namespace) -> str:
+    prefix = f"[{index}]" if args.unique_prompts else ""
+    body = "今天群里在聊什么呢，我也想参与一下讨论。"
+    return (prefix + body * (args.prompt_chars // len(body) + 1))[:args.prompt_chars]
+
+
+async def run(args: argparse.Namespace):
+    # 导入时会加载聊天插件（初始化数据库等），之后再把各模型项改为指向模拟服务商，
+    # 下面创建的 LLM_request 和 ResponseGenerator 都使用修改后的配置
+    from src.plugins.chat.config import global_config
+    for attr in ("llm_reasoning", "llm_reasoning_minor", "llm_normal", "llm_normal_minor", "vlm"):
+        setattr(global_config, attr, mock_model(args.model))
+    global_config.embedding = mock_model("mock-embedding")
+
+    from src.plugins.chat.llm_generator import ResponseGenerator
+    from src.plugins.models.client_pool import ClientSessionPool
+    from src.plugins.models.rate_limiter import get_limiter_stats
+    from src.plugins.models.timing import EventLoopMonitor, get_timing_stats
+    from src.plugins.models.usage_recorder import UsageRecorder
+    from src.plugins.models.utils_model import LLM_request
+
+    runner = None
+    if args.start_mock:
+        from mock_provider import parse_args as parse_mock_args, start_mock_provider
+        runner = await start_mock_provider(parse_mock_args(shlex.split(args.mock_args)))
+
+    EventLoopMonitor.get_instance().start()
+    llm = LLM_request.get_instance(mock_model(args.model), temperature=0.7, max_tokens=1000)
+    embedding = LLM_request.get_instance(global_config.embedding)
+    generator = ResponseGenerator() if args.mode == "reply" else None
+
+    async def one_request(index: int, result: BenchmarkResult):
+        prompt = make_prompt(index, args)
+        start = time.monotonic()
+        if args.mode == "chat":
+            content, _ = await llm.generate_response(prompt)
+            result.characters += len(content or "")
+        elif args.mode == "image":
+            content, _ = await llm.generate_response_for_image(prompt, TINY_PNG)
+            result.characters += len(content or "")
+        elif args.mode == "embedding":
+            vector = await embedding.get_embedding(prompt)
+            if vector is None:
+                raise RuntimeError("embedding 为空")
+        elif args.mode == "stream":
+            stream = llm.generate_response_stream(prompt)
+            try:
+                async for _ in stream:
+                    pass
+            finally:
+                stream.close()
+            if stream.first_token_latency is not None:
+                result.first_token.append(stream.first_token_latency)
+            result.characters += len(stream.content)
+        else:
+            # 回复流程去掉了构建 prompt（读数据库、记忆）的部分，只测模型选择、对冲和流式生成
+            model = generator._select_model()
+            attempt, delta = await generator._start_reply(model, prompt)
+            result.first_token.append(time.monotonic() - start)
+            try:
+                if delta is not None:
+                    async for _ in attempt.iterator:
+                        pass
+            finally:
+                await attempt.close()
+            result.characters += len(attempt.stream.content)
+        result.latencies.append(time.monotonic() - start)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    result = BenchmarkResult()
+
+    async def worker(index: int):
+        async with semaphore:
+            try:
+                await one_request(index, result)
+            except Exception as e:
+                result.add_error(e)
+
+    try:
+        await asyncio.gather(*(worker(i) for i in range(args.requests)))
+        result.end = time.monotonic()
+        result.report(args.mode, args.concurrency)
+
+        print("\n===== 模型调用耗时 =====")
+        for name, metrics in get_timing_stats().items():
+            print(f"{name}: " + "  ".join(f"{key} {value}" for key, value in metrics.items()))
+        print("\n===== 模型请求排队 =====")
+        for name, metrics in get_limiter_stats().items():
+            print(f"{name}: " + "  ".join(f"{key} {value}" for key, value in metrics.items()))
+        if generator is not None:
+            print("\n===== 回复模型路由 =====")
+            for name, state in generator.router.get_state().items():
+                print(f"{name}: " + "  ".join(f"{key} {value}" for key, value in state.items()))
+            print(generator.get_hedge_stats())
+    finally:
+        await UsageRecorder.get_instance().flush()
+        await ClientSessionPool.get_instance().close_all()
+        if runner is not None:
+            await runner.cleanup()
+
+
+def main():
+    args = parse_args()
+    # 和 bot.py 一样加载环境变量，再把模拟服务商的地址和key加入 nonebot 配置
+    load_dotenv(".env")
+    env = os.getenv("ENVIRONMENT")
+    if env and os.path.exists(f".env.{env}"):
+        load_dotenv(f".env.{env}", override=True)
+    nonebot.init(MOCK_BASE_URL=args.base_url, MOCK_KEY="mock-key")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
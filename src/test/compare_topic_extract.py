@@ -0,0 +1,147 @@
+"""
+主题识别方式对比 - 以主题判断模型（llm）的结果为参照，比较本地关键词提取（tfidf、textrank）的准确度和耗时
+
+从 messages 集合随机抽取消息，对每条消息：
+- 分别用 llm、tfidf、textrank 识别主题，记录耗时
+- 本地方式的主题与 llm 主题比较，一方包含另一方（如"原神"和"原神新版本"）即算匹配，计算精确率、召回率和 F1
+- 分别用几种方式的主题计算记忆激活值，比较是否同样激活了记忆（激活值>0）以及激活值的差距
+
+用法（在项目根目录运行，需要能加载 .env 和 config/bot_config.toml，会请求配置的主题判断模型）:
+    python src/test/compare_topic_extract.py --samples 200 --show 10
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Dict, List
+
+import nonebot
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_llm import percentile  # noqa: E402
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="主题识别方式对比")
+    parser.add_argument("--samples", type=int, default=100, help="抽取的消息数")
+    parser.add_argument("--min-length", type=int, default=6, help="只抽取至少这么长的消息")
+    parser.add_argument("--idf-messages", type=int, default=None, help="统计 IDF 的消息数，默认使用配置的 topic_idf_max_messages")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的模型请求数")
+    parser.add_argument("--show", type=int, default=5, help="打印多少条消息的识别结果")
+    return parser.parse_args()
+
+
+def topic_match(a: str, b: str) -> bool:
+    return a in b or b in a
+
+
+def compare_topics(local: List[str], reference: List[str]) -> Dict[str, float]:
+    """以 reference 为参照计算 local 的精确率和召回率，没有可比较的主题时记为1"""
+    precision = sum(any(topic_match(t, r) for r in reference) for t in local) / len(local) if local else 1.0
+    recall = sum(any(topic_match(r, t) for t in local) for r in reference) / len(reference) if reference else 1.0
+    return {"precision": precision, "recall": recall}
+
+
+async def run(args: argparse.Namespace):
+    # 导入时会加载聊天插件、连接数据库并加载记忆图
+    from src.common.database import Database
+    from src.plugins.chat.config import global_config
+    from src.plugins.chat.keyword_extractor import LOCAL_TOPIC_MODES, TOPIC_MODES, KeywordExtractor
+    from src.plugins.chat.message_analysis import MessageAnalysis
+    from src.plugins.memory_system.memory import hippocampus
+    from src.plugins.models.client_pool import ClientSessionPool
+    from src.plugins.models.usage_recorder import UsageRecorder
+
+    db = Database.get_instance()
+    extractor = KeywordExtractor.get_instance()
+    start = time.monotonic()
+    documents = extractor.learn_idf_from_db(db, args.idf_messages or global_config.topic_idf_max_messages)
+    print(f"从 {documents} 条消息统计 IDF，耗时 {time.monotonic() - start:.2f}秒，"
+          f"{'使用统计的 IDF 表' if documents >= extractor.MIN_DOCUMENTS else '消息太少，使用 jieba 自带的 IDF 表'}")
+
+    records = list(db.db.messages.aggregate([
+        {"$match": {"processed_plain_text": {"$exists": True, "$ne": "[表情包]"}}},
+        {"$sample": {"size": args.samples * 3}},
+    ]))
+    texts = [r["processed_plain_text"] for r in records if len(r["processed_plain_text"].strip()) >= args.min_length]
+    texts = texts[:args.samples]
+    if not texts:
+        print("没有可用的消息")
+        return
+
+    # 模式 -> 每条消息的主题/耗时/激活值
+    topics: Dict[str, List[List[str]]] = {mode: [[] for _ in texts] for mode in TOPIC_MODES}
+    latency: Dict[str, List[float]] = {mode: [] for mode in TOPIC_MODES}
+    activation: Dict[str, List[int]] = {mode: [0 for _ in texts] for mode in TOPIC_MODES}
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_message(index: int, text: str):
+        nonlocal errors
+        for mode in TOPIC_MODES:
+            analysis = MessageAnalysis(text)
+            try:
+                if mode == "llm":
+                    async with semaphore:
+                        mode_start = time.perf_counter()
+                        topics[mode][index] = await hippocampus._get_topics(text, analysis, mode)
+                else:
+                    mode_start = time.perf_counter()
+                    topics[mode][index] = await hippocampus._get_topics(text, analysis, mode)
+                latency[mode].append(time.perf_counter() - mode_start)
+                # 主题已缓存在 analysis 中，计算激活值不会再次请求模型
+                activation[mode][index] = await hippocampus.memory_activate_value(text, analysis=analysis, topic_mode=mode)
+            except Exception as e:
+                errors += 1
+                print(f"\033[1;31m[错误]\033[0m {mode} 识别「{text[:20]}」失败: {e}")
+
+    try:
+        await asyncio.gather(*(one_message(i, text) for i, text in enumerate(texts)))
+    finally:
+        await UsageRecorder.get_instance().flush()
+        await ClientSessionPool.get_instance().close_all()
+
+    print(f"\n===== 识别结果示例（共 {len(texts)} 条消息，失败 {errors} 次）=====")
+    for index in range(min(args.show, len(texts))):
+        print(f"\n消息: {texts[index]}")
+        for mode in TOPIC_MODES:
+            print(f"  {mode:<8} {topics[mode][index]}  激活值 {activation[mode][index]}")
+
+    print("\n===== 耗时 =====")
+    for mode in TOPIC_MODES:
+        values = latency[mode]
+        if values:
+            print(f"{mode:<8} p50 {percentile(values, 0.5) * 1000:.3f}毫秒  p95 {percentile(values, 0.95) * 1000:.3f}毫秒  "
+                  f"最大 {max(values) * 1000:.3f}毫秒")
+
+    print("\n===== 与 llm 主题比较 =====")
+    reference = topics["llm"]
+    for mode in LOCAL_TOPIC_MODES:
+        scores = [compare_topics(local, ref) for local, ref in zip(topics[mode], reference)]
+        precision = sum(s["precision"] for s in scores) / len(scores)
+        recall = sum(s["recall"] for s in scores) / len(scores)
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        activated = [(a > 0, b > 0) for a, b in zip(activation[mode], activation["llm"])]
+        agreement = sum(a == b for a, b in activated) / len(activated)
+        diff = sum(abs(a - b) for a, b in zip(activation[mode], activation["llm"])) / len(texts)
+        print(f"{mode:<8} 精确率 {precision:.2f}  召回率 {recall:.2f}  F1 {f1:.2f}  "
+              f"是否激活记忆一致 {agreement:.0%}  激活值平均差 {diff:.1f}")
+
+
+def main():
+    args = parse_args()
+    load_dotenv(".env")
+    env = os.getenv("ENVIRONMENT")
+    if env and os.path.exists(f".env.{env}"):
+        load_dotenv(f".env.{env}", override=True)
+    nonebot.init()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+本地的 OpenAI 兼容模拟服务商 - 不消耗真实额度地测试模型请求层的吞吐和延迟
+
+支持 chat/completions（含 SSE 流式输出和图片输入）和 embeddings，
+可以配置首字延迟的分布、输出速度、错误注入（429/500/413）和服务端并发上限
+
+用法:
+    python src/test/mock_provider.py --port 8765 --ttft 0.8 --tokens-per-second 40 --error-429 0.05
+
+然后在 .env 中填写（模型配置里 provider = "MOCK"）:
+    MOCK_BASE_URL=http://127.0.0.1:8765/v1
+    MOCK_KEY=mock-key
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from collections import Counter
+from typing import List, Optional
+
+from aiohttp import web
+
+SENTENCES = [
+    "哈哈哈这个我知道",
+    "今天天气还挺好的，适合出去玩",
+    "你说的有道理，不过我觉得还可以再想想",
+    "草，笑死我了",
+    "这个问题有点难，我得想一想",
+    "我刚刚在看番，没注意群里",
+    "好耶！",
+    "确实，我也是这么想的",
+]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="本地的 OpenAI 兼容模拟服务商")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.5, help="首字延迟的中位数（秒）")
+    parser.add_argument("--ttft-sigma", type=float, default=0.5, help="首字延迟对数正态分布的 sigma，越大长尾越明显")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="输出速度")
+    parser.add_argument("--reply-tokens", type=int, nargs=2, default=[20, 80], metavar=("MIN", "MAX"),
+                        help="回复长度范围（token，按一个汉字一个token计算）")
+    parser.add_argument("--reasoning-tokens", type=int, default=0, help="流式输出时先输出的思维链长度，模拟推理模型")
+    parser.add_argument("--error-429", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--error-500", type=float, default=0.0, help="返回500的概率")
+    parser.add_argument("--error-413", type=float, default=0.0, help="返回413的概率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429响应的 Retry-After（秒）")
+    parser.add_argument("--max-body", type=int, default=0, help="请求体超过这个字节数时返回413，0为不限")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="同时处理的请求超过这个数时返回429，0为不限")
+    parser.add_argument("--embedding-dim", type=int, default=1024)
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="embedding 请求的固定延迟（秒）")
+    parser.add_argument("--embedding-latency-per-item", type=float, default=0.002, help="每条文本额外增加的延迟（秒）")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+class MockProvider:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.in_flight = 0
+        self.stats = Counter()
+        if args.seed is not None:
+            random.seed(args.seed)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        for prefix in ("", "/v1"):
+            app.router.add_post(f"{prefix}/chat/completions", self.chat_completions)
+            app.router.add_post(f"{prefix}/embeddings", self.embeddings)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    def _ttft(self) -> float:
+        return random.lognormvariate(math.log(max(self.args.ttft, 1e-3)), self.args.ttft_sigma)
+
+    def _inject_error(self, body_size: int) -> Optional[web.Response]:
+        """按配置注入错误，返回错误响应；正常时返回 None"""
+        args = self.args
+        status = None
+        if args.max_body and body_size > args.max_body:
+            status = 413
+        elif args.max_concurrency and self.in_flight > args.max_concurrency:
+            status = 429
+        else:
+            rand = random.random()
+            if rand < args.error_429:
+                status = 429
+            elif rand < args.error_429 + args.error_500:
+                status = 500
+            elif rand < args.error_429 + args.error_500 + args.error_413:
+                status = 413
+        if status is None:
+            return None
+        self.stats[f"错误{status}"] += 1
+        headers = {"Retry-After": str(args.retry_after)} if status == 429 else None
+        return web.json_response({"error": {"message": f"mock error {status}", "code": status}},
+                                 status=status, headers=headers)
+
+    def _reply_text(self, max_tokens: Optional[int]) -> str:
+        length = random.randint(*self.args.reply_tokens)
+        if max_tokens:
+            length = min(length, max_tokens)
+        text = ""
+        while len(text) < length:
+            text += random.choice(SENTENCES) + random.choice(["。", "！", "？", "~"])
+        return text[:length]
+
+    @staticmethod
+    def _has_image(messages: list) -> bool:
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+                return True
+        return False
+
+    @staticmethod
+    def _apply_stop(text: str, stop) -> str:
+        """模拟停止序列：输出到停止序列时截断"""
+        if not stop:
+            return text
+        for sequence in [stop] if isinstance(stop, str) else stop:
+            index = text.find(sequence)
+            if index >= 0:
+                text = text[:index]
+        return text
+
+    @staticmethod
+    def _prompt_tokens(messages: list) -> int:
+        return sum(len(json.dumps(message.get("content"), ensure_ascii=False)) for message in messages)
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        self.in_flight += 1
+        try:
+            error = self._inject_error(len(body))
+            if error is not None:
+                return error
+            data = json.loads(body)
+            model = data.get("model", "mock")
+            messages = data.get("messages", [])
+            if self._has_image(messages):
+                self.stats["图片请求"] += 1
+                text = "这是一张模拟的图片，画面里有一只猫"
+            else:
+                text = self._reply_text(data.get("max_tokens") or data.get("max_completion_tokens"))
+            text = self._apply_stop(text, data.get("stop"))
+            prompt_tokens = self._prompt_tokens(messages)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text),
+                     "total_tokens": prompt_tokens + len(text)}
+
+            await asyncio.sleep(self._ttft())
+            if data.get("stream"):
+                self.stats["流式请求"] += 1
+                return await self._stream(request, model, text, usage)
+
+            self.stats["普通请求"] += 1
+            await asyncio.sleep(len(text) / self.args.tokens_per_second)
+            return web.json_response({
+                "id": f"mock-{time.time_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, model: str, text: str, usage: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: Optional[str] = None, **extra):
+            chunk = {
+                "id": "mock-stream",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        # 每个分片 1~3 个 token
+        reasoning = "嗯，让我想想怎么回答比较好" * (self.args.reasoning_tokens // 13 + 1)
+        for part, key in ((reasoning[:self.args.reasoning_tokens], "reasoning_content"), (text, "content")):
+            position = 0
+            while position < len(part):
+                size = random.randint(1, 3)
+                await send({key: part[position:position + size]})
+                position += size
+                await asyncio.sleep(size / self.args.tokens_per_second)
+        await send({}, finish_reason="stop")
+        # 和部分服务商一样，在最后一个分片中给出用量
+        usage = {**usage, "completion_tokens": usage["completion_tokens"] + self.args.reasoning_tokens}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        chunk = {"id": "mock-stream", "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _embedding(self, text: str) -> List[float]:
+        """同样的文本总是得到同样的向量"""
+        rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+        vector = [rng.gauss(0, 1) for _ in range(self.args.embedding_dim)]
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        self.in_flight += 1
+        try:
+            error = self._inject_error(len(body))
+            if error is not None:
+                return error
+            data = json.loads(body)
+            inputs = data.get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            self.stats["embedding请求"] += 1
+            self.stats["embedding条数"] += len(inputs)
+            await asyncio.sleep(self.args.embedding_latency + self.args.embedding_latency_per_item * len(inputs))
+            tokens = sum(len(text) for text in inputs)
+            return web.json_response({
+                "object": "list",
+                "model": data.get("model", "mock-embedding"),
+                "data": [{"object": "embedding", "index": i, "embedding": self._embedding(text)}
+                         for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"进行中": self.in_flight, **self.stats})
+
+
+async def start_mock_provider(args: argparse.Namespace) -> web.AppRunner:
+    """在当前事件循环中启动模拟服务商，返回的 runner 用 cleanup() 关闭"""
+    runner = web.AppRunner(MockProvider(args).create_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    cli_args = parse_args()
+    print(f"模拟服务商运行在 http://{cli_args.host}:{cli_args.port}/v1")
+    web.run_app(MockProvider(cli_args).create_app(), host=cli_args.host, port=cli_args.port, print=None)